@@ -1,3 +1,4 @@
-from .users import add_user, remove_user, list_users, rename_user, clear_users
+from .users import add_user, add_users, remove_user, list_users, rename_user, clear_users, migrate_users, DictAuthError
+from .credential_store import CredentialStore
 from .encrypt_password import encrypt_password
 from .dictionary_authenticator import DictionaryAuthenticator
@@ -0,0 +1,75 @@
+import os
+import json
+import tempfile
+import threading
+
+CREDENTIALS_FILENAME = 'dictauth_credentials.json'
+
+class CredentialStore(object):
+    """
+    JSON file of username -> {salt, digest}. The contents are cached in memory and
+    only re-read when the file changes on disk, so the authenticator picks up
+    added/removed users without a hub restart.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._users = {}
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        #saves replace the file, so the inode changes even if the mtime doesn't (coarse fs timestamps)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _refresh(self):
+        with self._lock:
+            stamp = self._file_stamp()
+            if stamp != self._stamp:
+                if stamp is None:
+                    self._users = {}
+                else:
+                    with open(self.path, 'r') as f:
+                        self._users = json.load(f)
+                self._stamp = stamp
+            return self._users
+
+    def get(self, username):
+        return self._refresh().get(username)
+
+    def users(self):
+        return dict(self._refresh())
+
+    def usernames(self):
+        return list(self._refresh().keys())
+
+    def save(self, users):
+        #write to a temp file in the same folder and atomically swap it in, so readers never see a partial file
+        with self._lock:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.dictauth-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(users, f, indent=1, sort_keys=True)
+                os.replace(tmp_path, self.path)
+            except:
+                os.remove(tmp_path)
+                raise
+            self._users = dict(users)
+            self._stamp = self._file_stamp()
+
+    def add(self, username, entry):
+        users = self.users()
+        users[username] = entry
+        self.save(users)
+
+    def remove(self, username):
+        users = self.users()
+        users.pop(username, None)
+        self.save(users)
@@ -1,23 +1,89 @@
 from jupyterhub.auth import Authenticator
+import asyncio
 import hashlib
-from traitlets import Dict
+import hmac
+import secrets
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from traitlets import Dict, Unicode, Integer
+from .credential_store import CredentialStore
+from .hashers import verify_password
 
 class DictionaryAuthenticator(Authenticator):
 
     encrypted_passwords = Dict(config=True,
-        help="""dict of username -> {digest -> hashval, salt -> saltval} for authentication with SHA512"""
+        help="""dict of username -> {digest -> hashval, salt -> saltval} for authentication (scrypt, or legacy SHA512)"""
     )
 
+    credentials_file = Unicode('', config=True,
+        help="""path to a dictauth credential store (see dictauth migrate_users); if set, it is used instead of encrypted_passwords
+        and is re-read whenever it changes on disk, so adding/removing users does not require a hub restart"""
+    )
+
+    hash_concurrency = Integer(4, config=True,
+        help="""max number of password hashes computed at once; hashing runs in a thread pool off the hub's event loop"""
+    )
+
+    verify_cache_size = Integer(1024, config=True,
+        help="""number of recent successful logins to remember so repeat logins skip the (slow) hash; 0 disables the cache"""
+    )
+
+    _store = None
+    _executor = None
+    _verify_cache = None
+    _cache_key = None
+
+    def get_credentials(self, username):
+        if self.credentials_file:
+            #create the store lazily; it caches the file contents until the file changes
+            if self._store is None or self._store.path != self.credentials_file:
+                self._store = CredentialStore(self.credentials_file)
+            return self._store.get(username)
+        return self.encrypted_passwords.get(username)
+
+    def _cache_tag(self, password, digest):
+        #never keep the password itself: remember a keyed hash (key is random per hub process) tied to the stored digest,
+        #so changing a user's credentials invalidates the cached entry
+        if self._cache_key is None:
+            self._cache_key = secrets.token_bytes(32)
+        return hmac.new(self._cache_key, (password + '\0' + digest).encode('utf-8'), hashlib.sha256).digest()
+
+    def _check_cache(self, username, tag):
+        if self._verify_cache is None or self.verify_cache_size <= 0:
+            return False
+        cached = self._verify_cache.get(username)
+        if cached is not None and hmac.compare_digest(cached, tag):
+            self._verify_cache.move_to_end(username)
+            return True
+        return False
+
+    def _update_cache(self, username, tag):
+        if self.verify_cache_size <= 0:
+            return
+        if self._verify_cache is None:
+            self._verify_cache = OrderedDict()
+        self._verify_cache[username] = tag
+        self._verify_cache.move_to_end(username)
+        while len(self._verify_cache) > self.verify_cache_size:
+            self._verify_cache.popitem(last=False)
+
     async def authenticate(self, handler, data):
         #check if username is in whitelist
-        if self.encrypted_passwords.get(data['username']):
-            #get digest/salt for that username
-            stored_digest = self.encrypted_passwords[data['username']]['digest']
-            salt = self.encrypted_passwords[data['username']]['salt']
-            #create the salted pw
-            salted_pw_bytes = (data['password']+salt).encode('utf-8')
-            #hash the pw
-            digest = hashlib.sha512(salted_pw_bytes).hexdigest()
-            #if it matches, return username
-            if digest == stored_digest:
-                return data['username']
+        username = data['username']
+        creds = self.get_credentials(username)
+        if not creds:
+            return
+        #get digest/salt for that username
+        stored_digest = creds['digest']
+        salt = creds['salt']
+        tag = self._cache_tag(data['password'], stored_digest)
+        if self._check_cache(username, tag):
+            return username
+        #hash the pw in the thread pool; the pool size caps how many hashes run at once
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.hash_concurrency)
+        valid = await asyncio.get_running_loop().run_in_executor(self._executor, verify_password, data['password'], salt, stored_digest)
+        #if it matches, return username
+        if valid:
+            self._update_cache(username, tag)
+            return username
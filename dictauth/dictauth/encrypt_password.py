@@ -1,5 +1,5 @@
 import secrets
-import hashlib
+from dictauth.hashers import encode_password
 import re
 import getpass
 
@@ -11,7 +11,7 @@ def encrypt_password(args):
     print("""
 ---------------------------------------------------------------------
 ---------------------------------------------------------------------
-This script converts a plain text password into a secure hash digest.
+This script converts a plain text password into a secure (scrypt) hash digest.
 Please input your password of choice.
 Your password must be a minimum of 8 chars, and must contain at least
 one letter and one number.
@@ -27,9 +27,9 @@ one letter and one number.
             print('Password must be a minimum of 8 chars, and must contain at least one letter and one number')
             pw = getpass.getpass('Input your password: ')
     
-        #encode as bytes
+        #make sure it can be encoded as bytes
         try:
-            salted_pw_bytes = (pw+salt).encode('utf-8')
+            pw.encode('utf-8')
         except Exception as e:
             print('Password cannot be utf-8 encoded. Try again.')
             print('Error message: ' + str(e))
@@ -42,7 +42,7 @@ one letter and one number.
         else:
             break
     
-    digest = hashlib.sha512(salted_pw_bytes).hexdigest()
+    digest = encode_password(pw, salt)
     
     print("""
 Successfully hashed password.
@@ -53,7 +53,7 @@ Successfully hashed password.
 ----Send these two values to your course instructor----
 -------------------------------------------------------
 Salt:         {salt}
-SHA512 Hash:  {digest}
+Hash:         {digest}
 -------------------------------------------------------
     """)
 
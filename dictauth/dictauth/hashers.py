@@ -0,0 +1,77 @@
+import hashlib
+import hmac
+import re
+
+class SHA512Hasher(object):
+    """
+    The original dictauth format: a bare hex SHA512 digest of password+salt.
+    Kept so that existing users can still log in.
+    """
+    name = 'sha512'
+    digest_regex = re.compile(r"^[a-f0-9]{128,}$")
+
+    def handles(self, digest):
+        return '$' not in digest
+
+    def is_valid(self, digest):
+        return bool(self.digest_regex.search(digest))
+
+    def encode(self, password, salt):
+        return hashlib.sha512((password+salt).encode('utf-8')).hexdigest()
+
+    def verify(self, password, salt, digest):
+        return hmac.compare_digest(self.encode(password, salt), digest)
+
+class ScryptHasher(object):
+    """
+    Memory-hard scrypt hashing. Digests are stored as scrypt$n$r$p$hexdigest, so the cost
+    parameters travel with each digest and can be raised later without breaking old entries.
+    """
+    name = 'scrypt'
+    digest_regex = re.compile(r"^scrypt\$[0-9]+\$[0-9]+\$[0-9]+\$[a-f0-9]{128,}$")
+
+    def __init__(self, n = 2**14, r = 8, p = 1, dklen = 64):
+        self.n = n
+        self.r = r
+        self.p = p
+        self.dklen = dklen
+
+    def handles(self, digest):
+        return digest.startswith(self.name + '$')
+
+    def is_valid(self, digest):
+        return bool(self.digest_regex.search(digest))
+
+    def _hash(self, password, salt, n, r, p, dklen):
+        #scrypt needs 128*n*r bytes of memory; give openssl some headroom above that
+        return hashlib.scrypt(password.encode('utf-8'), salt=bytes.fromhex(salt), n=n, r=r, p=p,
+                              maxmem=2*128*n*r*p + 1024*1024, dklen=dklen).hex()
+
+    def encode(self, password, salt):
+        dk = self._hash(password, salt, self.n, self.r, self.p, self.dklen)
+        return '$'.join([self.name, str(self.n), str(self.r), str(self.p), dk])
+
+    def verify(self, password, salt, digest):
+        _, n, r, p, dk = digest.split('$')
+        return hmac.compare_digest(self._hash(password, salt, int(n), int(r), int(p), len(dk)//2), dk)
+
+HASHERS = [ScryptHasher(), SHA512Hasher()]
+DEFAULT_HASHER = HASHERS[0]
+
+def get_hasher(digest):
+    for hasher in HASHERS:
+        if hasher.handles(digest):
+            return hasher
+    raise ValueError('No password hasher for digest ' + str(digest))
+
+def is_valid_digest(digest):
+    try:
+        return get_hasher(digest).is_valid(digest)
+    except ValueError:
+        return False
+
+def encode_password(password, salt):
+    return DEFAULT_HASHER.encode(password, salt)
+
+def verify_password(password, salt, digest):
+    return get_hasher(digest).verify(password, salt, digest)
@@ -1,10 +1,79 @@
 import os
-import sys
 from traitlets.config import Config
 from traitlets.config.loader import PyFileConfigLoader
 import re
+from .credential_store import CredentialStore, CREDENTIALS_FILENAME
+from .hashers import is_valid_digest
+
+class DictAuthError(Exception):
+    #raised for invalid user edits (bad salt/digest, duplicate/missing user, missing config); the dictauth CLI turns it
+    #into an error exit, while library callers (e.g. rudaux) can catch it like any other error
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+def credential_store_path(directory):
+    return os.path.join(directory, CREDENTIALS_FILENAME)
+
+#directory -> (jupyterhub_config.py stamp, credentials file the hub reads); the config is only re-executed when it changes
+_hub_credentials_files = {}
+#path -> CredentialStore, so repeated reads only stat the store file and reuse its cached contents
+_stores = {}
+
+def _config_path(directory):
+    path = os.path.join(directory, 'jupyterhub_config.py')
+    #check the config file exists
+    if not os.path.exists(path):
+        raise DictAuthError(
+             f"""
+             There is no jupyterhub_config.py in the specified directory ({directory}). 
+             Please specify a directory with a valid jupyterhub_config.py file. 
+             """
+           )
+    return path
+
+def _load_config(directory):
+    _config_path(directory)
+    #load the config
+    config = Config()
+    config.merge(PyFileConfigLoader('jupyterhub_config.py', path=directory).load_config())
+    return config
+
+def _credentials_file(config, directory):
+    path = config.DictionaryAuthenticator.get('credentials_file', '')
+    if not path:
+        return None
+    return os.path.join(directory, path)
+
+def _store(path):
+    if path not in _stores:
+        _stores[path] = CredentialStore(path)
+    return _stores[path]
+
+def hub_credentials_file(directory):
+    #the credential store the hub actually reads (c.DictionaryAuthenticator.credentials_file), or None if the hub
+    #still reads c.DictionaryAuthenticator.encrypted_passwords -- e.g. right after migrate_users, before the config is switched
+    #cached per directory until jupyterhub_config.py changes (same mtime/size/inode check as the credential store)
+    st = os.stat(_config_path(directory))
+    stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+    cached = _hub_credentials_files.get(directory)
+    if cached is None or cached[0] != stamp:
+        cached = (stamp, _credentials_file(_load_config(directory), directory))
+        _hub_credentials_files[directory] = cached
+    return cached[1]
+
+def uses_credential_store(directory):
+    #only users in whatever the hub reads can log in, so this follows the hub config rather than which files exist
+    return hub_credentials_file(directory) is not None
 
 def _save_dict(epwrds, directory):
+    store_path = hub_credentials_file(directory)
+    if store_path is not None:
+        _store(store_path).save(epwrds)
+        return
+    #migrated but the hub hasn't been switched over yet: keep the store in sync so no users are lost when it is
+    if os.path.exists(credential_store_path(directory)):
+        _store(credential_store_path(directory)).save(epwrds)
     #traitlets doesn't have a great way of writing PyFile configs back to disk, so we'll just do it manually
     with open(os.path.join(directory, 'jupyterhub_config.py'), 'r') as f:
         lines = f.readlines()
@@ -24,17 +93,11 @@ def _save_dict(epwrds, directory):
         f.writelines(lines)
 
 def _load_dict(directory):
-    #check the config file exists
-    if not os.path.exists(os.path.join(directory, 'jupyterhub_config.py')):
-        sys.exit(
-             f"""
-             There is no jupyterhub_config.py in the specified directory ({directory}). 
-             Please specify a directory with a valid jupyterhub_config.py file. 
-             """
-           )
-    #load the config
-    config = Config()
-    config.merge(PyFileConfigLoader('jupyterhub_config.py', path=directory).load_config())
+    #if the hub reads a credential store, read it directly (no need to exec jupyterhub_config.py)
+    store_path = hub_credentials_file(directory)
+    if store_path is not None:
+        return _store(store_path).users()
+    config = _load_config(directory)
     try:
         epwrds = config.DictionaryAuthenticator.encrypted_passwords
         if not isinstance(epwrds, dict):
@@ -45,47 +108,30 @@ def _load_dict(directory):
     return epwrds
 
 def get_users(args):
-    directory = args.directory
-    if not os.path.exists(os.path.join(directory, 'jupyterhub_config.py')):
-        sys.exit(
-             f"""
-             There is no jupyterhub_config.py in the specified directory ({directory}). 
-             Please specify a directory with a valid jupyterhub_config.py file. 
-             """
-           )
-    epwrds = _load_dict(directory)
+    epwrds = _load_dict(args.directory)
     return list(epwrds.keys())
 
 def list_users(args):
     print(get_users(args))
 
-#TODO prevent special chars in name
-def add_user(args):
-    username = args.username
-    salt = args.salt
-    digest = args.digest
-    directory = args.directory
-    user_creds_to_copy = args.copy_creds
-
-    epwrds = None
+def _add_to_dict(epwrds, username, salt, digest, user_creds_to_copy):
     if user_creds_to_copy is None:
         #validate the salt + digest
-        salt_digest_validator_regex = re.compile(r"^[a-f0-9]{128,}")
-        if (not salt_digest_validator_regex.search(salt)) or (not salt_digest_validator_regex.search(digest)):
-            sys.exit(
+        salt_validator_regex = re.compile(r"^[a-f0-9]{128,}")
+        if (not salt_validator_regex.search(salt)) or (not is_valid_digest(digest)):
+            raise DictAuthError(
                  f"""
                  The salt or digest is not valid.
-                 Both the salt and digest must be a 128-character long string with characters from a-f and 0-9.
+                 The salt must be a 128-character long string with characters from a-f and 0-9.
+                 The digest must be the output of dictauth encrypt_password (scrypt$...) or a 128-character SHA512 hex digest.
                  Salt: {salt}
                  Dgst: {digest}
                  """
                )
 
-        epwrds = _load_dict(directory)
-
         #if the user already exists (or if DictionaryAuthenticator.encrypted_passwords isn't in the file), error
         if epwrds.get(username):
-            sys.exit(
+            raise DictAuthError(
                  f"""
                  There is already a user named {username} in the dictionary. Please
                  remove them before creating a new user with this same username.  
@@ -93,16 +139,15 @@ def add_user(args):
                )
         epwrds[username] = {'salt' : salt, 'digest' : digest}
     else:
-        epwrds = _load_dict(directory)
         if not epwrds.get(user_creds_to_copy): 
-            sys.exit(
+            raise DictAuthError(
                 f"""
                 User {user_creds_to_copy} does not exist in the list of users.
                 Cannot copy credentials. User {username} not created.
                 """)
         #if the user already exists (or if DictionaryAuthenticator.encrypted_passwords isn't in the file), error
         if epwrds.get(username):
-            sys.exit(
+            raise DictAuthError(
                  f"""
                  There is already a user named {username} in the dictionary. Please
                  remove them before creating a new user with this same username.  
@@ -110,9 +155,20 @@ def add_user(args):
                )
         epwrds[username] = {'salt' : epwrds[user_creds_to_copy]['salt'], 'digest' : epwrds[user_creds_to_copy]['digest']}
 
-    _save_dict(epwrds, directory)
-        
-        
+#TODO prevent special chars in name
+def add_user(args):
+    epwrds = _load_dict(args.directory)
+    _add_to_dict(epwrds, args.username, args.salt, args.digest, getattr(args, 'copy_creds', None))
+    _save_dict(epwrds, args.directory)
+
+def add_users(args):
+    #add many users with a single load/save of the dictionary
+    #args.users is a list of dicts with keys username, salt, digest, copy_creds
+    #if any user is invalid, nothing is saved
+    epwrds = _load_dict(args.directory)
+    for user in args.users:
+        _add_to_dict(epwrds, user['username'], user.get('salt'), user.get('digest'), user.get('copy_creds'))
+    _save_dict(epwrds, args.directory)
 
 def remove_user(args):
     username = args.username
@@ -121,7 +177,7 @@ def remove_user(args):
     epwrds = _load_dict(directory)
     
     if not epwrds.get(username):
-        sys.exit(
+        raise DictAuthError(
              f"""
              There is no user named {username} in the dictionary.   
              """
@@ -148,7 +204,7 @@ def rename_user(args):
     #first make sure the user exists and extract the salt/digest
     epwrds = _load_dict(directory)
     if not epwrds.get(username):
-        sys.exit(
+        raise DictAuthError(
              f"""
              There is no user named {username} in the dictionary.   
              """
@@ -161,3 +217,23 @@ def rename_user(args):
     args.digest = tmp['digest']
     args.username = args.new_username
     add_user(args)
+
+
+def migrate_users(args):
+    #move the users out of jupyterhub_config.py and into a hot-reloadable credential store
+    directory = args.directory
+    store_path = os.path.abspath(credential_store_path(directory))
+    if uses_credential_store(directory) or os.path.exists(store_path):
+        raise DictAuthError(
+             f"""
+             There is already a credential store at {store_path}.
+             """
+           )
+    epwrds = _load_dict(directory)
+    CredentialStore(store_path).save(epwrds)
+    print(f"""
+Migrated {len(epwrds)} users to {store_path}.
+To finish, set the following in jupyterhub_config.py and restart your JupyterHub (one last time):
+c.DictionaryAuthenticator.credentials_file = '{store_path}'
+From now on, users added/removed with dictauth are picked up by the hub without a restart.
+    """)
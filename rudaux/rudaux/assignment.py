@@ -1,11 +1,25 @@
-class Assignment:
-
-    #TODO -- this has state now, so we need to make sure not overwritten by synchronize
-    def __init__(self, canvas_dict):
-        self.__dict__.update(canvas_dict)
-        self.snapshot_taken = False
-        self.override_snapshots_taken = []
-        self.grader_workloads = {}
+from .record import Record
+
+class Assignment(Record):
+
+    fields = {'canvas_id' : None, #str
+              'name' : None,
+              'due_at' : None, #pendulum datetimes (or None)
+              'lock_at' : None,
+              'unlock_at' : None,
+              'points_possible' : None,
+              'grading_type' : None,
+              'workflow_state' : None,
+              'has_overrides' : False,
+              'overrides' : [],
+              'published' : False,
+              'fingerprint' : None, #for delta canvas syncs
+              #TODO -- this has state now, so we need to make sure not overwritten by synchronize
+              'snapshot_taken' : False,
+              'override_snapshots_taken' : [],
+              'grader_workloads' : {}}
+    _caches = ('_override_index', '_override_index_key')
+    __slots__ = tuple(fields) + _caches
 
     def __repr__(self):
         return self.name + '(' + self.canvas_id + '): ' + ('jupyterhub' if self.is_jupyterhub_assignment else 'canvas') + ' assignment'
@@ -24,27 +38,36 @@ class Assignment:
     def grader_basename(self):
         return ''.join(ch for ch in self.name if ch.isalnum())+'-grader-'
 
+    #zfs snapshot name for the assignment (override None) or for one of its overrides
+    def snapshot_name(self, override = None):
+        return self.name if override is None else self.name + '-override-' + override['id']
+
+    def set_overrides(self, overrides):
+        self.overrides = overrides
+        self._override_index = None
+
+    def _get_override_index(self):
+        #student canvas id -> the override that sets their due date (the latest one, if it's later than the assignment's own due date)
+        #built lazily (it isn't pickled), and rebuilt if the overrides list was replaced or changed size
+        key = (id(self.overrides), len(self.overrides))
+        if self._override_index is None or self._override_index_key != key:
+            latest = {}
+            for over in self.overrides:
+                if over['due_at'] is None:
+                    continue
+                for sid in over['student_ids']:
+                    if sid not in latest or over['due_at'] > latest[sid]['due_at']:
+                        latest[sid] = over
+            self._override_index = {sid : over for sid, over in latest.items() if self.due_at is None or over['due_at'] > self.due_at}
+            self._override_index_key = key
+        return self._override_index
+
     def get_due_date(self, s):
-        basic_date = self.due_at
-
-        #get overrides for the student
-        overrides = [over for over in self.overrides if s.canvas_id in over['student_ids'] and (over['due_at'] is not None)]
-
-        #if there was no override, return the basic date
-        if len(overrides) == 0:
-            return basic_date, None
-
-        #if there was one, get the latest override date
-        latest_override = overrides[0]
-        for over in overrides:
-            if over['due_at'] > latest_override['due_at']:
-                latest_override = over
-        
-        #return the latest date between the basic and override dates
-        if latest_override['due_at'] > basic_date:
-            return latest_override['due_at'], latest_override
-        else:
-            return basic_date, None
+        #return the latest date between the basic and override dates, and the override it came from (if any)
+        override = self._get_override_index().get(s.canvas_id)
+        if override is None:
+            return self.due_at, None
+        return override['due_at'], override
 
         #self.all_submissions=[]
         #self.client = docker.from_env()
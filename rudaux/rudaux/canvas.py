@@ -1,6 +1,14 @@
-import requests
+import re
+import json
+import time
+import atexit
+import random
+import asyncio
+import aiohttp
+import threading
 import urllib.parse
 import pendulum as plm
+import terminaltables as ttbl
 from functools import lru_cache
 
 class CanvasGetError(Exception):
@@ -35,72 +43,290 @@ class GradeNotUploadedError(Exception):
         self.message = 'Grade on canvas not equal to the uploaded grade. Uploaded grade: ' + str(uploaded_val) + ' Canvas grade: ' + str(actual_val)
     
 
-class Canvas(object):
+class RateLimiter(object):
     """
-    Interface to the Canvas REST API
+    Client-side model of Canvas's per-token request quota (a leaky bucket on the server: every request costs some units,
+    in-flight requests are charged a flat amount up front, and the bucket refills over time; an empty bucket gets a 403).
+    Each response reports the bucket level (X-Rate-Limit-Remaining) and what the request cost (X-Request-Cost);
+    new requests only start while the estimated cost of everything in flight, plus a reserve, fits in the bucket,
+    and a throttled response pauses everyone for a while. Only used from the client's event loop, so needs no locking.
     """
 
-    def __init__(self, config, dry_run):
-        self.group_url = urllib.parse.urljoin(config.canvas_domain, 'api/v1/groups/')
-        self.base_url = urllib.parse.urljoin(config.canvas_domain, 'api/v1/courses/'+config.canvas_id+'/')
-        self.token = config.canvas_token
-        self.jupyterhub_host_root = config.jupyterhub_host_root
-        self.dry_run = dry_run
+    preflight_cost = 50
+    refill_rate = 10.
+
+    def __init__(self, max_concurrency = 4, reserve = 100):
+        self.max_concurrency = max_concurrency
+        self.reserve = reserve
+        #unknown until the first response comes back (only one request goes out until then); Canvas's default quota is 700
+        self.remaining = 700.
+        self.capacity = 700.
+        self.measured = False
+        self.updated = time.monotonic()
+        self.cost_estimate = 1.
+        self.in_flight = 0
+        self.paused_until = 0.
+        #set (and replaced) whenever a request finishes, to wake up waiting requests
+        self.released = None
+
+    def _level(self):
+        return min(self.capacity, self.remaining + self.refill_rate*(time.monotonic() - self.updated))
+
+    def _try_acquire(self):
+        #None if the request can go now, otherwise how long to wait before checking again
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        level = self._level()
+        if self.in_flight == 0:
+            #a lone request only needs the bucket to cover itself (and goes regardless until we've had a reading)
+            needed = self.preflight_cost + self.cost_estimate
+            if not self.measured or level >= needed:
+                self.in_flight += 1
+                return None
+            return (needed - level)/self.refill_rate
+        if self.in_flight < self.max_concurrency and self.measured:
+            #concurrent requests also have to leave the reserve untouched
+            needed = (self.in_flight + 1)*(self.preflight_cost + self.cost_estimate) + self.reserve
+            if level >= needed:
+                self.in_flight += 1
+                return None
+        #wait for a request to finish (or for the bucket to refill enough for one more)
+        return (self.preflight_cost + self.cost_estimate)/self.refill_rate
+
+    async def acquire(self):
+        while True:
+            wait = self._try_acquire()
+            if wait is None:
+                return
+            if self.released is None:
+                self.released = asyncio.Event()
+            try:
+                await asyncio.wait_for(self.released.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, resp = None):
+        self.in_flight -= 1
+        if self.released is not None:
+            self.released.set()
+            self.released = None
+        if resp is not None:
+            remaining = resp.headers.get('X-Rate-Limit-Remaining')
+            cost = resp.headers.get('X-Request-Cost')
+            if remaining is not None:
+                self.remaining = float(remaining)
+                self.capacity = max(self.capacity, self.remaining)
+                self.measured = True
+                self.updated = time.monotonic()
+            if cost is not None:
+                self.cost_estimate = 0.8*self.cost_estimate + 0.2*float(cost)
+
+    def throttled(self, delay):
+        self.remaining = 0.
+        self.updated = time.monotonic()
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+class CanvasResponse(object):
+    """
+    What we keep of a Canvas response once its body has been read (so that the connection can go back to the pool)
+    """
 
-    #cache subsequent calls to avoid slow repeated access to canvas api
-    #@lru_cache(maxsize=None) TODO -- be careful, e.g., get_overrides overwrites the dict return, which is cached
-    #so when you call get again it breaks things
-    #disabling the cache for now. In the future should call cache_clear() when certain get functions are called.
-    #also sometimes we need to force no cache when synchronizing (after various updates)
-    def get(self, path_suffix, use_group_base=False):
-        if use_group_base:
-            url = urllib.parse.urljoin(self.group_url, path_suffix)
-        else:
-            url = urllib.parse.urljoin(self.base_url, path_suffix)
+    def __init__(self, status_code, reason, headers, links, text):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.links = links
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+class AsyncCanvas(object):
+    """
+    asyncio Canvas REST client: one aiohttp session (so connections are reused across requests), with concurrency
+    bounded by the rate limiter and the connection pool. Throttled requests are retried with backoff, as are 5xx errors
+    and connection failures except on POSTs (those aren't idempotent: a failed create may still have gone through).
+    Keeps per-endpoint request counts and latency.
+    """
+
+    backoff_base = 2
+    backoff_cap = 60
+
+    def __init__(self, token, max_concurrency = 4, max_tries = 5, rate_limit_reserve = 100):
+        self.token = token
+        self.max_concurrency = max_concurrency
+        self.max_tries = max_tries
+        self.limiter = RateLimiter(max_concurrency, rate_limit_reserve)
+        self.session = None
+        #endpoint (url path with ids replaced by :id) -> request counts / latency
+        self.stats = {}
+
+    def _session(self):
+        #created on first use, inside the event loop that will use it
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = self.max_concurrency),
+                                                 headers = {'Authorization': f'Bearer {self.token}',
+                                                            'Accept': 'application/json'})
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _endpoint(self, method, url):
+        return method.upper() + ' ' + re.sub(r'/\d+(?=/|$)', '/:id', urllib.parse.urlparse(url).path)
+
+    def _record(self, endpoint, elapsed, resp, retried):
+        st = self.stats.setdefault(endpoint, {'requests' : 0, 'errors' : 0, 'retries' : 0, 'time' : 0., 'max_time' : 0., 'cost' : 0.})
+        st['requests'] += 1
+        st['time'] += elapsed
+        st['max_time'] = max(st['max_time'], elapsed)
+        if retried:
+            st['retries'] += 1
+        if resp is None or resp.status_code < 200 or resp.status_code > 299:
+            st['errors'] += 1
+        if resp is not None and resp.headers.get('X-Request-Cost') is not None:
+            st['cost'] += float(resp.headers.get('X-Request-Cost'))
+
+    def _is_throttled(self, resp):
+        return resp.status_code == 429 or (resp.status_code == 403 and 'Rate Limit Exceeded' in resp.text)
+
+    def _backoff(self, attempt):
+        return min(self.backoff_cap, self.backoff_base*2**attempt)*random.uniform(0.5, 1)
+
+    async def _send(self, method, url, params, json_data):
+        async with self._session().request(method, url, params = params, json = json_data) as resp:
+            text = await resp.text()
+            links = {rel : {'url' : str(link['url'])} for rel, link in resp.links.items()}
+            return CanvasResponse(resp.status, resp.reason, resp.headers, links, text)
+
+    async def request(self, method, url, params = None, json_data = None):
+        endpoint = self._endpoint(method, url)
+        for attempt in range(self.max_tries):
+            await self.limiter.acquire()
+            resp = None
+            start = time.monotonic()
+            try:
+                resp = await self._send(method, url, params, json_data)
+            except aiohttp.ClientConnectionError as e:
+                if method == 'post' or attempt == self.max_tries - 1:
+                    raise
+                print('Canvas connection error on ' + endpoint + ': ' + str(e))
+            finally:
+                self.limiter.release(resp)
+            last = (attempt == self.max_tries - 1)
+            if resp is not None and self._is_throttled(resp):
+                delay = float(resp.headers.get('Retry-After', 0)) or self._backoff(attempt)
+                self.limiter.throttled(delay)
+                retry = not last
+            else:
+                retry = not last and (resp is None or (resp.status_code >= 500 and method != 'post'))
+                delay = self._backoff(attempt)
+            self._record(endpoint, time.monotonic() - start, resp, retry)
+            if not retry:
+                return resp
+            print('Canvas request ' + endpoint + ' failed (' + (str(resp.status_code) if resp is not None else 'no response')
+                  + '); retrying in ' + str(round(delay, 1)) + ' seconds')
+            await asyncio.sleep(delay)
+
+    async def get(self, url, params = None):
+        #all pages of a GET; pages have to be fetched in order (each one links to the next, with the query included)
+        params = [('override_assignment_dates', 'false')] + (params if params is not None else [])
         resp = None
         resp_items = []
         #see https://community.canvaslms.com/t5/Question-Forum/Why-is-the-Assignment-due-at-value-that-of-the-last-override/m-p/209593
         #for why we have to set override_assignment_dates = false below -- basically due_at below gets set really weirdly if
         #the assignment has overrides unless you include this param
         while resp is None or 'next' in resp.links.keys():
-            resp = requests.get(
-                url = url if resp is None else resp.links['next']['url'],
-                headers = {
-                    'Authorization': f'Bearer {self.token}',
-                    'Accept': 'application/json'
-                    },
-                json = {'per_page' : 100},
-                params = {'override_assignment_dates' : False}
-            )
+            resp = await self.request('get', url if resp is None else resp.links['next']['url'],
+                                      params = params if resp is None else None,
+                                      json_data = {'per_page' : 100})
 
             if resp.status_code < 200 or resp.status_code > 299:
                 raise CanvasGetError(url, resp)
 
             json_data = resp.json()
             if isinstance(json_data, list):
-                resp_items.extend(resp.json())
+                resp_items.extend(json_data)
             else:
-                resp_items.append(resp.json())
+                resp_items.append(json_data)
 
         return resp_items
 
+    async def get_many(self, urls, params = None):
+        return await asyncio.gather(*[self.get(url, params[i] if params is not None else None) for i, url in enumerate(urls)])
+
+    async def upload(self, url, json_data, typ):
+        resp = await self.request(typ, url, json_data = json_data)
+        if resp.status_code < 200 or resp.status_code > 299:
+            print('Canvas Upload Error: ' + str(resp.reason))
+            raise CanvasUploadError(url, resp, typ)
+
+    def request_report(self):
+        tbl = [['Endpoint', 'Requests', 'Errors', 'Retries', 'Mean (s)', 'Max (s)', 'Cost']]
+        for endpoint, st in sorted(list(self.stats.items())):
+            tbl.append([endpoint, st['requests'], st['errors'], st['retries'], round(st['time']/st['requests'], 2),
+                        round(st['max_time'], 2), round(st['cost'], 1)])
+        return ttbl.AsciiTable(tbl, 'Canvas Requests').table
+
+class Canvas(object):
+    """
+    Interface to the Canvas REST API
+
+    A synchronous facade over AsyncCanvas: requests run on an event loop in a background thread (shared by every
+    thread using this object), and the fetches that fan out over many urls (overrides, group memberships,
+    submissions) send them concurrently.
+    """
+
+    def __init__(self, config, dry_run):
+        self.group_url = urllib.parse.urljoin(config.canvas_domain, 'api/v1/groups/')
+        self.base_url = urllib.parse.urljoin(config.canvas_domain, 'api/v1/courses/'+config.canvas_id+'/')
+        self.jupyterhub_host_root = config.jupyterhub_host_root
+        self.dry_run = dry_run
+        self.client = AsyncCanvas(config.canvas_token, config.canvas_max_concurrency, config.canvas_max_tries, config.canvas_rate_limit_reserve)
+        self.loop = None
+        self.loop_lock = threading.Lock()
+
+    def _run(self, coro):
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target = self.loop.run_forever, name = 'rudaux-canvas', daemon = True).start()
+                atexit.register(self.close)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def close(self):
+        with self.loop_lock:
+            if self.loop is not None:
+                asyncio.run_coroutine_threadsafe(self.client.close(), self.loop).result()
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.loop = None
+
+    def _url(self, path_suffix, use_group_base=False):
+        return urllib.parse.urljoin(self.group_url if use_group_base else self.base_url, path_suffix)
+
+    def request_report(self):
+        return self.client.request_report()
+
+    #cache subsequent calls to avoid slow repeated access to canvas api
+    #@lru_cache(maxsize=None) TODO -- be careful, e.g., get_overrides overwrites the dict return, which is cached
+    #so when you call get again it breaks things
+    #disabling the cache for now. In the future should call cache_clear() when certain get functions are called.
+    #also sometimes we need to force no cache when synchronizing (after various updates)
+    def get(self, path_suffix, use_group_base=False, params=None):
+        #params: extra query parameters, as a list of (key, value) (so keys like 'assignment_ids[]' can repeat)
+        return self._run(self.client.get(self._url(path_suffix, use_group_base), params))
+
+    def get_many(self, path_suffixes, use_group_base=False, params=None):
+        #several GETs at once (params, if given, has the extra query parameters for each); returns their results in the same order
+        return self._run(self.client.get_many([self._url(ps, use_group_base) for ps in path_suffixes], params))
+
     def upload(self, path_suffix, json_data, typ):
-        rfuncs = {'put' : requests.put,
-                 'post': requests.post,
-                 'delete': requests.delete}
-        url = urllib.parse.urljoin(self.base_url, path_suffix)
+        url = self._url(path_suffix)
         if not self.dry_run:
-            resp = rfuncs[typ](
-                url = url,
-                headers = {
-                    'Authorization': f'Bearer {self.token}',
-                    'Accept': 'application/json'
-                    },
-                json=json_data
-            )
-            if resp.status_code < 200 or resp.status_code > 299:
-                print('Canvas Upload Error: ' + str(resp.reason))
-                raise CanvasUploadError(url, resp, typ)
+            self._run(self.client.upload(url, json_data, typ))
         else:
             print('[Dry Run: would have made a ' + typ + ' request with URL: ' + url + ']')
         return
@@ -118,8 +344,8 @@ class Canvas(object):
     def get_course_info(self):
         return self.get('')[0]
 
-    def _get_people_by_type(self, typ):
-        people = self.get('enrollments')
+    def _get_people_by_type(self, typ, people = None):
+        people = people if people is not None else self.get('enrollments')
         ppl_typ = [p for p in people if p['type'] == typ]
         return [ { 'name' : p['user']['name'],
                    'sortable_name' : p['user']['sortable_name'],
@@ -132,6 +358,11 @@ class Canvas(object):
                   } for p in ppl_typ
                ] 
 
+    def get_people(self):
+        #students, fake students, instructors and TAs from one enrollments listing (rather than one listing each)
+        people = self.get('enrollments')
+        return {typ : self._get_people_by_type(typ, people) for typ in ['StudentEnrollment', 'StudentViewEnrollment', 'TeacherEnrollment', 'TaEnrollment']}
+
     def get_students(self):
         return self._get_people_by_type('StudentEnrollment')
   
@@ -144,16 +375,38 @@ class Canvas(object):
     def get_tas(self):
         return self._get_people_by_type('TaEnrollment')
 
-    def get_groups(self):
-        grps = self.get('groups')
-        return [{
+    def _stale(self, items, known):
+        #canvas has no updated_since filter for assignments/groups, so for delta syncs we compare a fingerprint of each
+        #one against an earlier sync (known = {canvas id : (fingerprint, data)}); items without a fingerprint are always stale
+        if known is None:
+            return items
+        return [it for it in items if it['fingerprint'] is None or known.get(it['canvas_id'], (None, None))[0] != it['fingerprint']]
+
+    def get_groups(self, known = None):
+        #known: {group id : (fingerprint, members)} from an earlier sync; groups whose member count hasn't changed keep those
+        #members rather than refetching them
+        grps = [{
                  'name' : g['name'],
                  'canvas_id' : str(g['id']),
-                 'members' : [str(m['user_id']) for m in self.get(str(g['id'])+'/memberships', use_group_base=True)]
-                } for g in grps]
-
-
-    def get_assignments(self):
+                 'fingerprint' : None if g.get('members_count') is None else str(g['members_count']),
+                 'members' : None
+                } for g in self.get('groups')]
+        stale = self._stale(grps, known)
+        if known is not None:
+            print('Fetching memberships for ' + str(len(stale)) + ' of ' + str(len(grps)) + ' groups (the rest are unchanged)')
+            stale_ids = set([g['canvas_id'] for g in stale])
+            for g in grps:
+                if g['canvas_id'] not in stale_ids:
+                    g['members'] = known[g['canvas_id']][1]
+        for g, members in zip(stale, self.get_many([g['canvas_id']+'/memberships' for g in stale], use_group_base=True)):
+            g['members'] = [str(m['user_id']) for m in members]
+        return grps
+
+
+    def get_assignments(self, known = None):
+        #known: {assignment id : (fingerprint, overrides)} from an earlier sync; assignments that haven't been updated since
+        #(same updated_at and has_overrides) keep those overrides rather than refetching them. Anything this misses is
+        #picked up by the next full sync
         asgns = self.get('assignments')
         processed_asgns = [ {  
                    'canvas_id' : str(a['id']),
@@ -166,19 +419,43 @@ class Canvas(object):
                    'workflow_state' : a['workflow_state'],
                    'has_overrides' : a['has_overrides'],
                    'overrides' : [],
-                   'published' : a['published']
+                   'published' : a['published'],
+                   'fingerprint' : None if a.get('updated_at') is None else a['updated_at'] + ('/overrides' if a['has_overrides'] else '')
                  } for a in asgns if 'external_tool_tag_attributes' in a.keys() and self.jupyterhub_host_root in a['external_tool_tag_attributes']['url'] and a['omit_from_final_grade'] == False]
-        for a in processed_asgns:
-            if a['has_overrides']:
-                a['overrides'] = self.get_overrides(a['canvas_id'])
+        with_overrides = [a for a in processed_asgns if a['has_overrides']]
+        stale = self._stale(with_overrides, known)
+        if known is not None:
+            print('Fetching overrides for ' + str(len(stale)) + ' of ' + str(len(with_overrides)) + ' assignments with overrides (the rest are unchanged)')
+            stale_ids = set([a['canvas_id'] for a in stale])
+            for a in with_overrides:
+                if a['canvas_id'] not in stale_ids:
+                    a['overrides'] = known[a['canvas_id']][1]
+        for a, overs in zip(stale, self.get_many(['assignments/'+a['canvas_id']+'/overrides' for a in stale])):
+            a['overrides'] = self._process_overrides(overs)
 
         return processed_asgns
 
     def get_submissions(self, assignment_id):
-        subms = self.get('assignments/'+assignment_id+'/submissions')
+        return self._process_submissions(self.get('assignments/'+assignment_id+'/submissions'))
+
+    def get_course_submissions(self, assignment_ids, chunk_size = 50):
+        #every student's submission for all of the given assignments, indexed by (assignment id, student id), from the
+        #course-level submissions endpoint rather than one listing per assignment. The assignments are split over a few
+        #paginated streams (at most chunk_size assignments each, to keep the urls short) that are fetched concurrently,
+        #since the pages of any one stream have to be fetched one after another
+        n_streams = min(len(assignment_ids), max(-(-len(assignment_ids) // chunk_size), self.client.max_concurrency))
+        chunks = [assignment_ids[i::n_streams] for i in range(n_streams)]
+        params = [[('student_ids[]', 'all')] + [('assignment_ids[]', aid) for aid in chunk] for chunk in chunks]
+        index = {}
+        for subms in self.get_many(['students/submissions']*len(chunks), params=params):
+            for subm in self._process_submissions(subms):
+                index[(subm['assignment_id'], subm['student_id'])] = subm
+        return index
+
+    def _process_submissions(self, subms):
         return [ {
                        'student_id' : str(subm['user_id']), 
-                       'assignment_id' : assignment_id,
+                       'assignment_id' : str(subm['assignment_id']),
                        'grade' : subm['grade'],
                        'score' : subm['score'],
                        'workflow_state' : subm['workflow_state'],
@@ -193,7 +470,9 @@ class Canvas(object):
                 } for subm in subms ]
 
     def get_overrides(self, assignment_id):
-        overs = self.get('assignments/'+assignment_id+'/overrides')
+        return self._process_overrides(self.get('assignments/'+assignment_id+'/overrides'))
+
+    def _process_overrides(self, overs):
         for over in overs:
             over['id'] = str(over['id'])
             over['student_ids'] = list(map(str, over['student_ids']))
@@ -204,7 +483,7 @@ class Canvas(object):
                     over[key] = None
         return overs
 
-    def create_override(self, assignment_id, override_dict):
+    def _validate_override(self, override_dict):
         #check all required keys
         required_keys = ['student_ids', 'unlock_at', 'due_at', 'lock_at', 'title']
         for rk in required_keys:
@@ -217,6 +496,10 @@ class Canvas(object):
         #convert dates to canvas date time strings in the course local timezone
         for dk in ['unlock_at', 'due_at', 'lock_at']:
             override_dict[dk] = str(override_dict[dk])
+        return override_dict
+
+    def create_override(self, assignment_id, override_dict):
+        self._validate_override(override_dict)
 
         #post the override
         post_json = {'assignment_override' : override_dict}
@@ -229,6 +512,31 @@ class Canvas(object):
             if n_match != 1:
                 raise OverrideUploadError(overs, override_dict)    
 
+    def apply_overrides(self, to_remove, to_create, chunk_size = 50):
+        #batch version of remove_override/create_override: to_remove is a list of (assignment id, override id),
+        #to_create a list of (assignment id, override dict). Canvas has no batch delete, so removals are individual DELETEs;
+        #creations go through the batch endpoint (in chunks; each chunk is created all-or-nothing).
+        #instead of re-listing after every request, each touched assignment's overrides are listed once at the end
+        #to verify; returns {assignment id : overrides} with those listings (empty in a dry run)
+        to_create = [(aid, self._validate_override(dict(od))) for aid, od in to_create]
+        for aid, oid in to_remove:
+            self.delete('assignments/'+aid+'/overrides/'+oid)
+        for i in range(0, len(to_create), chunk_size):
+            chunk = [dict(od, assignment_id = int(aid)) for aid, od in to_create[i:i+chunk_size]]
+            self.post('assignments/overrides', {'assignment_overrides' : chunk})
+
+        if self.dry_run:
+            return {}
+        aids = sorted(set([aid for aid, _ in to_remove] + [aid for aid, _ in to_create]))
+        listings = {aid : self._process_overrides(overs) for aid, overs in zip(aids, self.get_many(['assignments/'+aid+'/overrides' for aid in aids]))}
+        for aid, oid in to_remove:
+            if len([over for over in listings[aid] if over['id'] == oid]) != 0:
+                raise OverrideRemoveError(listings[aid], oid)
+        for aid, od in to_create:
+            if len([over for over in listings[aid] if over['title'] == od['title']]) != 1:
+                raise OverrideUploadError(listings[aid], od)
+        return listings
+
     def remove_override(self, assignment_id, override_id):
         self.delete('assignments/'+assignment_id+'/overrides/'+override_id)
 
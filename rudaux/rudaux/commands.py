@@ -1,34 +1,140 @@
 import os
+import functools
+import pendulum as plm
 import rudaux
+from rudaux.coordinator import RunCoordinator
+from rudaux.daemon import Daemon, DaemonError, send_command
 import terminaltables as ttbl
 
+def coordinated(command):
+    #take the command's run lock (waiting or skipping per lock_policy) and record the run in the run history
+    #dry runs (and status printouts) don't change anything, so they don't take the lock
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(args):
+            config = rudaux.course.load_config(args.directory)
+            if args.dry_run or getattr(args, 'status', False):
+                return func(args, config)
+            with RunCoordinator(config, args.directory).run(command) as go:
+                if go:
+                    return func(args, config)
+        return wrapper
+    return decorator
+
 # this is the only command that gets called on the student hub (for now)
 # it should be called every X minutes using a cron job (X = 15, say, if you want your snapshots to have a max resolution of 15 mins)
 # snapshots will only happen once per assignment (and once per override), so even if you set X = 1, it'll just make this command run a bunch without
 # actually doing anything. The only cost is that it has to run this code every minute, which is probably too much. Most assignments are due
 # on the hour / half hour at most, so every 15 should almost always be fine.
-def snapshot(args):
-    course = rudaux.Course(args.directory, dry_run = args.dry_run)
+@coordinated('snapshot')
+def snapshot(args, config):
+    #runs every few minutes and only needs due dates, so only refetch the overrides/groups that changed since the last run
+    course = rudaux.Course(args.directory, dry_run = args.dry_run, config = config, full_sync = False)
     # if course setup fails, do ???
     # do a non-blocking update: 
     # if update fails (e.g. canvas is down), just take snapshots based on previous course obj. Snapshots are cheap and we may as well be conservative
     course.take_snapshots()
-  
-    #TODO snapshots run every 30m, too many emails. 
-    #see todo below about digest messages
-    #course.send_notifications()
+    #notifications are queued on disk; they get sent (as digests) by the notify command
     
 
-def run(args):
-    course = rudaux.Course(args.directory, dry_run = args.dry_run)
+@coordinated('run')
+def run(args, config):
+    course = rudaux.Course(args.directory, dry_run = args.dry_run, config = config)
     # if course setup fails, do ???
     # do a non-blocking update: 
     # if update fails (e.g. canvas is down), just take snapshots based on previous course obj. Snapshots are cheap and we may as well be conservative
     course.grading_workflow()
+    print(course.canvas.request_report())
+
+@coordinated('notify')
+def notify(args, config):
+    #only needs the config and the outbox, so don't bother synchronizing with canvas/docker/etc
+    notifier = config.notification_type(config, args.dry_run, args.directory)
+    if args.status:
+        tbl = [['Recipient', 'Status', 'Messages', 'Last Error']] + [list(row) for row in notifier.status()]
+        print(ttbl.AsciiTable(tbl, 'Notifications').table)
+        return
+    print('Sending queued notifications')
+    notifier.connect()
+    try:
+        notifier.notify_all()
+    finally:
+        notifier.close()
+
+def stats(args):
+    #only needs the config and the docker job history
+    config = rudaux.course.load_config(args.directory)
+    history = rudaux.history.JobHistory(os.path.join(config.docker_state_dir, config.name + '_docker_history.db'))
+    summary = history.summary()
+    if len(summary) == 0:
+        print('No docker jobs recorded yet in ' + history.path)
+        return
+    n_cores, total_memory = rudaux.history.host_resources()
+    rec_memory, rec_threads = rudaux.history.recommend_settings(summary, n_cores, total_memory)
+
+    tbl = [['Assignment', 'Job Type', 'Jobs', 'Failed', 'OOM Killed', 'Mean (s)', 'P90 (s)', 'Max (s)', 'Peak Memory',
+            'Batch Size', 'Predicted (current)', 'Predicted (recommended)']]
+    for s in summary:
+        #without --jobs, assume the next batch looks like the past ones (one job per student per assignment)
+        n_jobs = args.jobs if args.jobs else s['n_jobs']
+        tbl.append([s['assignment'], s['job_type'], s['n_jobs'], s['n_failed'], s['n_oom'],
+                    round(s['mean_duration'], 1), round(s['p90_duration'], 1), round(s['max_duration'], 1),
+                    rudaux.history.format_memory(s['peak_memory']) if s['peak_memory'] is not None else '-',
+                    n_jobs,
+                    _format_duration(rudaux.history.predict_makespan(n_jobs, s['mean_duration'], s['max_duration'], config.num_docker_threads)),
+                    _format_duration(rudaux.history.predict_makespan(n_jobs, s['mean_duration'], s['max_duration'], rec_threads))])
+    print(ttbl.AsciiTable(tbl, 'Docker Job History').table)
+
+    tbl = [['Setting', 'Current', 'Recommended'],
+           ['num_docker_threads', config.num_docker_threads, rec_threads],
+           ['docker_memory', config.docker_memory, rec_memory if rec_memory is not None else '-']]
+    print(ttbl.AsciiTable(tbl, 'Host: ' + str(n_cores) + ' cores, ' + rudaux.history.format_memory(total_memory) + ' RAM').table)
+
+def _format_duration(seconds):
+    return str(int(seconds // 3600)) + 'h' + str(int(seconds % 3600 // 60)).zfill(2) + 'm' + str(int(seconds % 60)).zfill(2) + 's'
+
+def daemon(args):
+    #runs until stopped (SIGTERM/SIGINT or `rudaux ctl stop`); replaces the cron jobs
+    try:
+        Daemon(args.directory, dry_run = args.dry_run).run_forever()
+    except DaemonError as e:
+        print(e.message)
+
+def ctl(args):
+    config = rudaux.course.load_config(args.directory)
+    try:
+        response = send_command(config.daemon_socket, args.action)
+    except DaemonError as e:
+        print(e.message)
+        return
+    if not response['ok']:
+        print('Error: ' + response['error'])
+    elif args.action == 'status':
+        status = response['status']
+        print('rudaux daemon (pid ' + str(status['pid']) + ') is ' + ('running ' + ', '.join(status['current_tasks']) if len(status['current_tasks']) > 0 else 'idle'))
+        print(ttbl.AsciiTable([['Task', 'Last Run']] + [[t, w] for t, w in sorted(status['last_runs'].items())], 'Last Runs').table)
+        print(ttbl.AsciiTable([['Task', 'Scheduled For']] + status['upcoming'], 'Upcoming').table)
+    elif args.action == 'stop':
+        print('rudaux daemon stopping (after its current task)')
+    else:
+        print('Queued ' + response['queued'])
 
-# TODO implement a send notification command
-# and have smtp.submit save notifications to disk
-# so that the user can control how often their messages are sent (digest)
+def runs(args):
+    #current lock holders and recent runs of the cron-driven commands
+    config = rudaux.course.load_config(args.directory)
+    coord = RunCoordinator(config, args.directory)
+    tbl = [['Lock Group', 'Held By', 'Since']]
+    for group, holder in coord.holders().items():
+        if holder is None:
+            tbl.append([group, '-', '-'])
+        else:
+            tbl.append([group, coord.describe(holder), str(plm.from_timestamp(holder['started_at']).in_timezone('local'))])
+    print(ttbl.AsciiTable(tbl, 'Run Locks').table)
+    tbl = [['Command', 'Lock Group', 'PID', 'Started', 'Duration', 'Outcome']]
+    for command, group, pid, started_at, duration, outcome, error in coord.history.recent(args.n):
+        tbl.append([command, group, pid, str(plm.from_timestamp(started_at).in_timezone('local')),
+                    _format_duration(duration) if duration is not None else '-', outcome])
+    print(ttbl.AsciiTable(tbl, 'Recent Runs').table)
 
 def print_list(args):
     course = rudaux.Course(args.directory)
@@ -45,15 +151,16 @@ def print_list(args):
                 tbl = []
             print(ttbl.AsciiTable(tbl, title).table)
 
-def apply_latereg_extensions(args):
-    course = rudaux.Course(args.directory, dry_run = args.dry_run)
+@coordinated('extend_lateregs')
+def apply_latereg_extensions(args, config):
+    course = rudaux.Course(args.directory, dry_run = args.dry_run, config = config)
     course.apply_latereg_extensions()
 
 #Ideas for other commands:
 #status #return a report of status; subcommands:
 ##assignment (graded / feedback / solutions / etc)
 ##snapshot schedule 
-##hard drive / memory usage? 
+##hard drive / memory usage? (docker job runtimes/memory are covered by the stats command)
 ##errors in assignment grading
 #
 #schedule_tasks #creates a schedule of commands that run automatically
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import fcntl
+import socket
+import sqlite3
+import traceback
+from contextlib import contextmanager
+from .jobstore import pid_alive
+
+#commands that must not overlap share a lock group
+LOCK_GROUPS = {'snapshot' : 'snapshot',
+               'run' : 'grading',
+               'extend_lateregs' : 'grading',
+               'notify' : 'notify'}
+
+class RunLock(object):
+    """
+    Exclusive flock on a file in the course directory, with the holder's pid/command/start time written into it.
+    The kernel drops a flock when its holder dies, so a crashed run never leaves the lock held; a lock whose recorded
+    holder is dead but is somehow still held (e.g. the fd leaked into a child process) is treated as stale and broken.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def holder(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def try_acquire(self, command, break_stale = True):
+        #returns True if we now hold the lock
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            holder = self.holder()
+            if break_stale and holder is not None and not pid_alive(holder['pid']):
+                print('Breaking stale ' + os.path.basename(self.path) + ' held by dead process ' + str(holder['pid']) + ' (' + holder['command'] + ')')
+                try:
+                    os.remove(self.path)
+                except FileNotFoundError:
+                    pass
+                return self.try_acquire(command, break_stale = False)
+            return False
+        #someone may have broken (unlinked) the lock file between our open and flock; then we locked a dead inode
+        try:
+            if os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                os.close(fd)
+                return False
+        except FileNotFoundError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, json.dumps({'pid' : os.getpid(), 'host' : socket.gethostname(), 'command' : command, 'started_at' : time.time()}).encode('utf-8'))
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            os.ftruncate(self.fd, 0)
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+class RunHistory(object):
+    """
+    sqlite log of every rudaux command run through the coordinator: when it started, how long it took, and how it ended.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._db() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS runs (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            command TEXT,
+                            lock_group TEXT,
+                            pid INTEGER,
+                            started_at REAL,
+                            duration REAL,
+                            outcome TEXT,
+                            error TEXT)""")
+
+    @contextmanager
+    def _db(self):
+        conn = sqlite3.connect(self.path, timeout = 60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def start(self, command, group):
+        with self._db() as db:
+            return db.execute("INSERT INTO runs (command, lock_group, pid, started_at, outcome) VALUES (?, ?, ?, ?, 'running')",
+                              (command, group, os.getpid(), time.time())).lastrowid
+
+    def finish(self, run_id, outcome, error = None):
+        with self._db() as db:
+            db.execute("UPDATE runs SET duration = ? - started_at, outcome = ?, error = ? WHERE id = ?", (time.time(), outcome, error, run_id))
+
+    def skipped(self, command, group, reason):
+        with self._db() as db:
+            db.execute("INSERT INTO runs (command, lock_group, pid, started_at, duration, outcome, error) VALUES (?, ?, ?, ?, 0, 'skipped', ?)",
+                       (command, group, os.getpid(), time.time(), reason))
+
+    def recent(self, n = 20):
+        with self._db() as db:
+            return db.execute("SELECT command, lock_group, pid, started_at, duration, outcome, error FROM runs ORDER BY id DESC LIMIT ?", (n,)).fetchall()
+
+class RunCoordinator(object):
+    """
+    Keeps cron-driven rudaux commands from overlapping. Each command takes its lock group's lock for the duration
+    of the run; if the lock is busy, the group's policy decides whether to wait for it ('queue', up to
+    lock_wait_minutes) or to give up right away ('skip'). Every run (or skip) is recorded in the run history.
+    """
+
+    poll_every = 10
+
+    def __init__(self, config, course_dir):
+        self.course_dir = course_dir
+        self.policies = config.lock_policy
+        self.wait_minutes = config.lock_wait_minutes
+        self.max_hours = config.lock_max_hours
+        self.history = RunHistory(os.path.join(course_dir, config.name + '_run_history.db'))
+
+    def lock_path(self, group):
+        return os.path.join(self.course_dir, '.rudaux_' + group + '.lock')
+
+    def holders(self):
+        #current holder (or None) of each lock group's lock
+        return {group : RunLock(self.lock_path(group)).holder() for group in sorted(set(LOCK_GROUPS.values()))}
+
+    def describe(self, holder):
+        if holder is None:
+            return 'another process'
+        age = (time.time() - holder['started_at'])/3600.
+        desc = 'process ' + str(holder['pid']) + ' (' + holder['command'] + ', running for ' + str(round(age, 2)) + ' hours)'
+        if age > self.max_hours:
+            desc += ' -- WARNING: this is longer than lock_max_hours, it may be hung'
+        return desc
+
+    @contextmanager
+    def run(self, command):
+        #yields True if the command should go ahead, False if it was skipped
+        group = LOCK_GROUPS.get(command, command)
+        policy = self.policies.get(group, 'queue')
+        lock = RunLock(self.lock_path(group))
+        deadline = time.time() + 60*self.wait_minutes
+        waiting = False
+        while not lock.try_acquire(command):
+            holder = lock.holder()
+            if policy == 'skip' or time.time() > deadline:
+                reason = ('lock group ' + group + ' is held by ' + self.describe(holder)
+                          + ('' if policy == 'skip' else '; gave up after waiting ' + str(self.wait_minutes) + ' minutes'))
+                print('Skipping ' + command + ': ' + reason)
+                self.history.skipped(command, group, reason)
+                yield False
+                return
+            if not waiting:
+                print('Waiting (up to ' + str(self.wait_minutes) + ' minutes) for lock group ' + group + ', held by ' + self.describe(holder))
+                waiting = True
+            time.sleep(self.poll_every)
+        run_id = self.history.start(command, group)
+        try:
+            yield True
+        except BaseException as e:
+            self.history.finish(run_id, 'failed', traceback.format_exc())
+            raise
+        else:
+            self.history.finish(run_id, 'success')
+        finally:
+            lock.release()
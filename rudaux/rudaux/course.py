@@ -1,4 +1,5 @@
-import os, sys, pwd
+import os, sys
+import time
 import pickle as pk
 import tqdm
 import pendulum as plm
@@ -16,21 +17,99 @@ from .assignment import Assignment
 from .docker import Docker, DockerError
 from .submission import Submission, SubmissionStatus, MultipleGraderError
 from .notification import SMTP
+from .utils import chown_tree, save_pickle
+from .timeline import DueTimeline
+from .latereg import plan_latereg_extensions
 import git
 import shutil
 import random
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+def load_config(course_dir):
+    """
+    Load and validate the rudaux_config.py in course_dir, filling in defaults for optional settings.
+    """
+    print('Loading rudaux configuration')
+    
+    config = Config()
+
+    if not os.path.exists(os.path.join(course_dir, 'rudaux_config.py')):
+        sys.exit(
+          """
+          There is no rudaux_config.py in your current directory,
+          and no course directory was specified on the command line. Please
+          specify a directory with a valid rudaux_config.py file. 
+          """
+        )
+
+    config.merge(PyFileConfigLoader('rudaux_config.py', path=course_dir).load_config())
+
+    #make sure the student folder root doesn't end with a slash (for careful zfs snapshot syntax)
+    config.user_folder_root.rstrip('/')
+    #TODO make sure the user_folder_root is actually right; we use rm and chown on subdirectories below
+    #the system user that owns everything in the grader/student folders (defaults to jupyter)
+    config.jupyter_user = config.get('jupyter_user', 'jupyter')
+    #grader folders are cloned (shallow by default, in parallel) from a local mirror of the instructor repo
+    config.instructor_repo_mirror = config.get('instructor_repo_mirror', os.path.join(course_dir, config.name + '_instructor_repo.git'))
+    config.grader_clone_depth = config.get('grader_clone_depth', 1)
+    config.num_git_threads = config.get('num_git_threads', 4)
+    #notifications are queued on disk and sent in per-recipient digests (window in hours; 0 = send at the next drain)
+    config.notification_digest_hours = config.get('notification_digest_hours', {})
+    config.notification_max_attempts = config.get('notification_max_attempts', 5)
+    config.notification_retry_minutes = config.get('notification_retry_minutes', 30)
+    config.notification_threads = config.get('notification_threads', 4)
+    config.notification_rate = config.get('notification_rate', 1.)
+    #number of assignments to run through the grading workflow at once (sharing the docker pool); 1 = one after another
+    config.num_pipelined_assignments = config.get('num_pipelined_assignments', 1)
+    #where the docker pool keeps its state (the job history used for runtime estimates and `rudaux stats`, and the job queue)
+    config.docker_state_dir = config.get('docker_state_dir', course_dir)
+    #docker daemons to spread grading jobs over, as a list of {'url' : ..., 'slots' : ..., 'path_map' : {...}}; None = the local daemon
+    config.docker_hosts = config.get('docker_hosts', None)
+    #adaptively grow/shrink the number of concurrent containers between min/max based on host load, free memory and OOM kills
+    config.docker_adaptive = config.get('docker_adaptive', False)
+    config.min_docker_threads = config.get('min_docker_threads', 1)
+    config.max_docker_threads = config.get('max_docker_threads', config.num_docker_threads)
+    #what a command does when another command in its lock group is running: 'queue' (wait up to lock_wait_minutes) or 'skip'
+    lock_policy = {'snapshot' : 'skip', 'grading' : 'queue', 'notify' : 'skip'}
+    lock_policy.update(config.get('lock_policy', {}))
+    config.lock_policy = lock_policy
+    config.lock_wait_minutes = config.get('lock_wait_minutes', 60)
+    #runs holding a lock longer than this get flagged as possibly hung
+    config.lock_max_hours = config.get('lock_max_hours', 12)
+    #canvas requests: how many can be in flight at once (also limited by canvas's rate limit), how many times to try
+    #throttled/failed ones, and how much of the rate limit quota to leave unused
+    config.canvas_max_concurrency = config.get('canvas_max_concurrency', 4)
+    config.canvas_max_tries = config.get('canvas_max_tries', 5)
+    config.canvas_rate_limit_reserve = config.get('canvas_rate_limit_reserve', 100)
+    #delta canvas syncs (snapshots / the daemon's periodic sync) only refetch overrides and group memberships that changed;
+    #a full sync is forced when the last one is older than this
+    config.canvas_full_sync_hours = config.get('canvas_full_sync_hours', 24)
+    #`rudaux daemon` task intervals, control socket, and how long after a due time to take the snapshot
+    config.daemon_socket = config.get('daemon_socket', os.path.join(course_dir, config.name + '_daemon.sock'))
+    config.daemon_sync_minutes = config.get('daemon_sync_minutes', 60)
+    config.daemon_snapshot_minutes = config.get('daemon_snapshot_minutes', 30)
+    config.daemon_snapshot_delay = config.get('daemon_snapshot_delay', 30)
+    config.daemon_latereg_hours = config.get('daemon_latereg_hours', 24)
+    config.daemon_grading_hours = config.get('daemon_grading_hours', 24)
+    config.daemon_notify_minutes = config.get('daemon_notify_minutes', 60)
+    return config
 
 class Course(object):
     """
     Course object for managing a Canvas/JupyterHub/nbgrader course.
     """
 
-    def __init__(self, course_dir, dry_run = False, allow_canvas_cache = False):
+    def __init__(self, course_dir, dry_run = False, allow_canvas_cache = False, config = None, full_sync = True):
         """
         Initialize a course from a config file. 
         :param course_dir: The directory your course. If none, defaults to current working directory. 
         :type course_dir: str
+        :param config: The already-loaded configuration (from load_config); loaded from course_dir if None.
+        :type config: traitlets.config.Config
+        :param full_sync: Whether to refetch everything from Canvas, rather than only what changed since the cached state.
+        :type full_sync: bool
 
         :returns: A Course object for performing operations on an entire course at once.
         :rtype: Course
@@ -40,30 +119,10 @@ class Course(object):
         self.dry_run = dry_run
 
         #=======================================#
-        #              Load Config              #
+        #          Load/Validate Config         #
         #=======================================#
         
-        print('Loading rudaux configuration')
-        
-        self.config = Config()
-
-        if not os.path.exists(os.path.join(course_dir, 'rudaux_config.py')):
-            sys.exit(
-              """
-              There is no rudaux_config.py in your current directory,
-              and no course directory was specified on the command line. Please
-              specify a directory with a valid rudaux_config.py file. 
-              """
-            )
-
-        self.config.merge(PyFileConfigLoader('rudaux_config.py', path=course_dir).load_config())
-
-        #=======================================#
-        #          Validate Config              #
-        #=======================================#
-        #make sure the student folder root doesn't end with a slash (for careful zfs snapshot syntax)
-        self.config.user_folder_root.rstrip('/')
-        #TODO make sure the user_folder_root is actually right; we use rm and chown on subdirectories below
+        self.config = config if config is not None else load_config(course_dir)
         
         #===================================================================================================#
         #      Create Canvas object and try to load state (if failure, load cached if we're allowed to)     #
@@ -72,7 +131,7 @@ class Course(object):
         print('Creating Canvas interface...')
         self.canvas = Canvas(self.config, self.dry_run)
         self.canvas_cache_filename = os.path.join(self.course_dir, self.config.name + '_canvas_cache.pk')
-        self.synchronize_canvas(allow_canvas_cache)
+        self.synchronize_canvas(allow_canvas_cache, full = full_sync)
         
         #=======================================================#
         #      Create the JupyterHub Interface                  #
@@ -88,6 +147,14 @@ class Course(object):
         print('Creating ZFS interface...')
         self.zfs = ZFS(self.config, self.dry_run)
 
+        #=======================================================#
+        #      Instructor repo mirror (refreshed once per run)  #
+        #=======================================================#
+
+        self.instructor_repo_mirror = self.config.instructor_repo_mirror
+        self.instructor_repo_mirror_refreshed = False
+        self.instructor_repo_mirror_lock = threading.Lock()
+
         #=======================================================#
         #      Create the interface to Docker                   #
         #=======================================================#
@@ -100,7 +167,7 @@ class Course(object):
         #=======================================================#
 
         print('Creating Notification interface...')
-        self.notifier = self.config.notification_type(self.config, self.dry_run)
+        self.notifier = self.config.notification_type(self.config, self.dry_run, self.course_dir)
         
         #=======================================================#
         #      Load the saved state                             #
@@ -114,54 +181,55 @@ class Course(object):
         
         print('Done.')
        
-    def synchronize_canvas(self, allow_cache = False):
+    def synchronize_canvas(self, allow_cache = False, full = True):
+        #for a delta sync, assignments/groups whose fingerprints are unchanged since the last sync (this object's state, or
+        #the canvas cache) keep their overrides/memberships; falls back to a full sync if the last one is too old
+        known_asgns, known_groups = None, None
+        if not full:
+            baseline = self._sync_baseline()
+            if baseline is None:
+                print('No previous canvas state with fingerprints found; doing a full sync')
+            elif time.time() - baseline['last_full_sync'] > 3600*self.config.canvas_full_sync_hours:
+                print('Last full canvas sync was more than ' + str(self.config.canvas_full_sync_hours) + ' hours ago; doing a full sync')
+            else:
+                known_asgns = {a.canvas_id : (getattr(a, 'fingerprint', None), a.overrides) for a in baseline['assignments']}
+                known_groups = {g.canvas_id : (getattr(g, 'fingerprint', None), g.members) for g in baseline['groups']}
+                last_full_sync = baseline['last_full_sync']
+        if known_asgns is None:
+            last_full_sync = time.time()
         try:
-            print('Synchronizing with Canvas...')
+            print('Synchronizing with Canvas' + ('' if known_asgns is None else ' (delta)') + '...')
 
             print('Obtaining course information...')
             self.course_info = self.canvas.get_course_info()
             print('Done.')
             
-            print('Obtaining/processing student enrollment information from Canvas...')
-            student_dicts = self.canvas.get_students()
-            self.students = [Person(sd) for sd in student_dicts]
-            print('Done.')
-
-            print('Obtaining/processing TA enrollment information from Canvas...')
-            ta_dicts = self.canvas.get_tas()
-            self.tas = [Person(ta) for ta in ta_dicts]
-            print('Done.')
-
-            print('Obtaining/processing instructor enrollment information from Canvas...')
-            instructor_dicts = self.canvas.get_instructors()
-            self.instructors = [Person(inst) for inst in instructor_dicts]
-            print('Done.')
-
-            print('Obtaining/processing student view / fake student enrollment information from Canvas...')
-            fake_student_dicts = self.canvas.get_fake_students()
-            self.fake_students = [Person(fsd) for fsd in fake_student_dicts]
+            print('Obtaining/processing enrollment information from Canvas...')
+            people = self.canvas.get_people()
+            self.students = [Person(sd) for sd in people['StudentEnrollment']]
+            self.tas = [Person(ta) for ta in people['TaEnrollment']]
+            self.instructors = [Person(inst) for inst in people['TeacherEnrollment']]
+            self.fake_students = [Person(fsd) for fsd in people['StudentViewEnrollment']]
             print('Done.')
 
             print('Obtaining/processing assignment information from Canvas...')
-            assignment_dicts = self.canvas.get_assignments()
+            assignment_dicts = self.canvas.get_assignments(known_asgns)
             self.assignments = [Assignment(ad) for ad in assignment_dicts]
             print('Done.')
 
             print('Obtaining/processing group information from Canvas...')
-            group_dicts = self.canvas.get_groups()
+            group_dicts = self.canvas.get_groups(known_groups)
             self.groups = [Group(gr) for gr in group_dicts]
             print('Done.')
+            self.last_full_sync = last_full_sync
         except Exception as e:
             print('Exception encountered during synchronization')
             print(e)
             print(traceback.format_exc())
-            if allow_canvas_cache:
+            if allow_cache:
                 print('Attempting to fall back to cache...')
-                if os.path.exists(self.canvas_cache_filename):
-                    print('Loading cached canvas state from ' + self.canvas_cache_filename)
-                    canvas_cache = None
-                    with open(self.canvas_cache_filename, 'rb') as f:
-                        canvas_cache = pk.load(f)
+                canvas_cache = self._load_canvas_cache()
+                if canvas_cache is not None:
                     self.course_info = canvas_cache['course_info']
                     self.students = canvas_cache['students']
                     self.fake_students = canvas_cache['fake_students']
@@ -169,18 +237,44 @@ class Course(object):
                     self.tas = canvas_cache['tas']
                     self.assignments = canvas_cache['assignments']
                     self.groups = canvas_cache['groups']
+                    self.last_full_sync = canvas_cache.get('last_full_sync', 0)
         else:
-            print('Saving canvas cache file...')
-            with open(self.canvas_cache_filename, 'wb') as f:
-                pk.dump({'course_info' : self.course_info,
-                         'students' : self.students,
-                         'fake_students' : self.fake_students,
-                         'instructors' : self.instructors,
-                         'tas' : self.tas,
-                         'assignments' : self.assignments,
-                         'groups' : self.groups,
-                         }, f)
+            self.save_canvas_cache()
+        #sorted index of all due times, for snapshots / the daemon's schedule
+        self.due_timeline = DueTimeline(self.assignments)
         return
+
+    def _load_canvas_cache(self):
+        if not os.path.exists(self.canvas_cache_filename):
+            return None
+        print('Loading cached canvas state from ' + self.canvas_cache_filename)
+        with open(self.canvas_cache_filename, 'rb') as f:
+            return pk.load(f)
+
+    def _sync_baseline(self):
+        #the state a delta sync compares against: what this object last synced (e.g. in the daemon), else the cache
+        if getattr(self, 'last_full_sync', None) is not None:
+            return {'assignments' : self.assignments, 'groups' : self.groups, 'last_full_sync' : self.last_full_sync}
+        try:
+            canvas_cache = self._load_canvas_cache()
+        except Exception as e:
+            print('Could not load the canvas cache: ' + str(e))
+            return None
+        if canvas_cache is None or canvas_cache.get('last_full_sync') is None:
+            return None
+        return canvas_cache
+
+    def save_canvas_cache(self):
+        print('Saving canvas cache file...')
+        save_pickle({'course_info' : self.course_info,
+                     'students' : self.students,
+                     'fake_students' : self.fake_students,
+                     'instructors' : self.instructors,
+                     'tas' : self.tas,
+                     'assignments' : self.assignments,
+                     'groups' : self.groups,
+                     'last_full_sync' : self.last_full_sync,
+                     }, self.canvas_cache_filename)
     
     def load_snapshots(self):
         print('Loading the list of taken snapshots...')
@@ -207,8 +301,7 @@ class Course(object):
     def save_snapshots(self):
         print('Saving the taken snapshots list...')
         if not self.dry_run:
-            with open(self.snapshots_filename, 'wb') as f:
-                pk.dump(self.snapshots, f)
+            save_pickle(self.snapshots, self.snapshots_filename)
             print('Done.')
         else:
             print('[Dry Run: snapshot list not saved]')
@@ -217,8 +310,7 @@ class Course(object):
     def save_submissions(self):
         print('Saving the submissions list...')
         if not self.dry_run:
-            with open(self.submissions_filename, 'wb') as f:
-                pk.dump(self.submissions, f)
+            save_pickle(self.submissions, self.submissions_filename)
             print('Done.')
         else:
             print('[Dry Run: submissions not saved]')
@@ -230,100 +322,152 @@ class Course(object):
     #TODO rather than save a list of taken snapshots and update it, detect which snapshots were already taken from zfs list
     def take_snapshots(self):
         print('Taking snapshots')
-        for a in self.assignments:
-            if (a.due_at is not None) and a.due_at < plm.now() and a.name not in self.snapshots:
-                print('Assignment ' + a.name + ' is past due and no snapshot exists yet. Taking a snapshot [' + a.name + ']')
+        taken = set(self.snapshots)
+        now = plm.now()
+        for ev in self.due_timeline.due_before(now.timestamp()):
+            if ev.snap_name in taken:
+                continue
+            if ev.student is None:
+                print('Assignment ' + ev.assignment + ' is past due and no snapshot exists yet. Taking a snapshot [' + ev.snap_name + ']')
                 try:
-                    self.zfs.snapshot_all(a.name)
+                    self.zfs.snapshot_all(ev.snap_name)
                 except CalledProcessError as e:
-                    print('Error creating snapshot ' + a.name)
+                    print('Error creating snapshot ' + ev.snap_name)
                     print('Return code ' + str(e.returncode))
                     print(e.output.decode('utf-8'))
                     print('Not updating the taken snapshots list')
-                else:
-                    if not self.dry_run:
-                        self.snapshots.append(a.name)
+                    continue
+                add_to_taken_list = True
+            else:
+                print('Assignment ' + ev.assignment + ' has override ' + ev.snap_name + ' for student ' + ev.student + ' and no snapshot exists yet. Taking a snapshot [' + ev.snap_name + ']')
+                add_to_taken_list = True
+                try:
+                    self.zfs.snapshot_user(ev.student, ev.snap_name)
+                except CalledProcessError as e:
+                    print('Error creating snapshot ' + ev.snap_name)
+                    print('Return code ' + str(e.returncode))
+                    print(e.output.decode('utf-8'))
+                    if 'dataset does not exist' not in e.output.decode('utf-8'):
+                        print('Unknown error; not updating the taken snapshots list')
+                        add_to_taken_list = False
                     else:
-                        print('[Dry Run: snapshot name not added to taken list; would have added ' + a.name + ']')
-            for over in a.overrides:
-                snapname = a.name + '-override-' + over['id'] #TODO don't hard code this pattern here since we need it in submission too
-                if (over['due_at'] is not None) and over['due_at'] < plm.now() and not (snapname in self.snapshots):
-                    print('Assignment ' + a.name + ' has override ' + over['id'] + ' for student ' + over['student_ids'][0] + ' and no snapshot exists yet. Taking a snapshot [' + snapname + ']')
-                    add_to_taken_list = True
-                    try:
-                        self.zfs.snapshot_user(over['student_ids'][0], snapname)
-                    except CalledProcessError as e:
-                        print('Error creating snapshot ' + snapname)
-                        print('Return code ' + str(e.returncode))
-                        print(e.output.decode('utf-8'))
-                        if 'dataset does not exist' not in e.output.decode('utf-8'):
-                            print('Unknown error; not updating the taken snapshots list')
-                            add_to_taken_list = False
-                        else:
-                            print('Student hasnt created their folder; this counts as a missing submission. Updating taken snapshots list.')
-
-                    if not self.dry_run and add_to_taken_list:
-                        self.snapshots.append(snapname)
-                    elif self.dry_run:
-                        print('[Dry Run: snapshot name not added to taken list; would have added ' + snapname + ']')
-        print('Done.')
+                        print('Student hasnt created their folder; this counts as a missing submission. Updating taken snapshots list.')
+            if not self.dry_run and add_to_taken_list:
+                self.snapshots.append(ev.snap_name)
+                taken.add(ev.snap_name)
+            elif self.dry_run:
+                print('[Dry Run: snapshot name not added to taken list; would have added ' + ev.snap_name + ']')
+        next_due = self.due_timeline.next_due(now.timestamp())
+        print('Done. Next due time: ' + (str(plm.from_timestamp(next_due).in_timezone(self.course_info['time_zone'])) if next_due is not None else 'none'))
         self.save_snapshots() 
 
     def apply_latereg_extensions(self): 
-        need_synchronize = False
         tz = self.course_info['time_zone']
         fmt = 'ddd YYYY-MM-DD HH:mm:ss'
-        print('Applying late registration extensions')
-        for a in self.assignments:
-            print('Checking ' + str(a.name))
-            print('Due: ' + str(a.due_at.in_timezone(tz).format(fmt) if a.due_at is not None else a.due_at) + ' Unlock: ' + str(a.unlock_at.in_timezone(tz).format(fmt) if a.unlock_at is not None else a.unlock_at))
-            if (a.due_at is not None) and (a.unlock_at is not None): #if the assignment has both a due date and unlock date set
-                for s in self.students:
-                    regdate = s.reg_updated if (s.reg_updated is not None) else s.reg_created
-                    if s.status == 'active' and regdate > a.unlock_at:
-                        #if student s active and registered after assignment a was unlocked
-                        print('Student ' + s.name + ' registration date (' + regdate.in_timezone(tz).format(fmt)+') after unlock date of assignment ' + a.name + ' (' + a.unlock_at.in_timezone(tz).format(fmt) + ')')
-                        #get their due date w/ no late registration
-                        due_date, override = a.get_due_date(s)
-                        print('Current due date: ' + due_date.in_timezone(tz).format(fmt) + ' from override: ' + str(True if (override is not None) else False))
-                        #the late registration due date
-                        latereg_date = regdate.add(days=self.config.latereg_extension_days)
-                        print('Late registration extension date: ' + latereg_date.in_timezone(tz).format(fmt))
-                        if latereg_date > due_date:
-                            print('Creating automatic late registration extension to ' + latereg_date.in_timezone(tz).format(fmt)) 
-                            if override is not None:
-                                print('Removing old override')
-                                self.canvas.remove_override(a.canvas_id, override['id'])
-                            need_synchronize = True
-                            self.canvas.create_override(a.canvas_id, {'student_ids' : [s.canvas_id],
-                                                                  'due_at' : latereg_date,
-                                                                  'lock_at' : a.lock_at,
-                                                                  'unlock_at' : a.unlock_at,
-                                                                  'title' : s.name+'-'+a.name+'-latereg'}
-                                                   )
-                        else:
-                            print('Current due date after registration extension date. No extension required. Skipping.')
-            else:
-                print('Assignment missing either a due date (' + str(a.due_at) + ') or unlock date (' + str(a.unlock_at) + '). Not checking.')
-
-        #TODO create a "needs_synch" flag instead of doing it now; lazy synch
-        #if need_synchronize:
-        #    print('Overrides changed. Deleting out-of-date cache and forcing canvas synchronize...')
-        #    if os.path.exists(self.canvas_cache_filename):
-        #        os.remove(self.canvas_cache_filename)
-        #    self.synchronize_canvas(allow_cache = False)
+        print('Planning late registration extensions')
+        plan, skipped = plan_latereg_extensions(self.assignments, self.students, self.config.latereg_extension_days)
+        for a in skipped:
+            print('Assignment ' + a.name + ' missing either a due date (' + str(a.due_at) + ') or unlock date (' + str(a.unlock_at) + '). Not checking.')
+
+        #print the whole plan before touching canvas
+        if len(plan) == 0:
+            print('No late registration extensions required.')
+            print('Done.')
+            return
+        tbl = [['Assignment', 'Student', 'Registered', 'Unlock', 'Current Due', 'From Override', 'New Due']]
+        for ext in plan:
+            regdate = ext.student.reg_updated if (ext.student.reg_updated is not None) else ext.student.reg_created
+            tbl.append([ext.assignment.name, ext.student.name + ' (' + ext.student.canvas_id + ')', regdate.in_timezone(tz).format(fmt),
+                        ext.assignment.unlock_at.in_timezone(tz).format(fmt), ext.old_due_at.in_timezone(tz).format(fmt),
+                        ext.old_override['id'] if ext.old_override is not None else '-', ext.new_due_at.in_timezone(tz).format(fmt)])
+        print(ttbl.AsciiTable(tbl, 'Late Registration Extension Plan (' + str(len(plan)) + ' overrides)').table)
+
+        #one batch of canvas requests for the whole plan: individual removals of the replaced overrides, batched creations,
+        #then one listing per assignment to verify (the new override ids change the snapshot names, so we replace rather than update)
+        to_remove = []
+        to_create = []
+        for ext in plan:
+            a, s = ext.assignment, ext.student
+            print('Creating automatic late registration extension for ' + s.name + ' on ' + a.name + ' to ' + ext.new_due_at.in_timezone(tz).format(fmt))
+            if ext.old_override is not None:
+                print('Removing old override')
+                to_remove.append((a.canvas_id, ext.old_override['id']))
+            to_create.append((a.canvas_id, {'student_ids' : [s.canvas_id],
+                                            'due_at' : ext.new_due_at,
+                                            'lock_at' : a.lock_at,
+                                            'unlock_at' : a.unlock_at,
+                                            'title' : s.name+'-'+a.name+'-latereg'}))
+        listings = self.canvas.apply_overrides(to_remove, to_create)
+
+        #the verification listings are the assignments' current overrides, so no canvas resync is needed
+        if len(listings) > 0:
+            for a in self.assignments:
+                if a.canvas_id in listings:
+                    a.set_overrides(listings[a.canvas_id])
+            self.due_timeline = DueTimeline(self.assignments)
+            self.save_canvas_cache()
 
         print('Done.')
         return 
 
 
+    def refresh_instructor_repo_mirror(self):
+        #keep a local bare mirror of the instructor repo so that grader folders clone from local disk
+        #only hit the remote once per run, no matter how many grader folders get created
+        with self.instructor_repo_mirror_lock:
+            self._refresh_instructor_repo_mirror()
+
+    def _refresh_instructor_repo_mirror(self):
+        if self.instructor_repo_mirror_refreshed:
+            return
+        if os.path.exists(self.instructor_repo_mirror):
+            print('Refreshing instructor repo mirror at ' + self.instructor_repo_mirror)
+            mirror = git.Repo(self.instructor_repo_mirror)
+            mirror.remote('origin').set_url(self.config.instructor_repo_url)
+            mirror.git.remote('update', '--prune')
+        else:
+            print('Creating instructor repo mirror at ' + self.instructor_repo_mirror + ' from ' + self.config.instructor_repo_url)
+            git.Repo.clone_from(self.config.instructor_repo_url, self.instructor_repo_mirror, mirror=True)
+        self.instructor_repo_mirror_refreshed = True
+
+    def clone_grader_repo(self, repo_path):
+        print('Cloning course repository into ' + repo_path + ' from local mirror ' + self.instructor_repo_mirror)
+        clone_kwargs = {}
+        if self.config.grader_clone_depth:
+            clone_kwargs['depth'] = self.config.grader_clone_depth
+        #file:// so that --depth is respected for a local clone
+        repo = git.Repo.clone_from('file://' + os.path.abspath(self.instructor_repo_mirror), repo_path, **clone_kwargs)
+        #point origin back at the real instructor repo rather than our mirror
+        repo.remote('origin').set_url(self.config.instructor_repo_url)
+        chown_tree(repo_path, self.config.jupyter_user)
+        print('Cloned ' + repo_path)
+
+    def create_grader_accounts(self, assignments):
+        #create all missing jupyterhub grader accounts for the assignments in one batch, so that the hub is only restarted once
+        print('Checking jupyter users for graders of ' + str([a.name for a in assignments]))
+        existing = self.jupyterhub.get_users()
+        pending = {}
+        for a in assignments:
+            for i in range(len(self.config.graders[a.name])):
+                grader_name = a.grader_basename() + str(i)
+                if grader_name not in existing:
+                    print('Grader ' + grader_name + ' not created on the hub yet; assigning ' + self.config.graders[a.name][i])
+                    pending[grader_name] = self.config.graders[a.name][i]
+        if len(pending) > 0:
+            print('Creating ' + str(len(pending)) + ' grader accounts on the hub')
+            self.jupyterhub.assign_graders(pending)
+        else:
+            print('All grader users exist!')
+
     #TODO what happens if rudaux config doesn't have this one's name?
     def create_grader_folders(self, a):
         print('Creating grader folders/accounts for assignments')
-        #TODO don't hardcode 'jupyter' here
-        jupyter_uid = pwd.getpwnam('jupyter').pw_uid
         # create a user folder and jupyterhub account for each grader if needed
         print('Checking assignment ' + a.name + ' with grader list ' + str(self.config.graders[a.name]))
+        # create any jupyterhub users that weren't created by create_grader_accounts
+        self.create_grader_accounts([a])
+
+        repos_to_clone = []
         for i in range(len(self.config.graders[a.name])):
             grader_name = a.grader_basename() + str(i)
             print('Checking assignment ' + a.name + ' grader ' + self.config.graders[a.name][i] + '(' +grader_name + ')')
@@ -335,13 +479,6 @@ class Course(object):
                 self.zfs.create_user_folder(grader_name)
             print('Grading folder exists')
 
-            # create the jupyterhub user
-            print('Checking if jupyter user ' + grader_name + ' exists')
-            if not self.jupyterhub.grader_exists(grader_name):
-                print('Grader ' + grader_name + ' not created on the hub yet; assigning ' + self.config.graders[a.name][i])
-                self.jupyterhub.assign_grader(grader_name, self.config.graders[a.name][i])   
-            else:
-                print('User exists!')
 
             # if not a valid repo with an nbgrader config file, clone it
             repo_path = os.path.join(self.config.user_folder_root, grader_name)
@@ -359,25 +496,34 @@ class Course(object):
             else:
                 repo_valid = True
             if not repo_valid:
-                print(repo_path + ' is not a valid course repo. Cloning course repository from ' + self.config.instructor_repo_url)
-                if not self.dry_run:
-                    git.Repo.clone_from(self.config.instructor_repo_url, repo_path)
-                    for root, dirs, files in os.walk(repo_path):  
-                        for di in dirs:  
-                          os.chown(os.path.join(root, di), jupyter_uid, jupyter_uid)
-                        for fi in files:
-                          os.chown(os.path.join(root, fi), jupyter_uid, jupyter_uid)
-                else:
-                    print('[Dry Run: would have removed any file/folder at ' + repo_path + ', called mkdir('+repo_path+') and git clone ' + self.config.instructor_repo_url + ' into ' + repo_path)
+                print(repo_path + ' is not a valid course repo. Queueing clone of course repository from ' + self.config.instructor_repo_url)
+                repos_to_clone.append(repo_path)
             else:
                 print('Repo valid.')
 
+        # clone all the grader repos that need it in parallel from the local mirror
+        if len(repos_to_clone) > 0:
+            if not self.dry_run:
+                self.refresh_instructor_repo_mirror()
+                with ThreadPoolExecutor(max_workers = self.config.num_git_threads) as executor:
+                    futures = [executor.submit(self.clone_grader_repo, repo_path) for repo_path in repos_to_clone]
+                # raise the first clone error (if any) only after all clones have finished
+                for future in futures:
+                    future.result()
+            else:
+                for repo_path in repos_to_clone:
+                    print('[Dry Run: would have cloned ' + self.config.instructor_repo_url + ' (via local mirror ' + self.instructor_repo_mirror + ') into ' + repo_path + ']')
+
+        for i in range(len(self.config.graders[a.name])):
+            grader_name = a.grader_basename() + str(i)
+            repo_path = os.path.join(self.config.user_folder_root, grader_name)
+
             # if the assignment hasn't been generated yet, generate it
             print('Checking if assignment ' + a.name + ' has been generated for grader ' + grader_name)
-            generated_asgns = self.docker.run('nbgrader db assignment list', repo_path)
+            generated_asgns = self.docker.run('nbgrader db assignment list', repo_path, 'probe', a.name, a.due_at)
             if a.name not in generated_asgns['log']:
                 print('Assignment not yet generated. Generating')
-                output = self.docker.run('nbgrader generate_assignment --force ' + a.name, repo_path)
+                output = self.docker.run('nbgrader generate_assignment --force ' + a.name, repo_path, 'generate', a.name, a.due_at)
                 print(output['log'])
                 if 'ERROR' in output['log']:
                     raise DockerError('Error generating assignment ' + a.name + ' in grader folder ' + grader_name + ' at repo path ' + repo_path, output['log'])
@@ -390,7 +536,7 @@ class Course(object):
             print('Checking if solution generated...')
             if not os.path.exists(os.path.join(repo_path, soln_name)):
                 print('Solution not generated; generating')
-                output = self.docker.run('jupyter nbconvert ' + local_path + ' --output=' + soln_name + ' --output-dir=.', repo_path) 
+                output = self.docker.run('jupyter nbconvert ' + local_path + ' --output=' + soln_name + ' --output-dir=.', repo_path, 'generate', a.name, a.due_at) 
                 print(output['log'])
                 if 'ERROR' in output['log']:
                     raise DockerError('Error generating solution for assignment ' + a.name + ' in grader folder ' + grader_name + ' at repo path ' + repo_path, output['log'])
@@ -409,222 +555,269 @@ class Course(object):
         return results
 
     def grading_workflow(self): 
-        
-        for asgn in self.assignments:
-            #only do stuff for assignments past their basic due date
-            if asgn.due_at < plm.now():
-                #create grader zfs home folders  / jupyterhub accounts
-                #don't continue after this point unless grader creation is successful
-                print('Working on assignment ' + asgn.name)
-                print('Creating grader folders...')
-                create_folder_error = False
+
+        #pick up docker jobs left behind by a rudaux run that died, and clean up their orphaned containers
+        print('Recovering docker jobs from previous runs...')
+        self.docker.recover()
+
+        #create the hub accounts for every past-due assignment up front, so that the hub restarts at most once
+        #if this fails, create_grader_folders will retry (and report the failure) for each assignment individually
+        print('Creating grader accounts...')
+        try:
+            self.create_grader_accounts([asgn for asgn in self.assignments if asgn.due_at < plm.now() and asgn.name in self.config.graders])
+        except Exception as e:
+            print('Error encountered while creating grader accounts in batch; falling back to per-assignment creation')
+            print(e)
+
+        #only do stuff for assignments past their basic due date
+        past_due = [asgn for asgn in self.assignments if asgn.due_at < plm.now()]
+
+        #uploaded/posted grade state for all of them, fetched up front in one go; indexed by (assignment id, student id)
+        print('Getting uploaded/posted submissions on canvas')
+        canvas_subms = self.canvas.get_course_submissions([asgn.canvas_id for asgn in past_due])
+
+        if self.config.num_pipelined_assignments > 1:
+            #pipelined mode: work on several assignments at once, so that one assignment's collection/uploads/etc overlap
+            #with another's autograding. All docker jobs go through one shared pool of num_docker_threads containers.
+            print('Running grading workflow for ' + str(len(past_due)) + ' assignments, ' + str(self.config.num_pipelined_assignments) + ' at a time')
+            self.docker.start_pool()
+            try:
+                with ThreadPoolExecutor(max_workers = self.config.num_pipelined_assignments) as executor:
+                    futures = {asgn.name : executor.submit(self.grade_assignment, asgn, canvas_subms) for asgn in past_due}
+            finally:
+                self.docker.stop_pool()
+            #an unexpected error in one assignment shouldn't stop the others; report it to the instructor
+            for name, future in futures.items():
                 try:
-                    self.create_grader_folders(asgn)
-                except DockerError as e:
-                    error_message = e.message +'\nDocker output:\n' +e.docker_output
+                    future.result()
+                except Exception as e:
                     error_traceback = traceback.format_exc()
-                    create_folder_error = True
-                except git.exc.GitCommandError as e:
-                    error_message = str(e)
-                    error_traceback = traceback.format_exc()
-                    create_folder_error = True
-                except Exception as e:    
-                    error_message = str(e)
-                    error_traceback = traceback.format_exc()
-                    create_folder_error = True
-
-                if create_folder_error:
-                    print(f"""
-                      Error encountered while creating grader folders for {asgn.name}. Email sent to instructor. Skipping this assignment for now.
-                      Message: {error_message}
-                      Trace: {error_traceback}
-                      """)
-                    self.notifier.submit(self.config.instructor_user, 'Action Required: grader folder creation failed for ' + asgn.name+':\r\n' + error_message + '\r\n' + error_traceback)
-                    continue
+                    print('Unexpected error in grading workflow for ' + name)
+                    print(error_traceback)
+                    self.notifier.submit(self.config.instructor_user, 'Action Required: unexpected error in grading workflow for ' + name + ':\r\n' + str(e) + '\r\n' + error_traceback)
+        else:
+            for asgn in past_due:
+                self.grade_assignment(asgn, canvas_subms)
 
-                print('Getting uploaded/posted submissions on canvas')
-                canvas_subms = self.canvas.get_submissions(asgn.canvas_id)
-                posted_grades = {subm['student_id'] : subm['posted_at'] is not None for subm in canvas_subms} 
-                uploaded_grades = {subm['student_id'] : subm['score'] is not None for subm in canvas_subms}
-
-                #create the set of submission objects for any unfinished assignments 
-                print('Creating submission objects')
-                submissions = {}
-                errors = []
-                for stu in self.students:
-                    try:
-                        submissions[stu.canvas_id] = Submission(asgn, stu, uploaded_grades[stu.canvas_id], posted_grades[stu.canvas_id], self.config)
-                    except MultipleGraderError as e:
-                        print(f'Multiple grader error in creating submission for {asgn.name} : {stu.canvas_id}')
-                        print(e.message)
-                        submissions.pop(stu.canvas_id, None)
-                        errors.append(f'Multiple grader error in creating submission for {asgn.name} : {stu.canvas_id}\r\n'+e.message+'\r\n')
-                    except Exception as e:
-                        print(f'Error creating submission for {asgn.name} : {stu.canvas_id}')
-                        submissions.pop(stu.canvas_id, None)
-                        errors.append(f'Error creating submission for {asgn.name} : {stu.canvas_id}\r\n'+e.message+'\r\n')
-
-                if len(errors) > 0:
-                    print('Errors creating submissions detected. Notifying instructor and stopping processing this assignment.') 
-                    err_msg = 'Errors detected in ' + asgn.name + ' processing. Action required.' + \
-        								     '\r\n SUBMISSION CREATION ERRORS:\r\n' + \
-                                                                             '\r\n'.join(errors)
-                    print(err_msg)
-                    self.notifier.submit(self.config.instructor_user, err_msg)
-                    continue
-                        
-
-                #make sure all submissions are prepared
-                print('Preparing submissions')
-                prep_results = self.process(lambda subm : Submission.prepare(subm, self.course_info['time_zone']), submissions, submissions, None)
-
-                # check if we can return the solutions to the students yet, and if so return
-                print('Checking whether solutions can be returned')
-                n_total = len(prep_results)
-                n_outstanding = len([p for p in prep_results if prep_results[p] == SubmissionStatus.NOT_DUE])
-                retsoln_results = {}
-                if (n_total - n_outstanding)/n_total >= self.config.return_solution_threshold: 
-                    print('Threshold reached(' + str((n_total - n_outstanding)/n_total) + '>=' + str(self.config.return_solution_threshold)+'); this assignment is returnable')
-                    if plm.now() > plm.parse(self.config.earliest_solution_return_date, tz=self.course_info['time_zone']):
-                        retsoln_results = self.process(Submission.return_solution, submissions, prep_results, [SubmissionStatus.MISSING, SubmissionStatus.PREPARED])
-                    else:
-                        print('Earliest return date (' +self.config.earliest_solution_return_date + ') not passed yet. Skipping')
-                else:
-                    print('Threshold not reached (' + str((n_total - n_outstanding)/n_total) + '<' + str(self.config.return_solution_threshold)+'); this assignment is not yet returnable')
- 
+        print('Sending notifications')
+        self.send_notifications()
+        return
 
-                #any missing assignments get a 0
-                print('Assigning 0 to all missing submissions')
-                miss_results = self.process(lambda subm: Submission.finalize_failed_submission(subm, self.canvas), submissions,
-                                               prep_results, SubmissionStatus.MISSING)
+    def grade_assignment(self, asgn, canvas_subms = None):
 
-                print('Submitting autograding tasks')
-                ag_results = self.process(lambda subm : Submission.submit_autograding(subm, self.docker), submissions, 
-						prep_results, SubmissionStatus.PREPARED)
-                
-                print('Running autograding tasks')
-                docker_results = self.docker.run_all()
+        #create grader zfs home folders  / jupyterhub accounts
+        #don't continue after this point unless grader creation is successful
+        print('Working on assignment ' + asgn.name)
+        print('Creating grader folders...')
+        create_folder_error = False
+        try:
+            self.create_grader_folders(asgn)
+        except DockerError as e:
+            error_message = e.message +'\nDocker output:\n' +e.docker_output
+            error_traceback = traceback.format_exc()
+            create_folder_error = True
+        except git.exc.GitCommandError as e:
+            error_message = str(e)
+            error_traceback = traceback.format_exc()
+            create_folder_error = True
+        except Exception as e:    
+            error_message = str(e)
+            error_traceback = traceback.format_exc()
+            create_folder_error = True
+
+        if create_folder_error:
+            print(f"""
+              Error encountered while creating grader folders for {asgn.name}. Email sent to instructor. Skipping this assignment for now.
+              Message: {error_message}
+              Trace: {error_traceback}
+              """)
+            self.notifier.submit(self.config.instructor_user, 'Action Required: grader folder creation failed for ' + asgn.name+':\r\n' + error_message + '\r\n' + error_traceback)
+            return
+
+        if canvas_subms is None:
+            print('Getting uploaded/posted submissions on canvas')
+            canvas_subms = self.canvas.get_course_submissions([asgn.canvas_id])
+        posted_grades = lambda sid : canvas_subms[(asgn.canvas_id, sid)]['posted_at'] is not None
+        uploaded_grades = lambda sid : canvas_subms[(asgn.canvas_id, sid)]['score'] is not None
+
+        #create the set of submission objects for any unfinished assignments 
+        print('Creating submission objects')
+        submissions = {}
+        errors = []
+        for stu in self.students:
+            try:
+                submissions[stu.canvas_id] = Submission(asgn, stu, uploaded_grades(stu.canvas_id), posted_grades(stu.canvas_id), self.config)
+            except MultipleGraderError as e:
+                print(f'Multiple grader error in creating submission for {asgn.name} : {stu.canvas_id}')
+                print(e.message)
+                submissions.pop(stu.canvas_id, None)
+                errors.append(f'Multiple grader error in creating submission for {asgn.name} : {stu.canvas_id}\r\n'+e.message+'\r\n')
+            except Exception as e:
+                print(f'Error creating submission for {asgn.name} : {stu.canvas_id}')
+                submissions.pop(stu.canvas_id, None)
+                errors.append(f'Error creating submission for {asgn.name} : {stu.canvas_id}\r\n'+e.message+'\r\n')
+
+        if len(errors) > 0:
+            print('Errors creating submissions detected. Notifying instructor and stopping processing this assignment.') 
+            err_msg = 'Errors detected in ' + asgn.name + ' processing. Action required.' + \
+								     '\r\n SUBMISSION CREATION ERRORS:\r\n' + \
+                                                                     '\r\n'.join(errors)
+            print(err_msg)
+            self.notifier.submit(self.config.instructor_user, err_msg)
+            return
                 
-                print('Checking grading status')
-                gr_results = self.process(lambda subm : Submission.check_grading(subm, self.canvas, docker_results), submissions, 
-						ag_results, [SubmissionStatus.NEEDS_AUTOGRADE, SubmissionStatus.AUTOGRADED])
 
-                print('Checking if any errors occurred and submitting error/failure notifications for instructors')
-                errors = {'preparing': [sid +':\r\n' + str(submissions[sid].error) for sid in prep_results if prep_results[sid] == SubmissionStatus.ERROR],
-                          'returningsolns': [sid +':\r\n' + str(submissions[sid].error) for sid in retsoln_results if retsoln_results[sid] == SubmissionStatus.ERROR],
-                          'autograding': [sid +':\r\n' + 'autograding failed previously' for sid in ag_results if ag_results[sid] == SubmissionStatus.AUTOGRADE_FAILED_PREVIOUSLY] + 
-                                         [sid +':\r\n' + str(submissions[sid].error) for sid in gr_results if gr_results[sid] == SubmissionStatus.ERROR or gr_results[sid] == SubmissionStatus.AUTOGRADE_FAILED],
-                          'uploading':  [sid +':\r\n' + str(submissions[sid].error) for sid in miss_results if miss_results[sid] == SubmissionStatus.ERROR]}
-                if any([len(v) > 0 for k, v in errors.items()]):
-                    print('Errors detected. Notifying instructor and stopping processing this assignment.') 
-                    err_msg = 'Errors detected in ' + asgn.name + ' processing. Action required.' + \
-        								     '\r\n PREPARATION ERRORS:\r\n' + \
-                                                                             '\r\n'.join(errors['preparing']) + \
-                                                                             '\r\n RETURN_SOLN ERRORS:\r\n' + \
-                                                                             '\r\n'.join(errors['returningsolns']) + \
-        								     '\r\n AUTOGRADING ERRORS:\r\n' + \
-                                                                             '\r\n'.join(errors['autograding']) + \
-        								     '\r\n UPLOADING ERRORS:\r\n' + \
-                                                                             '\r\n'.join(errors['uploading'])
-                    print(err_msg)
-                    self.notifier.submit(self.config.instructor_user, err_msg)
-                    continue
+        #make sure all submissions are prepared
+        print('Preparing submissions')
+        prep_results = self.process(lambda subm : Submission.prepare(subm, self.course_info['time_zone']), submissions, submissions, None)
+
+        # check if we can return the solutions to the students yet, and if so return
+        print('Checking whether solutions can be returned')
+        n_total = len(prep_results)
+        n_outstanding = len([p for p in prep_results if prep_results[p] == SubmissionStatus.NOT_DUE])
+        retsoln_results = {}
+        if (n_total - n_outstanding)/n_total >= self.config.return_solution_threshold: 
+            print('Threshold reached(' + str((n_total - n_outstanding)/n_total) + '>=' + str(self.config.return_solution_threshold)+'); this assignment is returnable')
+            if plm.now() > plm.parse(self.config.earliest_solution_return_date, tz=self.course_info['time_zone']):
+                retsoln_results = self.process(Submission.return_solution, submissions, prep_results, [SubmissionStatus.MISSING, SubmissionStatus.PREPARED])
+            else:
+                print('Earliest return date (' +self.config.earliest_solution_return_date + ') not passed yet. Skipping')
+        else:
+            print('Threshold not reached (' + str((n_total - n_outstanding)/n_total) + '<' + str(self.config.return_solution_threshold)+'); this assignment is not yet returnable')
+ 
 
-                print('Checking if any manual grading needs to happen and submitting notifications for TAs')
-                not_done_grading = False
-                for grader_ta in list(set(self.config.graders[asgn.name])): #use list(set(...)) in case same account is assigned to multiple grader accounts for some reason
-                    #grader_ta = self.config.graders[asgn.name][int(submissions[res].grader.split('-')[-1])]
-                    grading_tasks = [submissions[sid].grader + ' -- ' + asgn.name + ' -- ' + submissions[sid].stu.canvas_id for sid in gr_results if gr_results[sid] == SubmissionStatus.NEEDS_MANUAL_GRADE and grader_ta == self.config.graders[asgn.name][int(submissions[sid].grader.split('-')[-1])]]
-                    if len(grading_tasks) > 0:
-                        print('Grader ' + grader_ta + ' has grading task for ' + asgn.name +'. Pinging if today is an email day.')
-                        if plm.now().in_timezone(self.course_info['time_zone']).format('dddd') in self.config.notify_days:
-                            self.notifier.submit(grader_ta, 'You have a manual grading task to do for assignment ' + asgn.name +'! \r\n'+('Note: There are still ' + str(n_outstanding) + ' student submissions not due yet due to extensions/late registrations/etc; your task list may be incomplete and more tasks may show up over time.' if n_outstanding > 0 else 'All submissions have been collected, so no additional submissions will be added.') +  '\r\nEach entry below is an assignment that you have to grade, and is listed in the format [grader user account] -- [assignment name] -- [student id]. \r\n To grade the assignments, please sign in to the course JupyterHub with the [grader user account] username and the same password as your personal user account.\r\n'+ 
-                                                     '\r\n'.join(grading_tasks))
-                        not_done_grading = True
-
-                if not_done_grading:
-                    print('Not done grading this assignment. Waiting until grading is complete before moving on')
-                    continue
+        #any missing assignments get a 0
+        print('Assigning 0 to all missing submissions')
+        miss_results = self.process(lambda subm: Submission.finalize_failed_submission(subm, self.canvas), submissions,
+                                       prep_results, SubmissionStatus.MISSING)
 
-                print('Grading complete.')
+        print('Submitting autograding tasks')
+        ag_results = self.process(lambda subm : Submission.submit_autograding(subm, self.docker), submissions, 
+						prep_results, SubmissionStatus.PREPARED)
+        
+        print('Running autograding tasks')
+        docker_results = self.docker.wait([submissions[sid].autograde_docker_job_id for sid in ag_results if ag_results[sid] == SubmissionStatus.NEEDS_AUTOGRADE])
+        ag_report = self.docker.never_started_report(docker_results)
+        
+        print('Checking grading status')
+        gr_results = self.process(lambda subm : Submission.check_grading(subm, self.canvas, docker_results), submissions, 
+						ag_results, [SubmissionStatus.NEEDS_AUTOGRADE, SubmissionStatus.AUTOGRADED])
 
-                print('Uploading grades')
-                ul_results = self.process(lambda subm : Submission.upload_grade(subm, self.canvas), submissions, 
+        print('Checking if any errors occurred and submitting error/failure notifications for instructors')
+        errors = {'preparing': [sid +':\r\n' + str(submissions[sid].error) for sid in prep_results if prep_results[sid] == SubmissionStatus.ERROR],
+                  'returningsolns': [sid +':\r\n' + str(submissions[sid].error) for sid in retsoln_results if retsoln_results[sid] == SubmissionStatus.ERROR],
+                  'autograding': [sid +':\r\n' + 'autograding failed previously' for sid in ag_results if ag_results[sid] == SubmissionStatus.AUTOGRADE_FAILED_PREVIOUSLY] + 
+                                 [sid +':\r\n' + str(submissions[sid].error) for sid in gr_results if gr_results[sid] == SubmissionStatus.ERROR or gr_results[sid] == SubmissionStatus.AUTOGRADE_FAILED],
+                  'uploading':  [sid +':\r\n' + str(submissions[sid].error) for sid in miss_results if miss_results[sid] == SubmissionStatus.ERROR]}
+        if any([len(v) > 0 for k, v in errors.items()]):
+            print('Errors detected. Notifying instructor and stopping processing this assignment.') 
+            err_msg = 'Errors detected in ' + asgn.name + ' processing. Action required.' + \
+								     '\r\n PREPARATION ERRORS:\r\n' + \
+                                                                     '\r\n'.join(errors['preparing']) + \
+                                                                     '\r\n RETURN_SOLN ERRORS:\r\n' + \
+                                                                     '\r\n'.join(errors['returningsolns']) + \
+								     '\r\n AUTOGRADING ERRORS:\r\n' + \
+                                                                     '\r\n'.join(errors['autograding']) + \
+								     '\r\n UPLOADING ERRORS:\r\n' + \
+                                                                     '\r\n'.join(errors['uploading']) + \
+                                                                     ('\r\n DOCKER START FAILURES:\r\n' + ag_report if ag_report is not None else '')
+            print(err_msg)
+            self.notifier.submit(self.config.instructor_user, err_msg)
+            return
+
+        print('Checking if any manual grading needs to happen and submitting notifications for TAs')
+        not_done_grading = False
+        for grader_ta in list(set(self.config.graders[asgn.name])): #use list(set(...)) in case same account is assigned to multiple grader accounts for some reason
+            #grader_ta = self.config.graders[asgn.name][int(submissions[res].grader.split('-')[-1])]
+            grading_tasks = [submissions[sid].grader + ' -- ' + asgn.name + ' -- ' + submissions[sid].stu.canvas_id for sid in gr_results if gr_results[sid] == SubmissionStatus.NEEDS_MANUAL_GRADE and grader_ta == self.config.graders[asgn.name][int(submissions[sid].grader.split('-')[-1])]]
+            if len(grading_tasks) > 0:
+                print('Grader ' + grader_ta + ' has grading task for ' + asgn.name +'. Pinging if today is an email day.')
+                if plm.now().in_timezone(self.course_info['time_zone']).format('dddd') in self.config.notify_days:
+                    self.notifier.submit(grader_ta, 'You have a manual grading task to do for assignment ' + asgn.name +'! \r\n'+('Note: There are still ' + str(n_outstanding) + ' student submissions not due yet due to extensions/late registrations/etc; your task list may be incomplete and more tasks may show up over time.' if n_outstanding > 0 else 'All submissions have been collected, so no additional submissions will be added.') +  '\r\nEach entry below is an assignment that you have to grade, and is listed in the format [grader user account] -- [assignment name] -- [student id]. \r\n To grade the assignments, please sign in to the course JupyterHub with the [grader user account] username and the same password as your personal user account.\r\n'+ 
+                                             '\r\n'.join(grading_tasks))
+                not_done_grading = True
+
+        if not_done_grading:
+            print('Not done grading this assignment. Waiting until grading is complete before moving on')
+            return
+
+        print('Grading complete.')
+
+        print('Uploading grades')
+        ul_results = self.process(lambda subm : Submission.upload_grade(subm, self.canvas), submissions, 
 						gr_results, SubmissionStatus.DONE_GRADING)
 
-                print('Submitting feedback generation tasks')
-                fb_results = self.process(lambda subm : Submission.submit_genfeedback(subm, self.docker), submissions, 
+        print('Submitting feedback generation tasks')
+        fb_results = self.process(lambda subm : Submission.submit_genfeedback(subm, self.docker), submissions, 
 						ul_results, SubmissionStatus.GRADE_UPLOADED)
 
-                print('Running feedback generation tasks')
-                docker_results = self.docker.run_all()
+        print('Running feedback generation tasks')
+        docker_results = self.docker.wait([submissions[sid].feedback_docker_job_id for sid in fb_results if fb_results[sid] == SubmissionStatus.NEEDS_FEEDBACK])
+        fb_report = self.docker.never_started_report(docker_results)
 
-                print('Checking feedback gen status')
-                fbc_results = self.process(lambda subm : Submission.check_feedback(subm, docker_results), submissions, 
+        print('Checking feedback gen status')
+        fbc_results = self.process(lambda subm : Submission.check_feedback(subm, docker_results), submissions, 
 						fb_results, [SubmissionStatus.NEEDS_FEEDBACK, SubmissionStatus.FEEDBACK_GENERATED])
 
-                print('Checking if any errors occurred and submitting error/failure notifications for instructors')
-                errors = {'uploading':  [sid +':\r\n' + str(submissions[sid].error) for sid in ul_results if ul_results[sid] == SubmissionStatus.ERROR],
-                          'feedback': [sid +':\r\n' + 'feedback generation failed previously' for sid in fb_results if fb_results[sid] == SubmissionStatus.FEEDBACK_FAILED_PREVIOUSLY] + 
-                                         [sid +':\r\n' + str(submissions[sid].error) for sid in fbc_results if fbc_results[sid] == SubmissionStatus.ERROR or fbc_results[sid] == SubmissionStatus.FEEDBACK_FAILED]
-                          }
-                if any([len(v) > 0 for k, v in errors.items()]):
-                    print('Errors detected. Notifying instructor and stopping processing this assignment.') 
-                    err_msg = 'Errors detected in ' + asgn.name + ' processing. Action required.' + \
-        								     '\r\n GRADE UPLOAD ERRORS:\r\n' + \
-                                                                             '\r\n'.join(errors['uploading']) + \
-        								     '\r\n FEEDBACK ERRORS:\r\n' + \
-                                                                             '\r\n'.join(errors['feedback'])
-                    print(err_msg)
-                    self.notifier.submit(self.config.instructor_user, err_msg)
-                    continue
-
-                print('Checking whether feedback can be returned')
-                n_total = len(prep_results)
-                n_outstanding = len([p for p in prep_results if prep_results[p] == SubmissionStatus.NOT_DUE])
-                retfdbk_results = {}
-                if (n_total - n_outstanding)/n_total >= self.config.return_solution_threshold: 
-                    print('Threshold reached(' + str((n_total - n_outstanding)/n_total) + '>=' + str(self.config.return_solution_threshold)+'); this assignment is returnable')
-                    if plm.now() > plm.parse(self.config.earliest_solution_return_date, tz=self.course_info['time_zone']):
-                        retfdbk_results = self.process(Submission.return_feedback, submissions, {key : val for (key, val) in fbc_results.items() if posted_grades[key]}, SubmissionStatus.FEEDBACK_GENERATED)
-                    else:
-                        print('Earliest return date (' +self.config.earliest_solution_return_date + ') not passed yet. Skipping')
-                    
-                else:
-                    print('Threshold not reached (' + str((n_total - n_outstanding)/n_total) + '<' + str(self.config.return_solution_threshold)+'); this assignment is not yet returnable')
-
-                errors = {'retfeedback':  [sid +':\r\n' + str(submissions[sid].error) for sid in retfdbk_results if retfdbk_results[sid] == SubmissionStatus.ERROR]}
-                if any([len(v) > 0 for k, v in errors.items()]):
-                    print('Errors detected. Notifying instructor and stopping processing this assignment.') 
-                    err_msg = 'Errors detected in ' + asgn.name + ' processing. Action required.' + \
-        								     '\r\n FEEDBACK RETURN ERRORS:\r\n' + \
-                                                                             '\r\n'.join(errors['retfeedback'])
-                    print(err_msg)
-                    self.notifier.submit(self.config.instructor_user, err_msg)
-                    continue 
-               
-                #check if all grades are posted
-                print('Checking if all grades have been posted...')
-                if all([submissions[subm].grade_posted for subm in submissions]):
-                    print('All grades posted.')
-                elif any([submissions[subm].grade_uploaded and not submissions[subm].grade_posted  for subm in submissions]):
-                    print('There are unposted grades. Pinging instructor to post if today is an email day.')
-                    if plm.now().in_timezone(self.course_info['time_zone']).format('dddd') in self.config.notify_days:
-                        self.notifier.submit(self.config.instructor_user, 'Action Required: Post grades for assignment ' + asgn.name)
-                else:
-                    print('No unposted / uploaded grades, but not all grades posted yet. Waiting.')
-                  
-                #if asgn past due end
-            # loop over assignments end
-        # func base indentation
-        print('Sending notifications')
-        self.send_notifications()
-        return
+        print('Checking if any errors occurred and submitting error/failure notifications for instructors')
+        errors = {'uploading':  [sid +':\r\n' + str(submissions[sid].error) for sid in ul_results if ul_results[sid] == SubmissionStatus.ERROR],
+                  'feedback': [sid +':\r\n' + 'feedback generation failed previously' for sid in fb_results if fb_results[sid] == SubmissionStatus.FEEDBACK_FAILED_PREVIOUSLY] + 
+                                 [sid +':\r\n' + str(submissions[sid].error) for sid in fbc_results if fbc_results[sid] == SubmissionStatus.ERROR or fbc_results[sid] == SubmissionStatus.FEEDBACK_FAILED]
+                  }
+        if any([len(v) > 0 for k, v in errors.items()]):
+            print('Errors detected. Notifying instructor and stopping processing this assignment.') 
+            err_msg = 'Errors detected in ' + asgn.name + ' processing. Action required.' + \
+								     '\r\n GRADE UPLOAD ERRORS:\r\n' + \
+                                                                     '\r\n'.join(errors['uploading']) + \
+								     '\r\n FEEDBACK ERRORS:\r\n' + \
+                                                                     '\r\n'.join(errors['feedback']) + \
+                                                                     ('\r\n DOCKER START FAILURES:\r\n' + fb_report if fb_report is not None else '')
+            print(err_msg)
+            self.notifier.submit(self.config.instructor_user, err_msg)
+            return
+
+        print('Checking whether feedback can be returned')
+        n_total = len(prep_results)
+        n_outstanding = len([p for p in prep_results if prep_results[p] == SubmissionStatus.NOT_DUE])
+        retfdbk_results = {}
+        if (n_total - n_outstanding)/n_total >= self.config.return_solution_threshold: 
+            print('Threshold reached(' + str((n_total - n_outstanding)/n_total) + '>=' + str(self.config.return_solution_threshold)+'); this assignment is returnable')
+            if plm.now() > plm.parse(self.config.earliest_solution_return_date, tz=self.course_info['time_zone']):
+                retfdbk_results = self.process(Submission.return_feedback, submissions, {key : val for (key, val) in fbc_results.items() if posted_grades(key)}, SubmissionStatus.FEEDBACK_GENERATED)
+            else:
+                print('Earliest return date (' +self.config.earliest_solution_return_date + ') not passed yet. Skipping')
+            
+        else:
+            print('Threshold not reached (' + str((n_total - n_outstanding)/n_total) + '<' + str(self.config.return_solution_threshold)+'); this assignment is not yet returnable')
+
+        errors = {'retfeedback':  [sid +':\r\n' + str(submissions[sid].error) for sid in retfdbk_results if retfdbk_results[sid] == SubmissionStatus.ERROR]}
+        if any([len(v) > 0 for k, v in errors.items()]):
+            print('Errors detected. Notifying instructor and stopping processing this assignment.') 
+            err_msg = 'Errors detected in ' + asgn.name + ' processing. Action required.' + \
+								     '\r\n FEEDBACK RETURN ERRORS:\r\n' + \
+                                                                     '\r\n'.join(errors['retfeedback'])
+            print(err_msg)
+            self.notifier.submit(self.config.instructor_user, err_msg)
+            return 
+       
+        #check if all grades are posted
+        print('Checking if all grades have been posted...')
+        if all([submissions[subm].grade_posted for subm in submissions]):
+            print('All grades posted.')
+        elif any([submissions[subm].grade_uploaded and not submissions[subm].grade_posted  for subm in submissions]):
+            print('There are unposted grades. Pinging instructor to post if today is an email day.')
+            if plm.now().in_timezone(self.course_info['time_zone']).format('dddd') in self.config.notify_days:
+                self.notifier.submit(self.config.instructor_user, 'Action Required: Post grades for assignment ' + asgn.name)
+        else:
+            print('No unposted / uploaded grades, but not all grades posted yet. Waiting.')
+          
  
     def send_notifications(self):
         self.notifier.connect()
-        self.notifier.notify_all()
-        self.notifier.close()
+        try:
+            self.notifier.notify_all()
+        finally:
+            self.notifier.close()
 
     def search_students(self, name = None, canvas_id = None, sis_id = None, max_return = 5):
         #get exact matches for IDs
@@ -0,0 +1,299 @@
+import os
+import json
+import time
+import heapq
+import signal
+import socket
+import threading
+import traceback
+import socketserver
+import pendulum as plm
+from .course import Course, load_config
+from .coordinator import RunCoordinator, RunLock, LOCK_GROUPS
+
+class DaemonError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+class Daemon(object):
+    """
+    Long-running alternative to the cron jobs: keeps one Course (canvas state, docker/zfs/hub interfaces) alive
+    and runs every task from an internal schedule (grading runs build their own Course, see _task_run). Snapshots are taken at each assignment/override due time
+    (plus a periodic sweep), while canvas syncs, late registration extensions, grading and notifications run on
+    their own intervals. Each lock group's tasks run on their own worker thread, so e.g. a due-time snapshot isn't held
+    up by a grading run. Tasks go through the run coordinator, so they don't overlap with any cron-launched
+    commands and show up in `rudaux runs`. A unix socket accepts on-demand runs and status queries (see `rudaux ctl`).
+    """
+
+    tasks = ['sync', 'snapshot', 'extend_lateregs', 'run', 'notify']
+
+    def __init__(self, course_dir, dry_run = False):
+        self.course_dir = course_dir
+        self.dry_run = dry_run
+        self.config = load_config(course_dir)
+        self.intervals = {'sync' : 60*self.config.daemon_sync_minutes,
+                          'snapshot' : 60*self.config.daemon_snapshot_minutes,
+                          'extend_lateregs' : 3600*self.config.daemon_latereg_hours,
+                          'run' : 3600*self.config.daemon_grading_hours,
+                          'notify' : 60*self.config.daemon_notify_minutes}
+        self.coordinator = RunCoordinator(self.config, course_dir)
+        #heap of (time, seq, task); the set tracks what's already scheduled at which time so due-time ticks aren't duplicated
+        self.schedule = []
+        self.scheduled = set()
+        #the time of the recurring entry of each task (on-demand runs and due-time snapshot ticks are extra entries)
+        self.periodic = {}
+        self.seq = 0
+        self.lock = threading.Condition()
+        self.stopping = False
+        #lock group -> (task, worker thread) for every task that is currently running
+        self.workers = {}
+        #canvas syncs replace the course's canvas state, so only one task syncs at a time
+        self.sync_lock = threading.Lock()
+        self.last_runs = {}
+        self.course = None
+        self.server = None
+
+    def run_forever(self):
+        #only one daemon per course
+        daemon_lock = RunLock(self.coordinator.lock_path('daemon'))
+        if not daemon_lock.try_acquire('daemon'):
+            holder = daemon_lock.holder()
+            raise DaemonError('Another rudaux daemon is already running for this course: ' + self.coordinator.describe(holder))
+        try:
+            print('Starting rudaux daemon')
+            self.course = Course(self.course_dir, dry_run = self.dry_run, allow_canvas_cache = True, config = self.config, full_sync = False)
+            self.last_runs['sync'] = time.time()
+            self._schedule_initial()
+            self._start_control_socket()
+            if threading.current_thread() is threading.main_thread():
+                signal.signal(signal.SIGTERM, lambda signum, frame : self.stop())
+                signal.signal(signal.SIGINT, lambda signum, frame : self.stop())
+            self._loop()
+        finally:
+            self._join_workers()
+            self._stop_control_socket()
+            daemon_lock.release()
+            print('rudaux daemon stopped')
+
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+            self.lock.notify_all()
+
+    #=======================================#
+    #              Scheduling               #
+    #=======================================#
+
+    def enqueue(self, task, when = None):
+        when = time.time() if when is None else when
+        with self.lock:
+            if (task, when) in self.scheduled:
+                return
+            self.scheduled.add((task, when))
+            heapq.heappush(self.schedule, (when, self.seq, task))
+            self.seq += 1
+            self.lock.notify_all()
+
+    def _last_success(self, command):
+        #when this command last finished successfully (from the run history), so restarts don't reset the intervals
+        for cmd, group, pid, started_at, duration, outcome, error in self.coordinator.history.recent(200):
+            if cmd == command and outcome == 'success':
+                return started_at
+        return None
+
+    def _schedule_periodic(self, task, when):
+        with self.lock:
+            self.periodic[task] = when
+        self.enqueue(task, when)
+
+    def _schedule_initial(self):
+        now = time.time()
+        for task in ['extend_lateregs', 'run', 'notify']:
+            last = self._last_success(task)
+            self._schedule_periodic(task, now if last is None else max(now, last + self.intervals[task]))
+        self._schedule_periodic('snapshot', now)
+        self._schedule_periodic('sync', now + self.intervals['sync'])
+        self._schedule_next_snapshot()
+
+    def _schedule_next_snapshot(self):
+        #a snapshot tick right after the next due time (take_snapshots only snapshots things that are strictly past due);
+        #each tick schedules the one after it
+        next_due = self.course.due_timeline.next_due(time.time())
+        if next_due is not None:
+            self.enqueue('snapshot', next_due + self.config.daemon_snapshot_delay)
+
+    def _group(self, task):
+        return LOCK_GROUPS.get(task, task)
+
+    def _loop(self):
+        #hand each due task to a worker thread; a task waits in the schedule while another task of its lock group runs
+        #(it would only wait for the lock anyway), but never behind a task of another group
+        while True:
+            with self.lock:
+                if self.stopping:
+                    return
+                now = time.time()
+                ready = [entry for entry in self.schedule if entry[0] <= now and self._group(entry[2]) not in self.workers]
+                if len(ready) == 0:
+                    pending = [entry[0] for entry in self.schedule if self._group(entry[2]) not in self.workers]
+                    timeout = 60 if len(pending) == 0 else min(min(pending) - now, 60)
+                    self.lock.wait(timeout = timeout)
+                    continue
+                task = min(ready)[2]
+                #several ticks for the same task can come due at once (e.g. many overrides due at the same time); run it once
+                whens = [entry[0] for entry in self.schedule if entry[0] <= now and entry[2] == task]
+                self.schedule = [entry for entry in self.schedule if not (entry[0] <= now and entry[2] == task)]
+                heapq.heapify(self.schedule)
+                for w in whens:
+                    self.scheduled.discard((task, w))
+                periodic = self.periodic.get(task) in whens
+                worker = threading.Thread(target = self._work, args = (task, periodic), name = 'rudaux-daemon-' + task, daemon = True)
+                self.workers[self._group(task)] = (task, worker)
+            worker.start()
+
+    def _work(self, task, periodic):
+        try:
+            self._run_task(task)
+            if periodic:
+                #for snapshots, this is a sweep in case a due time tick was missed (e.g. the zfs snapshot failed)
+                self._schedule_periodic(task, time.time() + self.intervals[task])
+            if task in ['sync', 'snapshot', 'extend_lateregs', 'run']:
+                #due dates/overrides may have changed (these resync canvas), or we just used up the next tick
+                self._schedule_next_snapshot()
+        except Exception as e:
+            print('Error rescheduling daemon task ' + task)
+            print(traceback.format_exc())
+        finally:
+            with self.lock:
+                self.workers.pop(self._group(task), None)
+                self.lock.notify_all()
+
+    def _join_workers(self):
+        #let running tasks finish before shutting down
+        with self.lock:
+            threads = [worker for task, worker in self.workers.values()]
+        if len(threads) > 0:
+            print('Waiting for ' + str(len(threads)) + ' running daemon tasks to finish')
+        for thread in threads:
+            thread.join()
+
+    #=======================================#
+    #                Tasks                  #
+    #=======================================#
+
+    def _run_task(self, task):
+        print('Daemon running task ' + task + ' at ' + str(plm.now().in_timezone(self.course.course_info['time_zone'])))
+        start = time.time()
+        try:
+            with self.coordinator.run(task) as go:
+                if go:
+                    getattr(self, '_task_' + task)()
+        except Exception as e:
+            print('Error in daemon task ' + task)
+            print(traceback.format_exc())
+        with self.lock:
+            self.last_runs[task] = start
+        print('Daemon task ' + task + ' done in ' + str(round(time.time() - start, 1)) + ' seconds')
+
+    def _task_sync(self):
+        #only refetches what changed (with a full sync every canvas_full_sync_hours); grading/extensions do full syncs
+        with self.sync_lock:
+            self.course.synchronize_canvas(allow_cache = True, full = False)
+
+    def _task_snapshot(self):
+        #pick up snapshots taken by anything else (e.g. a manual `rudaux snapshot`)
+        self.course.load_snapshots()
+        self.course.take_snapshots()
+
+    def _task_extend_lateregs(self):
+        #extensions change overrides, so no other sync may replace the canvas state partway through
+        with self.sync_lock:
+            self.course.synchronize_canvas(allow_cache = False)
+            self.course.apply_latereg_extensions()
+
+    def _task_run(self):
+        #grading takes hours, during which the sync worker keeps replacing the shared course's canvas state; so, like a
+        #cron-launched `rudaux run`, grade with a private Course built from a fresh full sync
+        course = Course(self.course_dir, dry_run = self.dry_run, config = self.config)
+        try:
+            course.grading_workflow()
+            print(course.canvas.request_report())
+        finally:
+            course.canvas.close()
+
+    def _task_notify(self):
+        self.course.send_notifications()
+
+    def status(self):
+        with self.lock:
+            upcoming = sorted([(w, t) for (t, w) in self.scheduled])[:20]
+            return {'pid' : os.getpid(),
+                    'current_tasks' : sorted([task for task, worker in self.workers.values()]),
+                    'last_runs' : {t : str(plm.from_timestamp(w).in_timezone('local')) for t, w in self.last_runs.items()},
+                    'upcoming' : [[t, str(plm.from_timestamp(w).in_timezone('local'))] for w, t in upcoming]}
+
+    #=======================================#
+    #            Control socket             #
+    #=======================================#
+
+    def _start_control_socket(self):
+        path = self.config.daemon_socket
+        if os.path.exists(path):
+            #we hold the daemon lock, so nobody else is listening on it
+            os.remove(path)
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline().decode('utf-8'))
+                    response = daemon.handle_request(request)
+                except Exception as e:
+                    response = {'ok' : False, 'error' : str(e)}
+                self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+        self.server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        #only the user running the daemon (i.e. root, usually) may control it
+        os.chmod(path, 0o600)
+        threading.Thread(target = self.server.serve_forever, name = 'rudaux-daemon-control', daemon = True).start()
+        print('Listening for control commands on ' + path)
+
+    def _stop_control_socket(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            if os.path.exists(self.config.daemon_socket):
+                os.remove(self.config.daemon_socket)
+            self.server = None
+
+    def handle_request(self, request):
+        command = request.get('command')
+        if command == 'status':
+            return {'ok' : True, 'status' : self.status()}
+        if command == 'stop':
+            self.stop()
+            return {'ok' : True}
+        if command in self.tasks:
+            self.enqueue(command)
+            return {'ok' : True, 'queued' : command}
+        return {'ok' : False, 'error' : 'Unknown command ' + str(command) + '; expected one of ' + ', '.join(self.tasks + ['status', 'stop'])}
+
+def send_command(socket_path, command, timeout = 10):
+    #talk to a running daemon over its control socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        raise DaemonError('No rudaux daemon is listening on ' + socket_path)
+    try:
+        sock.sendall((json.dumps({'command' : command}) + '\n').encode('utf-8'))
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return json.loads(data.decode('utf-8'))
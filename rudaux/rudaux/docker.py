@@ -1,139 +1,750 @@
 import docker
+import os
 import time
+import heapq
+import random
+import threading
+from collections import deque
+import traceback
+from .history import JobHistory, parse_memory
+from .jobstore import JobStore, job_identity, pid_alive
+from .utils import available_memory
 
 class DockerError(Exception):
     def __init__(self, message, docker_output):
         self.message = message
         self.docker_output = docker_output
 
+def default_client_factory(url):
+    #url None means the local daemon configured by the environment (DOCKER_HOST etc)
+    if url is None:
+        return docker.from_env()
+    return docker.DockerClient(base_url = url)
+
+class DockerHost(object):
+    """
+    One docker daemon that grading jobs can run on, with a fixed number of container slots.
+    Grader/student folders must be visible on the host at the same path, or at the path given by
+    path_map (local prefix -> prefix on the host), e.g. via an NFS mount.
+    """
+
+    def __init__(self, url, slots, client_factory, path_map = None):
+        self.url = url
+        self.slots = slots
+        self.client_factory = client_factory
+        self.path_map = path_map if path_map is not None else {}
+        self.client = None
+        self.healthy = False
+        self.last_check = 0.
+        self.running = 0
+        self.check()
+
+    def name(self):
+        return self.url if self.url is not None else 'local'
+
+    def check(self):
+        #(re)connect if needed and ping the daemon
+        self.last_check = time.time()
+        try:
+            if self.client is None:
+                self.client = self.client_factory(self.url)
+            self.client.ping()
+            self.healthy = True
+        except Exception as e:
+            print('Docker host ' + self.name() + ' failed health check: ' + str(e))
+            self.client = None
+            self.healthy = False
+        return self.healthy
+
+    def map_path(self, path):
+        for local, remote in self.path_map.items():
+            local = local.rstrip('/')
+            if path == local or path.startswith(local + '/'):
+                return remote.rstrip('/') + path[len(local):]
+        return path
+
+class CircuitBreaker(object):
+    """
+    Pauses all container starts for a cooldown period when too many recent starts have failed
+    (e.g. the daemon is unhealthy), instead of burning through every queued job's attempts.
+    After the cooldown a single trial start is let through: if it works the breaker closes again,
+    otherwise it reopens with a doubled cooldown. Once it has reopened max_reopens times, or has not been closed for
+    max_open seconds, tripped() says so and the scheduler gives up on the jobs that are waiting to start.
+    """
+
+    def __init__(self, window = 60, min_attempts = 10, max_failure_rate = 0.5, cooldown = 30, max_cooldown = 300,
+                 max_reopens = 3, max_open = 600):
+        self.window = window
+        self.min_attempts = min_attempts
+        self.max_failure_rate = max_failure_rate
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_reopens = max_reopens
+        self.max_open = max_open
+        self.cooldown = cooldown
+        self.attempts = deque()
+        self.state = 'closed'
+        self.open_until = 0.
+        self.opened_at = None
+        self.reopens = 0
+        self.trial_running = False
+
+    def allow(self):
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and time.time() >= self.open_until:
+            print('Docker circuit breaker half-open; trying one container start')
+            self.state = 'half_open'
+        if self.state == 'half_open' and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+
+    def record(self, success):
+        now = time.time()
+        if self.state == 'half_open':
+            self.trial_running = False
+            if success:
+                print('Docker circuit breaker closed; resuming container starts')
+                self.reset()
+            else:
+                self.cooldown = min(2*self.cooldown, self.max_cooldown)
+                self.reopens += 1
+                self._open(now)
+            return
+        self.attempts.append((now, success))
+        while len(self.attempts) > 0 and self.attempts[0][0] < now - self.window:
+            self.attempts.popleft()
+        n_failed = len([a for a in self.attempts if not a[1]])
+        if self.state == 'closed' and len(self.attempts) >= self.min_attempts and n_failed > self.max_failure_rate*len(self.attempts):
+            self._open(now)
+
+    def _open(self, now):
+        print('Docker circuit breaker open: too many container start failures; pausing container starts for ' + str(self.cooldown) + ' seconds')
+        self.state = 'open'
+        self.open_until = now + self.cooldown
+        if self.opened_at is None:
+            self.opened_at = now
+
+    def tripped(self, now):
+        #true if starts have kept failing for long enough that waiting jobs should be given up on
+        return self.state != 'closed' and (self.reopens >= self.max_reopens or now - self.opened_at > self.max_open)
+
+    def reset(self):
+        self.state = 'closed'
+        self.cooldown = self.base_cooldown
+        self.attempts.clear()
+        self.opened_at = None
+        self.reopens = 0
+        self.trial_running = False
+
 class Docker(object):
 
-    def __init__(self, config, dry_run):
-        self.client = docker.from_env()
+    #jobs are started in order of job type first (lower runs first), then most recently due assignment first,
+    #then longest estimated runtime first (so long jobs don't end up alone at the tail of the batch). Runtimes are learned
+    #per (assignment, job type), so among the jobs of one assignment and type the largest submission goes first instead.
+    #probe jobs (quick queries such as listing the gradebook's assignments) run first and are left out of the estimates
+    job_type_priority = {'probe' : 0, 'generate' : 0, 'autograde' : 1, 'feedback' : 2}
+    untimed_job_types = ['probe']
+    default_job_type_priority = 1
+    #weight of the newest job duration in the runtime estimate (exponential moving average)
+    runtime_ema_weight = 0.3
+    #adaptive mode: seconds between concurrency adjustments, and how long to hold off growing after an OOM kill
+    adjust_every = 15
+    oom_backoff = 120
+    #attempts to start each job (on any host) before giving up, seconds between health checks of down hosts,
+    #and how long every host may be down before queued jobs are failed
+    max_tries = 5
+    health_check_every = 30
+    host_down_timeout = 300
+    #failed starts are retried after a jittered exponential backoff (seconds): base * 2^(tries-1), capped, +/- 50%
+    backoff_base = 5.
+    backoff_cap = 120.
+    #a running container that can't be refreshed this many times in a row (while its host is healthy) is treated as lost
+    max_reload_failures = 5
+    #failed starts in these categories are given up on right away, since another attempt would fail the same way
+    non_retryable = ['image_not_found']
+    #only these jobs go in the on-disk job store (and so get re-attached / have their results recovered after a crash);
+    #everything else, e.g. probe queries whose answer may have changed since, always runs again
+    persisted_job_types = ['autograde', 'feedback']
+    #results left behind by a dead rudaux process are only handed out if they are at most this old (seconds)
+    result_max_age = 24*3600
+
+    def __init__(self, config, dry_run, client_factory = default_client_factory):
+        #client_factory(url) -> docker client; swap it out to run against a fake backend
         self.image = config.grading_image
         self.dry_run = dry_run
-        self.n_threads = config.num_docker_threads
+        self.course_name = config.name
+        #in adaptive mode, n_threads is the current (moving) limit on concurrent containers
+        #(load/memory are measured on this machine, so this only applies when running on the local daemon)
+        self.adaptive = config.docker_adaptive and config.docker_hosts is None
+        self.min_threads = max(1, config.min_docker_threads)
+        self.max_threads = max(self.min_threads, config.max_docker_threads)
+        if config.docker_hosts is None:
+            #in adaptive mode the local host gets room for max_threads containers, so that n_threads alone sets the limit
+            self.hosts = [DockerHost(None, self.max_threads if self.adaptive else config.num_docker_threads, client_factory)]
+            self.n_threads = config.num_docker_threads
+        else:
+            self.hosts = [DockerHost(h['url'], h['slots'], client_factory, h.get('path_map')) for h in config.docker_hosts]
+            self.n_threads = sum([h.slots for h in self.hosts])
+        self.all_down_since = None
+        if self.adaptive:
+            self.n_threads = min(max(self.n_threads, self.min_threads), self.max_threads)
+        self.n_cores = os.cpu_count()
+        self.last_adjust = time.time()
+        self.last_oom = None
         self.mem_per_thread = config.docker_memory
         self.jobs = {}
+        self.queue = []
+        #jobs waiting out a retry backoff: heap of (not_before time, job seq, key)
+        self.delayed = []
+        self.breaker = CircuitBreaker()
+        #result of the most recent failed container start, for the report when the breaker gives up on queued jobs
+        self.last_start_failure = None
+        self.running = {}
+        self.running_hosts = {}
+        #consecutive failed refreshes of each running container while its host is healthy
+        self.reload_failures = {}
+        self.results = {}
+        self.start_times = {}
         self.job_id = 0
         self.runsts = ['running', 'created']
+        #guards jobs/queue/running/results; waiters are notified whenever a job finishes
+        self.lock = threading.Condition()
+        self.pool_thread = None
+        self.pool_stop = False
+        self.print_every = 30
+        #peak memory use of running containers (sampled from container stats every stats_every seconds)
+        self.peak_memory = {}
+        self.stats_times = {}
+        self.stats_every = 5
+        #wall time, peak memory and exit status of every finished job, keyed by (assignment, job type)
+        self.history = JobHistory(os.path.join(config.docker_state_dir, config.name + '_docker_history.db'))
+        self.mem_per_thread_bytes = parse_memory(self.mem_per_thread)
+        #runtime estimates (seconds) learned from past runs, keyed by (assignment, job type)
+        self.runtime_estimates = self.history.runtime_estimates()
+        #the job queue is mirrored on disk so that a restarted rudaux can pick up where a killed one left off
+        self.store = JobStore(os.path.join(config.docker_state_dir, config.name + '_docker_jobs.db'))
+        #recover() is only run by the grading workflow, not by every command that creates a Docker interface
+        self.recovered = False
 
-    def submit(self, command, homedir = None):
-        key = 'job-' + str(self.job_id)
-        self.jobs[key] = {'command': command, 'homedir' : homedir}
-        self.job_id += 1
+    def _persist(self, method, *args):
+        #keep the on-disk job queue in sync; a failure here shouldn't take down the batch
+        if self.dry_run:
+            return
+        try:
+            getattr(self.store, method)(*args)
+        except Exception as e:
+            print('Failed to update the docker job store (' + method + '): ' + str(e))
+
+    def recover(self):
+        #re-attach to containers started by a previous rudaux process that died, collect the results it left behind,
+        #and remove rudaux containers for this course that no job (of ours or of another live rudaux process) owns
+        #only call this from the grading path (it removes containers), before submitting jobs; later calls do nothing
+        if self.dry_run or self.recovered:
+            return
+        self.recovered = True
+        #list the containers before reading the job store: every container's job row is written before it is started,
+        #so a container that another process starts meanwhile always has a row we can see
+        host_ctrs = []
+        for host in self.hosts:
+            if not host.healthy:
+                continue
+            try:
+                host_ctrs.append((host, host.client.containers.list(all = True, filters = {'label' : 'rudaux.course=' + self.course_name})))
+            except Exception as e:
+                print('Failed to list containers on docker host ' + host.name() + ': ' + str(e))
+        #identities of jobs that are owned by a live process, whatever their status (queued, running, ...)
+        known = set()
+        hosts = {h.url : h for h in self.hosts}
+        now = time.time()
+        for row in self.store.jobs():
+            key = 'job-' + row['identity']
+            if (row['owner_pid'] == os.getpid() and key in self.jobs) or (row['owner_pid'] != os.getpid() and pid_alive(row['owner_pid'])):
+                #another rudaux process (or this one) is still working on this one
+                known.add(row['identity'])
+                continue
+            if row['job_type'] not in self.persisted_job_types:
+                #left behind by an older rudaux that stored every job
+                self.store.remove(row['identity'])
+                continue
+            job = {'command' : row['command'], 'homedir' : row['homedir'], 'job_type' : row['job_type'], 'assignment' : row['assignment'],
+                   'due_at' : row['due_at'], 'identity' : row['identity'], 'seq' : self.job_id, 'tries' : 0}
+            if row['status'] == 'finished' and now - row['updated_at'] <= self.result_max_age:
+                print('Recovered result of docker job ' + key + ' (' + row['command'] + ') from a previous run')
+                self.jobs[key] = job
+                self.results[key] = {'exit_status' : row['exit_status'], 'log' : row['log']}
+                self.job_id += 1
+                known.add(row['identity'])
+                continue
+            host = hosts.get(row['host_url'])
+            if row['status'] == 'running' and host is not None and host.healthy:
+                try:
+                    ctr = host.client.containers.get(row['container_id'])
+                except Exception as e:
+                    ctr = None
+                if ctr is not None:
+                    print('Re-attaching to container ' + ctr.id[:12] + ' for docker job ' + key + ' (' + row['command'] + ')')
+                    self.jobs[key] = job
+                    self.running[key] = ctr
+                    self.running_hosts[key] = host
+                    self.start_times[key] = row['updated_at']
+                    host.running += 1
+                    self.job_id += 1
+                    known.add(row['identity'])
+                    self.store.started(row['identity'], ctr.id, host.url)
+                    continue
+            #queued, lost, or stale: it will just get submitted again
+            self.store.remove(row['identity'])
+        for host, ctrs in host_ctrs:
+            for ctr in ctrs:
+                #jobs that aren't in the store (e.g. probes) are recognized by the pid of the rudaux process that started them
+                owner = ctr.labels.get('rudaux.pid')
+                if owner is not None and int(owner) != os.getpid() and pid_alive(int(owner)):
+                    continue
+                if ctr.labels.get('rudaux.job') not in known:
+                    print('Removing orphaned rudaux container ' + ctr.id[:12] + ' (job ' + str(ctr.labels.get('rudaux.job')) + ') on docker host ' + host.name())
+                    try:
+                        ctr.remove(force = True)
+                    except Exception as e:
+                        print('Failed to remove container ' + ctr.id[:12] + ': ' + str(e))
+
+    def has_job(self, command, homedir = None):
+        #true if this job is already queued/running (e.g. re-attached by recover) or has a result waiting to be collected
+        with self.lock:
+            return 'job-' + job_identity(command, homedir) in self.jobs
+
+    def estimate_runtime(self, assignment, job_type):
+        #fall back to the average over all assignments for this job type if we haven't seen this assignment before
+        est = self.runtime_estimates.get((assignment, job_type))
+        if est is None:
+            ests = [v for (a, jt), v in self.runtime_estimates.items() if jt == job_type]
+            est = sum(ests)/len(ests) if len(ests) > 0 else 0.
+        return est
+
+    def _record_runtime(self, job, duration):
+        if job['job_type'] in self.untimed_job_types:
+            return
+        key = (job['assignment'], job['job_type'])
+        old = self.runtime_estimates.get(key)
+        self.runtime_estimates[key] = duration if old is None else (1-self.runtime_ema_weight)*old + self.runtime_ema_weight*duration
+
+    def _sample_memory(self, key, ctr):
+        #stats are only available while the container runs, so sample periodically and keep the max
+        if time.time() - self.stats_times.get(key, 0.) < self.stats_every:
+            return
+        self.stats_times[key] = time.time()
+        try:
+            try:
+                stats = ctr.stats(stream = False, one_shot = True)
+            except TypeError:
+                #older docker SDKs don't have one_shot
+                stats = ctr.stats(stream = False)
+            mem = stats.get('memory_stats', {})
+            #max_usage is only reported on cgroup v1 hosts
+            usage = max(mem.get('max_usage', 0), mem.get('usage', 0))
+        except Exception as e:
+            return
+        if usage > self.peak_memory.get(key, 0):
+            self.peak_memory[key] = usage
+
+    def _adjust_concurrency(self):
+        #additive increase / multiplicative decrease of the container limit:
+        #halve after an OOM kill, drop by one when the host is overloaded or short on memory,
+        #and add one when there is queued work and the host has spare cores and memory for another container
+        now = time.time()
+        if not self.adaptive or now - self.last_adjust < self.adjust_every:
+            return
+        since = self.last_adjust
+        self.last_adjust = now
+        load = os.getloadavg()[0]
+        try:
+            mem = available_memory()
+        except Exception as e:
+            mem = None
+        with self.lock:
+            old = self.n_threads
+            if self.last_oom is not None and self.last_oom > since:
+                self.n_threads = max(self.min_threads, self.n_threads // 2)
+                reason = 'container killed for running out of memory'
+            elif load > self.n_cores or (mem is not None and mem < self.mem_per_thread_bytes):
+                self.n_threads = max(self.min_threads, self.n_threads - 1)
+                reason = 'host overloaded'
+            elif (len(self.queue) > 0 and len(self.running) >= self.n_threads
+                    and load < self.n_cores - 1
+                    and (mem is None or mem > 2*self.mem_per_thread_bytes)
+                    and (self.last_oom is None or now - self.last_oom > self.oom_backoff)):
+                self.n_threads = min(self.max_threads, self.n_threads + 1)
+                reason = 'spare capacity'
+            if self.n_threads != old:
+                print('Docker concurrency ' + str(old) + ' -> ' + str(self.n_threads) + ' (' + reason + '; load ' + str(round(load, 2))
+                        + ', ' + (str(mem // 1024**2) + 'MB' if mem is not None else 'unknown memory') + ' available)')
+
+    def _record_history(self, job, ctr, started_at, duration, peak_memory):
+        state = ctr.attrs.get('State', {})
+        try:
+            self.history.record(job['assignment'], job['job_type'], job['command'], started_at, duration,
+                                peak_memory, state.get('ExitCode'), state.get('OOMKilled', False))
+        except Exception as e:
+            print('Failed to record docker job history: ' + str(e))
+
+    def priority(self, job):
+        return (self.job_type_priority.get(job['job_type'], self.default_job_type_priority),
+                -job['due_at'] if job['due_at'] is not None else 0.,
+                -self.estimate_runtime(job['assignment'], job['job_type']),
+                -(job.get('size') or 0))
+
+    def submit(self, command, homedir = None, job_type = None, assignment = None, due_at = None, size = None):
+        #job_type is one of job_type_priority's keys; due_at is the (assignment-level) due date of the job's assignment;
+        #size (e.g. bytes of the submitted notebook) breaks ties between jobs with the same runtime estimate, largest first
+        #a job's key is derived from its command and homedir, so submitting a job that is already queued/running
+        #(e.g. re-attached after a restart) or has a recovered result just hands back that job
+        identity = job_identity(command, homedir)
+        key = 'job-' + identity
+        with self.lock:
+            if key in self.jobs:
+                return key
+            self.jobs[key] = {'command': command, 'homedir' : homedir, 'job_type' : job_type, 'assignment' : assignment,
+                              'due_at' : due_at.timestamp() if due_at is not None else None, 'identity' : identity,
+                              'size' : size, 'seq' : self.job_id, 'tries' : 0}
+            if job_type in self.persisted_job_types:
+                self._persist('add', identity, self.jobs[key])
+            heapq.heappush(self.queue, (self.priority(self.jobs[key]), self.job_id, key))
+            self.job_id += 1
+            self.lock.notify_all()
         return key
 
-    def run(self, command, homedir = None):
-        ctr, result = self._run_container(command, homedir)
-        if ctr:
-            while ctr.status in self.runsts:
-                time.sleep(0.25)
-                ctr.reload()
-            result['exit_status'] = ctr.status
-            result['log'] = ctr.logs(stdout = True, stderr = True).decode('utf-8')
-            ctr.remove()
-        return result
+    def run(self, command, homedir = None, job_type = None, assignment = None, due_at = None):
+        #run a single command and block until it's done (goes through the same pool as everything else)
+        key = self.submit(command, homedir, job_type, assignment, due_at)
+        return self.wait([key])[key]
 
     def run_all(self):
-        print('Docker running ' + str(len(self.jobs)) + ' jobs')
-        results = {}
-        running = {}
-        print_every = 30
-        job_keys = [key for key in self.jobs]
-        while len(running) > 0 or len(job_keys) > 0:
-
-            # sleep while we have reached max threads and all running
-            time_since_print = 0
-            while len(running) >= self.n_threads and all([running[k].status in self.runsts for k in running]):
+        with self.lock:
+            keys = list(self.jobs.keys())
+        print('Docker running ' + str(len(keys)) + ' jobs')
+        return self.wait(keys)
+
+    def wait(self, keys):
+        #block until all the given jobs are finished and return their results
+        #if the pool thread is running it does the work; otherwise we drive the scheduler from this thread
+        keys = list(keys)
+        time_since_print = 0
+        while True:
+            with self.lock:
+                if all([k in self.results for k in keys]):
+                    results = {k : self.results.pop(k) for k in keys}
+                    for k in keys:
+                        job = self.jobs.pop(k, None)
+                        if job is not None:
+                            self._persist('remove', job['identity'])
+                    done = True
+                else:
+                    done = False
+                pooled = self.pool_thread is not None
+                if pooled and not done:
+                    self.lock.wait(timeout = 0.25)
+            if done:
+                report = self.never_started_report(results)
+                if report is not None:
+                    print(report)
+                return results
+            if not pooled:
+                self._step()
                 time.sleep(0.25)
-                time_since_print += 0.25
-                for k in running:
-                    running[k].reload()
-                if time_since_print >= print_every:
-                    print('Jobs still running: ' + str(list(running.keys())))
-                    time_since_print = 0
-
-            # refresh the status of all running containers (we may have not made it into the above loop)
-            for k in running:
-                running[k].reload()
-
-            # clean out nonrunning containers
-            to_pop = []
-            for k in running:
-                if running[k].status not in self.runsts:
-                    results[k]['exit_status'] = running[k].status
-                    results[k]['log'] = running[k].logs(stdout = True, stderr = True).decode('utf-8')
-                    running[k].remove()
-                    to_pop.append(k)
-            for k in to_pop:
-                running.pop(k, None)
-
-            # add a new container if there are any remaining
-            if len(job_keys) > 0:
-                assert len(running) < self.n_threads
-                key = job_keys.pop()
-                print('Running ' + str(key) +': ' + self.jobs[key]['command'] + ' in ' + self.jobs[key]['homedir'])
-                results[key] = {}
-                ctr, results[key] = self._run_container(self.jobs[key]['command'], self.jobs[key]['homedir'])
-                if ctr:
-                    running[key] = ctr
+            time_since_print += 0.25
+            if time_since_print >= self.print_every:
+                with self.lock:
+                    print('Jobs still running: ' + str(list(self.running.keys())) + '; ' + str(len(self.queue)) + ' jobs queued; '
+                            + str(len(self.delayed)) + ' jobs waiting to retry')
+                time_since_print = 0
 
-        # clear the commands queue when done
-        self.jobs = {} 
+    def start_pool(self):
+        #run the scheduler in a background thread so that several callers (e.g. one per assignment) can share the containers
+        with self.lock:
+            if self.pool_thread is not None:
+                return
+            self.pool_stop = False
+            self.pool_thread = threading.Thread(target = self._pool_loop, name = 'rudaux-docker-pool', daemon = True)
+            self.pool_thread.start()
 
-        return results
+    def stop_pool(self):
+        #finishes any jobs that were already submitted before returning
+        with self.lock:
+            thread = self.pool_thread
+            self.pool_stop = True
+            self.lock.notify_all()
+        if thread is not None:
+            thread.join()
+        with self.lock:
+            self.pool_thread = None
 
-    def _run_container(self, command, homedir, n_tries = 5):
-        ctr = None
-        result = {}
-        while ctr is None and n_tries > 0:
-            n_tries -= 1
+    def _pool_loop(self):
+        while True:
+            with self.lock:
+                if self.pool_stop and len(self.queue) == 0 and len(self.delayed) == 0 and len(self.running) == 0:
+                    return
+                if len(self.queue) == 0 and len(self.delayed) == 0 and len(self.running) == 0:
+                    self.lock.wait(timeout = 0.25)
+                    continue
             try:
-                if not self.dry_run:
-                    ctr = self.client.containers.run(self.image, command,
-                                                          detach = True,
-                                                          remove = False,
-                                                          stderr = True,
-                                                          stdout = True,
-                                                          mem_limit = self.mem_per_thread,
-                                                          volumes = {homedir : {'bind': '/home/jupyter', 'mode': 'rw'}} if homedir else {}
-                                                          )
-                else:
-                    print('[Dry Run: would have started docker container with command: ' + command + ']')
-                    result['exit_status'] = 'dry_run'
-                    result['log'] = 'dry_run'
-            except docker.errors.APIError as e:
-                if n_tries == 0:
-                    print('Docker APIError exception encountered when starting docker container')
-                    print('Command: ' + command)
-                    print('Homedir: ' + homedir)
-                result['exit_status'] = 'never_started'
-                result['log'] = 'ERROR: Docker APIError, ' + str(e)
-                ctr = None
-                time.sleep(10.)
-                if n_tries > 0:
-                    print('Failed to start container. Attempting again; ' + str(n_tries) + ' attempts remaining.')
-            except docker.errors.ImageNotFound as e:
-                if n_tries == 0:
-                    print('Docker ImageNotFound exception encountered when starting docker container')
-                    print('Command: ' + command)
-                    print('Homedir: ' + homedir)
-                result['exit_status'] = 'never_started'
-                result['log'] = 'ERROR: Docker ImageNotFound, ' + str(e)
-                ctr = None
-                time.sleep(10.)
-                if n_tries > 0:
-                    print('Failed to start container. Attempting again; ' + str(n_tries) + ' attempts remaining.')
+                self._step()
+            except Exception as e:
+                print('Error in docker pool scheduler; continuing')
+                print(traceback.format_exc())
+            time.sleep(0.25)
+
+    def _check_hosts(self):
+        #re-check hosts that are down (at most every health_check_every seconds), and fail all queued jobs
+        #if every host has been down for longer than host_down_timeout
+        now = time.time()
+        for host in self.hosts:
+            if not host.healthy and now - host.last_check >= self.health_check_every:
+                if host.check():
+                    print('Docker host ' + host.name() + ' is back up')
+        if any([host.healthy for host in self.hosts]):
+            self.all_down_since = None
+            return
+        if self.all_down_since is None:
+            self.all_down_since = now
+        if now - self.all_down_since > self.host_down_timeout:
+            with self.lock:
+                waiting = self.queue + self.delayed
+                if len(waiting) > 0:
+                    print('No docker hosts have been reachable for ' + str(self.host_down_timeout) + ' seconds; failing ' + str(len(waiting)) + ' queued jobs')
+                for _, _, key in waiting:
+                    self.results[key] = self._never_started(key, 'no_healthy_hosts', 'ERROR: no healthy docker hosts')
+                self.queue = []
+                self.delayed = []
+                self.lock.notify_all()
+
+    def _check_breaker(self):
+        #if container starts have kept failing for long enough (even though the hosts answer health checks), fail the jobs
+        #waiting to start instead of letting them trickle through one trial start per cooldown; the breaker then starts
+        #over, so jobs submitted later get their own attempts
+        with self.lock:
+            if not self.breaker.tripped(time.time()):
+                return
+            waiting = self.queue + self.delayed
+            print('Docker container starts have kept failing; failing ' + str(len(waiting)) + ' queued jobs')
+            last = self.last_start_failure
+            log = 'ERROR: docker container starts kept failing' + (' (last error: ' + last['log'] + ')' if last is not None else '')
+            for _, _, key in waiting:
+                self.results[key] = self._never_started(key, 'circuit_open', log)
+            self.queue = []
+            self.delayed = []
+            self.breaker.reset()
+            self.lock.notify_all()
+
+    def _pick_host(self):
+        #least loaded healthy host (relative to its slot count) that has a free slot
+        free = [h for h in self.hosts if h.healthy and h.running < h.slots]
+        if len(free) == 0:
+            return None
+        return min(free, key = lambda h : h.running / h.slots)
+
+    def _never_started(self, key, category, log):
+        return {'exit_status' : 'never_started', 'log' : log, 'category' : category, 'command' : self.jobs[key]['command']}
+
+    def _retry_or_fail(self, key, result):
+        #put a job whose container never started (or whose host went away) on the backoff heap, unless it is out of attempts
+        job = self.jobs[key]
+        job['tries'] += 1
+        if job['tries'] < self.max_tries:
+            delay = min(self.backoff_cap, self.backoff_base * 2**(job['tries']-1)) * random.uniform(0.5, 1.5)
+            print('Job ' + key + ' did not run; retrying in ' + str(round(delay, 1)) + ' seconds (' + str(self.max_tries - job['tries']) + ' attempts remaining)')
+            heapq.heappush(self.delayed, (time.time() + delay, job['seq'], key))
+            self._persist('requeued', job['identity'])
+        else:
+            print('Giving up on job ' + key + ' after ' + str(self.max_tries) + ' attempts')
+            print('Command: ' + job['command'])
+            print('Homedir: ' + str(job['homedir']))
+            self.results[key] = result
+            self.lock.notify_all()
+
+    def _remove_container(self, ctr):
+        #a leftover container is only clutter, so don't let a failed removal hold up the job
+        try:
+            ctr.remove(force = True)
+        except docker.errors.NotFound as e:
+            pass
+        except Exception as e:
+            print('Failed to remove container ' + ctr.id[:12] + ': ' + str(e))
+
+    def _lost(self, key, host, category, log):
+        #a running job's container is gone (or unreachable): free its slot and run it again, or give up on it
+        with self.lock:
+            self.running.pop(key, None)
+            self.running_hosts.pop(key, None)
+            self.start_times.pop(key, None)
+            self.peak_memory.pop(key, None)
+            self.stats_times.pop(key, None)
+            self.reload_failures.pop(key, None)
+            host.running -= 1
+            self._retry_or_fail(key, self._never_started(key, category, log))
+
+    def _step(self):
+        #refresh the status of all running containers, collect finished ones, and start queued jobs while there are free slots
+        #(the limit is adjusted first, while the slots are still full from the last step)
+        self._adjust_concurrency()
+        self._check_hosts()
+        with self.lock:
+            running = list(self.running.items())
+        for k, ctr in running:
+            host = self.running_hosts[k]
+            try:
+                ctr.reload()
+                self.reload_failures.pop(k, None)
+            except docker.errors.NotFound as e:
+                #someone removed the container (or the daemon lost it); run the job again
+                print('Container for ' + k + ' on docker host ' + host.name() + ' is gone: ' + str(e))
+                self._lost(k, host, 'container_lost', 'ERROR: container disappeared from docker host ' + host.name())
+                continue
             except Exception as e:
-                if n_tries == 0:
-                    print('Unknown exception encountered when starting docker container')
-                    print('Command: ' + command)
-                    print('Homedir: ' + homedir)
-                result['exit_status'] = 'never_started'
-                result['log'] = 'ERROR: Unknown exception, ' + str(e) 
-                ctr = None
-                time.sleep(10.)
-                if n_tries > 0:
-                    print('Failed to start container. Attempting again; ' + str(n_tries) + ' attempts remaining.')
-        return ctr, result
+                #if the host died, the container went with it; run the job again elsewhere
+                print('Failed to refresh container for ' + k + ' on docker host ' + host.name() + ': ' + str(e))
+                if not host.check():
+                    self._lost(k, host, 'host_down', 'ERROR: docker host ' + host.name() + ' went down')
+                else:
+                    #the host is fine but keeps failing to tell us about this container; give up on it
+                    self.reload_failures[k] = self.reload_failures.get(k, 0) + 1
+                    if self.reload_failures[k] >= self.max_reload_failures:
+                        self._remove_container(ctr)
+                        self._lost(k, host, 'container_lost', 'ERROR: could not refresh container on docker host ' + host.name() + ': ' + str(e))
+                continue
+            if ctr.status not in self.runsts:
+                try:
+                    result = {'exit_status' : ctr.status, 'log' : ctr.logs(stdout = True, stderr = True).decode('utf-8')}
+                except Exception as e:
+                    print('Failed to get logs of container for ' + k + ' on docker host ' + host.name() + ': ' + str(e))
+                    self._remove_container(ctr)
+                    self._lost(k, host, 'container_lost', 'ERROR: could not get container logs from docker host ' + host.name() + ': ' + str(e))
+                    continue
+                #save the result before the container (and its logs) go away
+                self._persist('finished', self.jobs[k]['identity'], result)
+                self._remove_container(ctr)
+                with self.lock:
+                    self.running.pop(k, None)
+                    self.running_hosts.pop(k, None)
+                    host.running -= 1
+                    job = self.jobs[k]
+                    started_at = self.start_times.pop(k)
+                    duration = time.time() - started_at
+                    peak_memory = self.peak_memory.pop(k, None)
+                    self.stats_times.pop(k, None)
+                    self._record_runtime(job, duration)
+                    self.results[k] = result
+                    self.lock.notify_all()
+                if ctr.attrs.get('State', {}).get('OOMKilled', False):
+                    print('Docker job ' + k + ' (' + job['command'] + ') was killed for running out of memory')
+                    with self.lock:
+                        self.last_oom = time.time()
+                self._record_history(job, ctr, started_at, duration, peak_memory)
+            else:
+                self._sample_memory(k, ctr)
+
+        self._check_breaker()
+
+        with self.lock:
+            #jobs whose retry backoff has passed go back into the priority queue
+            now = time.time()
+            while len(self.delayed) > 0 and self.delayed[0][0] <= now:
+                _, seq, key = heapq.heappop(self.delayed)
+                heapq.heappush(self.queue, (self.priority(self.jobs[key]), seq, key))
+
+        while True:
+            with self.lock:
+                if len(self.running) >= self.n_threads or len(self.queue) == 0:
+                    return
+                if not self.breaker.allow():
+                    return
+                host = self._pick_host()
+                if host is None:
+                    if self.breaker.state == 'half_open':
+                        self.breaker.trial_running = False
+                    return
+                _, _, key = heapq.heappop(self.queue)
+                job = self.jobs[key]
+                host.running += 1
+            print('Running ' + str(key) +': ' + job['command'] + ' in ' + str(job['homedir']) + ' on docker host ' + host.name())
+            ctr, result = self._run_container(host, job)
+            with self.lock:
+                if result.get('exit_status') != 'dry_run':
+                    self.breaker.record(ctr is not None)
+                if ctr:
+                    self.running[key] = ctr
+                    self.running_hosts[key] = host
+                    self.start_times[key] = time.time()
+                    self._persist('started', job['identity'], ctr.id, host.url)
+                else:
+                    host.running -= 1
+                    if result['exit_status'] == 'dry_run':
+                        self.results[key] = result
+                        self.lock.notify_all()
+                    else:
+                        result['command'] = job['command']
+                        self.last_start_failure = result
+                        if result.get('category') in self.non_retryable:
+                            print('Giving up on job ' + key + ' (' + result['category'] + ')')
+                            self.results[key] = result
+                            self.lock.notify_all()
+                        else:
+                            self._retry_or_fail(key, result)
+
+    def _run_container(self, host, job):
+        #a single attempt; failures are retried by the scheduler (on another host if this one turns out to be down)
+        command = job['command']
+        homedir = job['homedir']
+        result = {}
+        if self.dry_run:
+            print('[Dry Run: would have started docker container with command: ' + command + ']')
+            result['exit_status'] = 'dry_run'
+            result['log'] = 'dry_run'
+            return None, result
+        try:
+            homedir_on_host = host.map_path(homedir) if homedir else None
+            ctr = host.client.containers.run(self.image, command,
+                                                  detach = True,
+                                                  remove = False,
+                                                  stderr = True,
+                                                  stdout = True,
+                                                  mem_limit = self.mem_per_thread,
+                                                  labels = {'rudaux.course' : self.course_name, 'rudaux.job' : job['identity'], 'rudaux.pid' : str(os.getpid())},
+                                                  volumes = {homedir_on_host : {'bind': '/home/jupyter', 'mode': 'rw'}} if homedir else {}
+                                                  )
+            return ctr, result
+        except docker.errors.ImageNotFound as e:
+            print('Docker ImageNotFound exception encountered when starting docker container on host ' + host.name())
+            result['exit_status'] = 'never_started'
+            result['category'] = 'image_not_found'
+            result['log'] = 'ERROR: Docker ImageNotFound, ' + str(e)
+        except docker.errors.APIError as e:
+            print('Docker APIError exception encountered when starting docker container on host ' + host.name())
+            result['exit_status'] = 'never_started'
+            result['category'] = 'api_error'
+            result['log'] = 'ERROR: Docker APIError, ' + str(e)
+        except Exception as e:
+            print('Unknown exception encountered when starting docker container on host ' + host.name())
+            result['exit_status'] = 'never_started'
+            result['category'] = 'unknown'
+            result['log'] = 'ERROR: Unknown exception, ' + str(e)
+        #take the host out of rotation if it isn't answering; it's re-checked every health_check_every seconds
+        if not host.check():
+            print('Docker host ' + host.name() + ' is down; jobs will fail over to the other hosts')
+            result['category'] = 'host_down'
+        return None, result
+
+    def never_started_report(self, results):
+        #one summary of all jobs in results that never got a container, grouped by failure category; None if there are none
+        failed = {k : r for k, r in results.items() if r['exit_status'] == 'never_started'}
+        if len(failed) == 0:
+            return None
+        categories = {}
+        for k, r in failed.items():
+            categories.setdefault(r.get('category', 'unknown'), []).append(k)
+        lines = [str(len(failed)) + ' docker jobs never started:']
+        for cat, keys in sorted(categories.items()):
+            lines.append('  ' + cat + ' (' + str(len(keys)) + ' jobs), e.g. ' + failed[keys[0]]['log'])
+            for k in sorted(keys):
+                lines.append('    ' + k + ': ' + failed[k].get('command', ''))
+        return '\r\n'.join(lines)
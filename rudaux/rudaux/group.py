@@ -1,7 +1,12 @@
-class Group:
+from .record import Record
 
-    def __init__(self, canvas_dict):
-        self.__dict__.update(canvas_dict)
+class Group(Record):
+
+    fields = {'name' : None,
+              'canvas_id' : None, #str
+              'members' : [], #student canvas ids
+              'fingerprint' : None} #for delta canvas syncs
+    __slots__ = tuple(fields)
 
     def __repr__(self):
         return self.name + ' (' + self.canvas_id  + '), members: ' + str(self.members)
@@ -0,0 +1,106 @@
+import os
+import math
+import sqlite3
+from contextlib import contextmanager
+
+def host_resources():
+    #(number of cores, total RAM in bytes) of this machine
+    return os.cpu_count(), os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def parse_memory(mem):
+    #docker-style memory strings ('512m', '2g', or a number of bytes) -> bytes
+    units = {'b' : 1, 'k' : 1024, 'm' : 1024**2, 'g' : 1024**3}
+    mem = str(mem).strip().lower()
+    if mem[-1] in units:
+        return int(float(mem[:-1]) * units[mem[-1]])
+    return int(mem)
+
+def format_memory(nbytes):
+    #bytes -> docker-style memory string, rounded up to the nearest 256m
+    return str(int(math.ceil(nbytes / 256 / 1024**2)) * 256) + 'm'
+
+class JobHistory(object):
+    """
+    Local (sqlite) record of every docker job rudaux has run: wall time, peak memory and exit status,
+    keyed by assignment and job type. Used to estimate runtimes for scheduling and by `rudaux stats`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._db() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            assignment TEXT,
+                            job_type TEXT,
+                            command TEXT,
+                            started_at REAL,
+                            duration REAL,
+                            peak_memory INTEGER,
+                            exit_code INTEGER,
+                            oom_killed INTEGER)""")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (assignment, job_type)")
+
+    @contextmanager
+    def _db(self):
+        conn = sqlite3.connect(self.path, timeout = 60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def record(self, assignment, job_type, command, started_at, duration, peak_memory, exit_code, oom_killed):
+        with self._db() as db:
+            db.execute("""INSERT INTO jobs (assignment, job_type, command, started_at, duration, peak_memory, exit_code, oom_killed)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                       (assignment, job_type, command, started_at, duration, peak_memory, exit_code, int(bool(oom_killed))))
+
+    def runtime_estimates(self, n_recent = 50):
+        #(assignment, job type) -> mean duration of the most recent n_recent successful jobs (probe jobs aren't estimated)
+        #one LIMIT query per key rather than a window function, which needs sqlite >= 3.25
+        ok = "(exit_code = 0 OR exit_code IS NULL) AND IFNULL(job_type, '') != 'probe'"
+        estimates = {}
+        with self._db() as db:
+            keys = db.execute("SELECT DISTINCT assignment, job_type FROM jobs WHERE " + ok).fetchall()
+            for a, jt in keys:
+                estimates[(a, jt)] = db.execute("""SELECT AVG(duration) FROM
+                                                     (SELECT duration FROM jobs WHERE assignment IS ? AND job_type IS ? AND """ + ok + """
+                                                      ORDER BY id DESC LIMIT ?)""", (a, jt, n_recent)).fetchone()[0]
+        return estimates
+
+    def summary(self):
+        #one dict per (assignment, job type) with duration/memory statistics over all recorded jobs
+        with self._db() as db:
+            rows = db.execute("""SELECT assignment, job_type, duration, peak_memory, exit_code, oom_killed
+                                 FROM jobs ORDER BY assignment, job_type, duration""").fetchall()
+        groups = {}
+        for a, jt, dur, mem, code, oom in rows:
+            groups.setdefault((a, jt), []).append((dur, mem, code, oom))
+        summary = []
+        for (a, jt), recs in groups.items():
+            durs = [r[0] for r in recs]
+            mems = [r[1] for r in recs if r[1] is not None]
+            summary.append({'assignment' : a,
+                            'job_type' : jt,
+                            'n_jobs' : len(recs),
+                            'mean_duration' : sum(durs)/len(durs),
+                            'p90_duration' : durs[min(len(durs)-1, int(0.9*len(durs)))],
+                            'max_duration' : durs[-1],
+                            'peak_memory' : max(mems) if len(mems) > 0 else None,
+                            'n_failed' : len([r for r in recs if r[2] not in (0, None)]),
+                            'n_oom' : len([r for r in recs if r[3]])})
+        return summary
+
+def predict_makespan(n_jobs, mean_duration, max_duration, n_threads):
+    #longest-job-first packing gets within a small factor of the ideal: total work spread over all threads,
+    #but never less than the single longest job
+    return max(n_jobs * mean_duration / max(n_threads, 1), max_duration)
+
+def recommend_settings(summary, n_cores, total_memory, headroom = 1.25, memory_fraction = 0.8):
+    #recommend a per-container memory limit (peak seen * headroom) and the concurrency that fits the host
+    peaks = [s['peak_memory'] for s in summary if s['peak_memory'] is not None]
+    if len(peaks) == 0:
+        return None, n_cores
+    mem = headroom * max(peaks)
+    threads = max(1, min(n_cores, int(memory_fraction * total_memory // mem)))
+    return format_memory(mem), threads
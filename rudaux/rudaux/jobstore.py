@@ -0,0 +1,82 @@
+import os
+import time
+import hashlib
+import sqlite3
+from contextlib import contextmanager
+
+def job_identity(command, homedir):
+    #the same command in the same folder is the same job, across runs
+    return hashlib.sha1((command + '\0' + str(homedir)).encode('utf-8')).hexdigest()[:16]
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class JobStore(object):
+    """
+    On-disk (sqlite) copy of the docker job queue: every submitted job with its container id once started,
+    and its result once finished (until a caller collects it). Lets a new rudaux process re-attach to containers
+    and pick up results left behind by one that was killed mid-batch.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._db() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                            identity TEXT PRIMARY KEY,
+                            command TEXT,
+                            homedir TEXT,
+                            job_type TEXT,
+                            assignment TEXT,
+                            due_at REAL,
+                            status TEXT,
+                            container_id TEXT,
+                            host_url TEXT,
+                            owner_pid INTEGER,
+                            exit_status TEXT,
+                            log TEXT,
+                            updated_at REAL)""")
+
+    @contextmanager
+    def _db(self):
+        conn = sqlite3.connect(self.path, timeout = 60)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, identity, job):
+        with self._db() as db:
+            db.execute("""INSERT OR REPLACE INTO jobs (identity, command, homedir, job_type, assignment, due_at, status, owner_pid, updated_at)
+                          VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)""",
+                       (identity, job['command'], job['homedir'], job['job_type'], job['assignment'], job['due_at'], os.getpid(), time.time()))
+
+    def started(self, identity, container_id, host_url):
+        with self._db() as db:
+            db.execute("UPDATE jobs SET status = 'running', container_id = ?, host_url = ?, owner_pid = ?, updated_at = ? WHERE identity = ?",
+                       (container_id, host_url, os.getpid(), time.time(), identity))
+
+    def requeued(self, identity):
+        with self._db() as db:
+            db.execute("UPDATE jobs SET status = 'queued', container_id = NULL, host_url = NULL, updated_at = ? WHERE identity = ?",
+                       (time.time(), identity))
+
+    def finished(self, identity, result):
+        with self._db() as db:
+            db.execute("UPDATE jobs SET status = 'finished', exit_status = ?, log = ?, updated_at = ? WHERE identity = ?",
+                       (result['exit_status'], result['log'], time.time(), identity))
+
+    def remove(self, identity):
+        with self._db() as db:
+            db.execute("DELETE FROM jobs WHERE identity = ?", (identity,))
+
+    def jobs(self):
+        with self._db() as db:
+            return [dict(row) for row in db.execute("SELECT * FROM jobs").fetchall()]
@@ -1,6 +1,7 @@
-from dictauth.users import add_user, remove_user, get_users
+from dictauth.users import add_users, remove_user, get_users, uses_credential_store
 from collections import namedtuple
 from subprocess import check_call 
+import threading
 
 class JupyterHub(object):
     """
@@ -10,34 +11,42 @@ class JupyterHub(object):
     def __init__(self, config, dry_run):
         self.jupyterhub_config_dir = config.jupyterhub_config_dir
         self.dry_run = dry_run
+        #dictauth edits are read-modify-write, so serialize them (the grading workflow may run assignments in parallel)
+        self.lock = threading.Lock()
    
     def assign_grader(self, grader_name, ta_username):
-        #just add authentication using dictauth
-        Args = namedtuple('Args', 'username directory copy_creds salt digest')
-        args = Args(username = grader_name, directory = self.jupyterhub_config_dir, copy_creds = ta_username, salt = None, digest = None)
+        self.assign_graders({grader_name : ta_username})
+
+    def assign_graders(self, graders):
+        #graders is a dict of grader_name -> ta_username
+        #add all authentication entries using dictauth in one write, then restart the hub once (if needed)
+        Args = namedtuple('Args', 'directory users')
+        args = Args(directory = self.jupyterhub_config_dir, users = [{'username' : grader_name, 'copy_creds' : ta_username} for grader_name, ta_username in graders.items()])
         if not self.dry_run:
-            add_user(args)
-            self.stop()
-            self.start()
+            with self.lock:
+                add_users(args)
+                self.restart_if_needed()
         else:
-            print('[Dry run: would have called add_user with args ' + str(args) + ' and then restarted hub]')
+            print('[Dry run: would have called add_users with args ' + str(args) + ' and then restarted hub]')
 
     def unassign_grader(self, grader_name):
         #just remove authentication using dictauth
         Args = namedtuple('Args', 'username directory')
         args = Args(username = grader_name, directory = self.jupyterhub_config_dir)
         if not self.dry_run:
-            remove_user(args)
-            self.stop()
-            self.start()
+            with self.lock:
+                remove_user(args)
+                self.restart_if_needed()
         else:
             print('[Dry run: would have called remove_user with args ' + str(args) + ' and then restarted hub]')
 
-    def grader_exists(self, grader_name):
+    def get_users(self):
         Args = namedtuple('Args', 'directory')
         args = Args(directory = self.jupyterhub_config_dir)
-        output = get_users(args)
-        return (grader_name in output)
+        return set(get_users(args))
+
+    def grader_exists(self, grader_name):
+        return (grader_name in self.get_users())
 
     def stop(self):
         check_call(['systemctl', 'stop', 'jupyterhub'])
@@ -45,6 +54,17 @@ class JupyterHub(object):
     def start(self):
         check_call(['systemctl', 'start', 'jupyterhub'])
 
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def restart_if_needed(self):
+        #a hub configured with a dictauth credentials_file reloads users on its own; only the old config-file dict needs a restart
+        if uses_credential_store(self.jupyterhub_config_dir):
+            print('JupyterHub reads a dictauth credentials_file; no restart needed')
+        else:
+            self.restart()
+
     
 
         #======================================================#
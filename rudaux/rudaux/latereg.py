@@ -0,0 +1,61 @@
+import numpy as np
+from collections import namedtuple
+
+#one change to make on canvas: give student a new override on assignment (due at new_due_at), replacing old_override if not None
+LateregExtension = namedtuple('LateregExtension', ['assignment', 'student', 'old_due_at', 'old_override', 'new_due_at'])
+
+def plan_latereg_extensions(assignments, students, extension_days):
+    """
+    Work out every late registration extension that needs to be created, for all assignments and students at once.
+    A student who registered after an assignment unlocked gets extension_days from their registration date,
+    unless their current due date (the assignment's, or a later override's) is already at least that late.
+
+    Returns (plan, skipped) where plan is a list of LateregExtension and skipped lists the assignments that are
+    missing a due or unlock date.
+    """
+    checked = [a for a in assignments if a.due_at is not None and a.unlock_at is not None]
+    skipped = [a for a in assignments if a.due_at is None or a.unlock_at is None]
+
+    #registration dates and late registration due dates (pendulum handles the calendar/DST arithmetic, once per student)
+    studs = []
+    regdates = []
+    for s in students:
+        regdate = s.reg_updated if (s.reg_updated is not None) else s.reg_created
+        if s.status == 'active' and regdate is not None:
+            studs.append(s)
+            regdates.append(regdate)
+    if len(checked) == 0 or len(studs) == 0:
+        return [], skipped
+    latereg_dates = [rd.add(days=extension_days) for rd in regdates]
+    col = {s.canvas_id : j for j, s in enumerate(studs)}
+    reg = np.array([rd.timestamp() for rd in regdates])
+    latereg = np.array([ld.timestamp() for ld in latereg_dates])
+
+    #assignments x students: the latest override due date for each student, and which override it came from
+    due = np.array([a.due_at.timestamp() for a in checked])
+    unlock = np.array([a.unlock_at.timestamp() for a in checked])
+    over_due = np.full((len(checked), len(studs)), -np.inf)
+    over_idx = np.full((len(checked), len(studs)), -1, dtype=int)
+    for i, a in enumerate(checked):
+        for k, over in enumerate(a.overrides):
+            if over['due_at'] is None:
+                continue
+            t = over['due_at'].timestamp()
+            for sid in over['student_ids']:
+                j = col.get(sid)
+                if j is not None and t > over_due[i, j]:
+                    over_due[i, j] = t
+                    over_idx[i, j] = k
+
+    #an override only counts if it is later than the assignment's own due date
+    has_over = over_due > due[:, None]
+    effective_due = np.where(has_over, over_due, due[:, None])
+    needs_extension = (reg[None, :] > unlock[:, None]) & (latereg[None, :] > effective_due)
+
+    plan = []
+    for i, j in zip(*np.nonzero(needs_extension)):
+        a = checked[i]
+        old_override = a.overrides[over_idx[i, j]] if has_over[i, j] else None
+        plan.append(LateregExtension(a, studs[j], old_override['due_at'] if old_override is not None else a.due_at,
+                                     old_override, latereg_dates[j]))
+    return plan, skipped
@@ -1,27 +1,178 @@
 import smtplib
 import subprocess
+import sqlite3
+import hashlib
+import os
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 class NotifyError(Exception):
     def __init__(self, message):
+        super().__init__(message)
         self.message = message
 
+class Outbox(object):
+    """
+    Durable (sqlite) queue of notifications, so messages survive between rudaux runs
+    and can be sent as per-recipient digests, deduplicated and retried on failure.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._db() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS messages (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            recipient TEXT NOT NULL,
+                            message TEXT NOT NULL,
+                            dedupe_key TEXT NOT NULL,
+                            created_at REAL NOT NULL,
+                            status TEXT NOT NULL DEFAULT 'pending',
+                            attempts INTEGER NOT NULL DEFAULT 0,
+                            next_attempt_at REAL NOT NULL DEFAULT 0,
+                            last_error TEXT,
+                            sent_at REAL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS messages_status ON messages (status, recipient)")
+            db.execute("""CREATE TABLE IF NOT EXISTS recipients (
+                            recipient TEXT PRIMARY KEY,
+                            last_sent_at REAL NOT NULL)""")
+
+    @contextmanager
+    def _db(self):
+        #one short-lived connection per operation; safe to use from several threads/processes
+        conn = sqlite3.connect(self.path, timeout = 60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, recipient, message, now):
+        #skip messages identical to one that is already waiting to be sent to the same recipient
+        dedupe_key = hashlib.sha256((recipient + '\0' + message).encode('utf-8')).hexdigest()
+        with self._db() as db:
+            if db.execute("SELECT 1 FROM messages WHERE dedupe_key = ? AND status IN ('pending', 'sending')", (dedupe_key,)).fetchone() is not None:
+                return False
+            db.execute("INSERT INTO messages (recipient, message, dedupe_key, created_at) VALUES (?, ?, ?, ?)",
+                       (recipient, message, dedupe_key, now))
+        return True
+
+    def due(self, now, digest_hours, claim_seconds = None):
+        #returns recipient -> [(id, message)] for recipients whose digest window has elapsed
+        #with claim_seconds, the returned messages are also claimed (status sending) in the same transaction, so that
+        #another rudaux process draining the outbox at the same time doesn't send them too; a claim that is never
+        #resolved with mark_sent/mark_failed (the sender died) expires after claim_seconds and the messages go out again
+        with self._db() as db:
+            if claim_seconds is not None:
+                db.execute("BEGIN IMMEDIATE")
+            last_sent = dict(db.execute("SELECT recipient, last_sent_at FROM recipients").fetchall())
+            rows = db.execute("""SELECT id, recipient, message FROM messages
+                                 WHERE status IN ('pending', 'sending') AND next_attempt_at <= ? ORDER BY id""", (now,)).fetchall()
+            batches = {}
+            for msg_id, recip, message in rows:
+                if last_sent.get(recip, 0) + 3600*digest_hours.get(recip, 0) <= now:
+                    batches.setdefault(recip, []).append((msg_id, message))
+            if claim_seconds is not None:
+                db.executemany("UPDATE messages SET status = 'sending', next_attempt_at = ? WHERE id = ?",
+                               [(now + claim_seconds, msg_id) for batch in batches.values() for msg_id, _ in batch])
+        return batches
+
+    def mark_sent(self, recipient, ids, now):
+        with self._db() as db:
+            db.executemany("UPDATE messages SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?", [(now, i) for i in ids])
+            db.execute("INSERT OR REPLACE INTO recipients (recipient, last_sent_at) VALUES (?, ?)", (recipient, now))
+
+    def mark_failed(self, ids, error, now, max_attempts, retry_seconds):
+        #back off exponentially between attempts; give up (status failed) after max_attempts
+        with self._db() as db:
+            for i in ids:
+                attempts = db.execute("SELECT attempts FROM messages WHERE id = ?", (i,)).fetchone()[0] + 1
+                db.execute("UPDATE messages SET attempts = ?, last_error = ?, next_attempt_at = ?, status = ? WHERE id = ?",
+                           (attempts, error, now + retry_seconds*2**(attempts-1), 'failed' if attempts >= max_attempts else 'pending', i))
+
+    def summary(self):
+        #returns a list of (recipient, status, count, last error)
+        with self._db() as db:
+            return db.execute("""SELECT recipient, status, COUNT(*), MAX(last_error) FROM messages
+                                 GROUP BY recipient, status ORDER BY recipient, status""").fetchall()
+
+class RateLimiter(object):
+    """
+    Spaces out calls to wait() so that at most rate calls/second go through, across all threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1./rate if rate > 0 else 0.
+        self.next_time = 0.
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
 class Notification(object):
-    def __init__(self, config, dry_run):
+
+    #how long a drain may take to deliver the messages it claimed before another drain may send them
+    claim_seconds = 3600
+
+    def __init__(self, config, dry_run, course_dir):
         self.dry_run = dry_run
-        self.notifications = {}
+        self.outbox = Outbox(os.path.join(course_dir, config.name + '_notifications.db'))
+        self.digest_hours = config.notification_digest_hours
+        self.max_attempts = config.notification_max_attempts
+        self.retry_seconds = 60*config.notification_retry_minutes
+        self.n_threads = config.notification_threads
+        self.rate_limiter = RateLimiter(config.notification_rate)
 
     def submit(self, recipient, message):
-        if recipient not in self.notifications:
-            self.notifications[recipient] = []
-        self.notifications[recipient].append(message)
+        if self.dry_run:
+            print('[Dry run: would have queued notification for ' + recipient + ']')
+            return
+        if not self.outbox.add(recipient, message, time.time()):
+            print('Identical notification already queued for ' + recipient + '; skipping')
 
     def notify_all(self):
-        for recip in self.notifications:
-            if len(self.notifications[recip]) > 0:
-                self.notify(recip, '\r\n\r\n-------------------\r\n\r\n'.join(self.notifications[recip]))
-                time.sleep(5)
-            self.notifications[recip] = []
+        now = time.time()
+        batches = self.outbox.due(now, self.digest_hours, None if self.dry_run else self.claim_seconds)
+        if self.dry_run:
+            for recip in batches:
+                print('[Dry run: would have sent ' + str(len(batches[recip])) + ' notifications to ' + recip + ']')
+            return
+        #deliver the digests concurrently; the rate limiter (not a fixed sleep) keeps us polite to the mail server
+        with ThreadPoolExecutor(max_workers = self.n_threads) as executor:
+            futures = {recip : executor.submit(self._deliver, recip, batches[recip], now) for recip in batches}
+        #_deliver handles send errors itself, so anything raised here is a bookkeeping failure (e.g. the outbox db is locked);
+        #those messages stay claimed and are retried once the claim expires
+        failed = []
+        for recip, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print('Error updating the outbox after delivering notifications to ' + recip + ': ' + str(e))
+                failed.append(recip)
+        if len(failed) > 0:
+            raise NotifyError('Failed to record delivery of notifications to ' + ', '.join(failed))
+
+    def _deliver(self, recip, batch, now):
+        ids = [msg_id for msg_id, _ in batch]
+        self.rate_limiter.wait()
+        try:
+            self.notify(recip, '\r\n\r\n-------------------\r\n\r\n'.join([message for _, message in batch]))
+        except Exception as e:
+            print('Error sending notifications to ' + recip + '; will retry later')
+            print(e)
+            self.outbox.mark_failed(ids, str(e), now, self.max_attempts, self.retry_seconds)
+        else:
+            print('Sent ' + str(len(ids)) + ' notifications to ' + recip)
+            self.outbox.mark_sent(recip, ids, now)
+
+    def status(self):
+        return self.outbox.summary()
 
     def notify(self, recipient, message):
         raise NotImplementedError('Need to subclass Notification')
@@ -34,8 +185,8 @@ class Notification(object):
 
 
 class SendMail(Notification):
-    def __init__(self, config, dry_run):
-        super().__init__(config, dry_run)
+    def __init__(self, config, dry_run, course_dir):
+        super().__init__(config, dry_run, course_dir)
         self.address = config.sendmail.address
         self.contact_info = config.sendmail.contact_info
         self.message_template = '\r\n'.join(['From: '+self.address,
@@ -52,17 +203,15 @@ class SendMail(Notification):
 
     def notify(self, recipient, message):
         # -i flag: do NOT treat bare dot as EOF
-        cmd = ['/usr/sbin/sendmail', f'-f {self.address}', self.contact_info[recipient]['address']]
+        cmd = ['/usr/sbin/sendmail', '-i', '-f', self.address, self.contact_info[recipient]['address']]
         msg = self.message_template.format(self.contact_info[recipient]['address'], self.contact_info[recipient]['name'], message)
         proc = subprocess.Popen(cmd, shell=False,
                                 stdin=subprocess.PIPE,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE)
         out, err = proc.communicate(input=msg.encode('utf-8'))
-        #TODO handle errors
-        #print(f"ret: {proc.returncode}")
-        #print("stdout:" + str(out))
-        #print("stderr:" + str(err))
+        if proc.returncode != 0:
+            raise NotifyError('sendmail exited with status ' + str(proc.returncode) + ': ' + err.decode('utf-8', errors='replace').strip())
 
     def connect(self):
         pass
@@ -71,8 +220,8 @@ class SendMail(Notification):
         pass
 
 class SMTP(Notification):
-    def __init__(self, config, dry_run):
-        super().__init__(config, dry_run)
+    def __init__(self, config, dry_run, course_dir):
+        super().__init__(config, dry_run, course_dir)
         self.hostname = config.smtp.hostname
         self.username = config.smtp.username
         self.passwd = config.smtp.passwd
@@ -91,29 +240,59 @@ class SMTP(Notification):
                                   'Beep boop,',
                                   config.name + ' Bot'])
 
-    #TODO deal with smtplib exceptions
     def connect(self):
-        self.server = smtplib.SMTP(self.hostname)
-        self.server.ehlo()
-        self.server.starttls()
-        self.server.login(self.username, self.passwd)
+        #connections are opened lazily, one per delivery thread, and reused for every message that thread sends
+        self.local = threading.local()
+        self.servers = []
+        self.servers_lock = threading.Lock()
         self.connected = True
 
-    #TODO implement saving messages to disk with timestamp if send fails
-    #TODO deal with smtplib exceptions
+    def _server(self):
+        server = getattr(self.local, 'server', None)
+        if server is None:
+            server = smtplib.SMTP(self.hostname, timeout = 60)
+            server.ehlo()
+            server.starttls()
+            server.login(self.username, self.passwd)
+            self.local.server = server
+            with self.servers_lock:
+                self.servers.append(server)
+        return server
+
+    def _drop_server(self):
+        server = getattr(self.local, 'server', None)
+        self.local.server = None
+        if server is not None:
+            with self.servers_lock:
+                self.servers.remove(server)
+            try:
+                server.close()
+            except Exception:
+                pass
+
     def notify(self, recipient, message):
         if not self.connected:
             raise NotifyError('Not connected to SMTP server; cannot send notifications')
-        self.server.sendmail(self.address, 
-				self.contact_info[recipient]['address'], 
-				self.message_template.format(self.contact_info[recipient]['address'], self.contact_info[recipient]['name'], message)
-                            )
+        msg = self.message_template.format(self.contact_info[recipient]['address'], self.contact_info[recipient]['name'], message)
+        try:
+            self._server().sendmail(self.address, self.contact_info[recipient]['address'], msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError) as e:
+            #the server dropped our (idle) connection; reconnect and try once more
+            print('SMTP connection lost (' + str(e) + '); reconnecting')
+            self._drop_server()
+            self._server().sendmail(self.address, self.contact_info[recipient]['address'], msg)
+        except smtplib.SMTPResponseException as e:
+            #421: server is closing the channel, so don't reuse this connection
+            if e.smtp_code == 421:
+                self._drop_server()
+            raise
 
-    #TODO deal with smtplib exceptions
     def close(self):
-        if self.connected:       
-            self.server.quit()
+        if self.connected:
+            for server in self.servers:
+                try:
+                    server.quit()
+                except smtplib.SMTPException:
+                    server.close()
+            self.servers = []
             self.connected = False
-
-
-
@@ -1,8 +1,17 @@
-class Person:
+from .record import Record
 
-    def __init__(self, canvas_dict):
-        self.__dict__.update(canvas_dict)
-        self.submissions = []
+class Person(Record):
+
+    fields = {'name' : None,
+              'sortable_name' : None,
+              'short_name' : None,
+              'canvas_id' : None, #str
+              'sis_id' : None, #str
+              'reg_created' : None, #pendulum datetime
+              'reg_updated' : None, #pendulum datetime
+              'status' : None, #canvas enrollment state, e.g. 'active'
+              'submissions' : []}
+    __slots__ = tuple(fields)
 
     def __repr__(self):
         return self.name + ' (' + self.canvas_id  + ')'
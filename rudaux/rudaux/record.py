@@ -0,0 +1,35 @@
+import copy
+
+class Record(object):
+    """
+    Base class for rudaux's record objects (people, groups, assignments, submissions). Each subclass lists its fields
+    and their defaults in `fields` and keeps them in __slots__, so instances carry no per-instance __dict__.
+    Records pickle as a plain {field : value} dict, so pickles survive fields being added or removed (missing fields get
+    their defaults, unknown ones are dropped) -- this also loads caches pickled before these classes had slots, since
+    those pickled the instance __dict__. Slots listed in `_caches` are in-memory caches: never pickled, reset to None.
+    """
+
+    __slots__ = ()
+    fields = {}
+    _caches = ()
+
+    def __init__(self, values):
+        self._set_fields(values)
+
+    def _set_fields(self, values):
+        for field, default in self.fields.items():
+            #copy so that mutable defaults (lists, dicts) aren't shared between records
+            setattr(self, field, values[field] if field in values else copy.copy(default))
+        for cache in self._caches:
+            setattr(self, cache, None)
+
+    def __getstate__(self):
+        return {field : getattr(self, field) for field in self.fields}
+
+    def __setstate__(self, state):
+        #(dict, slots dict) is what pickle stores for objects with both a __dict__ and __slots__
+        if isinstance(state, tuple):
+            merged = dict(state[0] or {})
+            merged.update(state[1] or {})
+            state = merged
+        self._set_fields(state)
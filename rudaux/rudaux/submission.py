@@ -1,11 +1,13 @@
 from traitlets.config.configurable import Configurable
 from traitlets import Int, Float, Unicode, Bool
 from enum import IntEnum
-import os, shutil, pwd
+import os, shutil
 import json
 from nbgrader.api import Gradebook, MissingEntry
 from .docker import DockerError
 from .canvas import GradeNotUploadedError
+from .utils import chown_user, makedirs_owned
+from .record import Record
 import pendulum as plm
 
 class SubmissionStatus(IntEnum):
@@ -31,30 +33,80 @@ class MultipleGraderError(Exception):
     def __init__(self, message):
         self.message = message
 
-class Submission:
+class Submission(Record):
+
+    fields = {'asgn' : None, #Assignment
+              'stu' : None, #Person
+              'due_date' : None, #pendulum datetime (the student's override's, if they have one)
+              'snap_name' : None,
+              'grader_folder_root' : None,
+              'student_folder_root' : None,
+              'student_local_assignment_folder' : None,
+              'jupyter_user' : None,
+              'grader' : None, #grader account name, once assigned
+              'grader_repo_path' : None,
+              'grade_uploaded' : False,
+              'grade_posted' : False,
+              'autograde_docker_job_id' : None,
+              'feedback_docker_job_id' : None,
+              'score' : None,
+              'max_score' : None,
+              'error' : None}
+    __slots__ = tuple(fields)
+
+    student_prefix = 'student_'
 
     def __init__(self, asgn, stu, grade_uploaded, grade_posted, config):
-        self.asgn = asgn
-        self.stu = stu
-        self.due_date, override = asgn.get_due_date(stu)
-        self.snap_name = asgn.name if (override is None) else (asgn.name + '-override-' + override['id'])
-        self.grader_folder_root = config.user_folder_root
-        self.student_folder_root = config.student_folder_root
-        self.student_local_assignment_folder = config.student_local_assignment_folder
-        self.student_prefix = 'student_'
-        self.snapped_assignment_path = os.path.join(self.student_folder_root, self.stu.canvas_id, '.zfs', 'snapshot', self.snap_name, self.student_local_assignment_folder, self.asgn.name, self.asgn.name+'.ipynb')
-        self.grader_local_collection_folder = os.path.join('submitted', self.student_prefix + self.stu.canvas_id, self.asgn.name)
-        self.grader_local_autograded_folder = os.path.join('autograded', self.student_prefix + self.stu.canvas_id, self.asgn.name)
-        self.grader_local_feedback_folder = os.path.join('feedback', self.student_prefix + self.stu.canvas_id, self.asgn.name)
+        due_date, override = asgn.get_due_date(stu)
+        Record.__init__(self, {'asgn' : asgn,
+                               'stu' : stu,
+                               'due_date' : due_date,
+                               'snap_name' : asgn.snapshot_name(override),
+                               'grader_folder_root' : config.user_folder_root,
+                               'student_folder_root' : config.student_folder_root,
+                               'student_local_assignment_folder' : config.student_local_assignment_folder,
+                               'jupyter_user' : config.jupyter_user,
+                               'grade_uploaded' : grade_uploaded,
+                               'grade_posted' : grade_posted})
         self.grader = self.get_grader()
-        self.grader_repo_path = None
-        self.grade_uploaded = grade_uploaded
-        self.grade_posted = grade_posted
-        self.autograde_docker_job_id = None
-        self.feedback_docker_job_id = None
-        self.score = None
-        self.max_score = None
-        self.error = None
+
+    #paths are derived from the fields when needed, rather than stored (and pickled) with every submission
+    @property
+    def snapped_assignment_path(self):
+        return os.path.join(self.student_folder_root, self.stu.canvas_id, '.zfs', 'snapshot', self.snap_name, self.student_local_assignment_folder, self.asgn.name, self.asgn.name+'.ipynb')
+
+    @property
+    def grader_local_collection_folder(self):
+        return os.path.join('submitted', self.student_prefix + self.stu.canvas_id, self.asgn.name)
+
+    @property
+    def grader_local_autograded_folder(self):
+        return os.path.join('autograded', self.student_prefix + self.stu.canvas_id, self.asgn.name)
+
+    @property
+    def grader_local_feedback_folder(self):
+        return os.path.join('feedback', self.student_prefix + self.stu.canvas_id, self.asgn.name)
+
+    #these need the grader repo path, i.e., only once the submission is assigned to a grader
+    @property
+    def collected_assignment_path(self):
+        return os.path.join(self.grader_repo_path, self.grader_local_collection_folder, self.asgn.name + '.ipynb')
+
+    @property
+    def autograded_assignment_path(self):
+        return os.path.join(self.grader_repo_path, self.grader_local_autograded_folder)
+
+    @property
+    def autograde_fail_flag_path(self):
+        return os.path.join(self.grader_repo_path, 'autograde_failed_'+self.asgn.name+'-'+self.stu.canvas_id)
+
+    @property
+    def feedback_path(self):
+        return os.path.join(self.grader_repo_path, self.grader_local_feedback_folder)
+
+    @property
+    def feedback_fail_flag_path(self):
+        return os.path.join(self.grader_repo_path, 'feedback_failed_'+self.asgn.name+'-'+self.stu.canvas_id)
 
     def get_grader(self):
         graders = [username.strip('/') for username in os.listdir(self.grader_folder_root) if self.asgn.grader_basename() in username]
@@ -93,9 +145,6 @@ class Submission:
             return SubmissionStatus.NOT_DUE
         print('Submission ready for collection (due+1hr). Due date: ' + self.due_date.in_timezone(tz).format(fmt) + ' Time now: ' + plm.now().in_timezone(tz).format(fmt))
 
-        #create the collected assignment path
-        self.collected_assignment_path = os.path.join(self.grader_repo_path, self.grader_local_collection_folder, self.asgn.name + '.ipynb')
-
         #try to collect the assignment if not already collected
         print('Collecting submission...')
         try:
@@ -143,15 +192,8 @@ class Submission:
                     min_grader = grd
             self.grader = min_grader
 
-            #create the submission folder in the grader account and set permissions
-            jupyter_uid = pwd.getpwnam('jupyter').pw_uid
-            fldr = os.path.join(self.grader_folder_root, min_grader, self.grader_local_collection_folder)
-            os.makedirs(fldr, exist_ok=True)
-
-            #chown everything inside the grader folder root to jupyter/jupyter, moving backwards through the path hierarchy until we reach the grader root folder
-            while not os.path.samefile(fldr, os.path.join(self.grader_folder_root, min_grader)):
-                os.chown(fldr, jupyter_uid, jupyter_uid)
-                fldr = os.path.dirname(fldr)
+            #create the submission folder in the grader account and set permissions on any folders we had to create
+            makedirs_owned(os.path.join(self.grader_folder_root, min_grader, self.grader_local_collection_folder), self.jupyter_user)
 
         #increment the known grader workload by 1
         self.asgn.grader_workloads[self.grader] += 1
@@ -160,10 +202,9 @@ class Submission:
         self.grader_repo_path = os.path.join(self.grader_folder_root, self.grader)
             
     def collect(self):
-        jupyter_uid = pwd.getpwnam('jupyter').pw_uid
         if not os.path.exists(self.collected_assignment_path):
             shutil.copy(self.snapped_assignment_path, self.collected_assignment_path)
-            os.chown(self.collected_assignment_path, jupyter_uid, jupyter_uid)
+            chown_user(self.collected_assignment_path, self.jupyter_user)
         
     def clean(self):
         #need to check for duplicate cell ids, see
@@ -197,11 +238,14 @@ class Submission:
     ###    Funcs to grade the submission for grading    ##
     ######################################################
 
-    def submit_autograding(self, docker):
-        # create the autograded assignment file path
-        self.autograded_assignment_path = os.path.join(self.grader_repo_path, self.grader_local_autograded_folder)
-        self.autograde_fail_flag_path = os.path.join(self.grader_repo_path, 'autograde_failed_'+self.asgn.name+'-'+self.stu.canvas_id)
+    def submission_size(self):
+        #size of the collected notebook, as a rough guide to how long its docker jobs take (bigger notebooks run longer)
+        try:
+            return os.path.getsize(self.collected_assignment_path)
+        except OSError:
+            return None
 
+    def submit_autograding(self, docker):
         print('Autograding submission ' + self.asgn.name+':'+self.stu.canvas_id)
 
         if os.path.exists(self.autograde_fail_flag_path):
@@ -212,16 +256,22 @@ class Submission:
             print('Assignment previously autograded & validated.')
             return SubmissionStatus.AUTOGRADED
         else:
-            print('Removing old autograding result from DB if it exists')
-            try:
-                gb = Gradebook('sqlite:///'+self.grader_repo_path +'/gradebook.db')
-                gb.remove_submission(self.asgn.name, self.student_prefix+self.stu.canvas_id)
-            except MissingEntry as e:
-                pass
-            finally:
-                gb.close()
+            command = 'nbgrader autograde --force --assignment=' + self.asgn.name + ' --student='+self.student_prefix+self.stu.canvas_id
+            #if the pool already has this job (re-attached to a container that survived a restart, or its result was recovered),
+            #the gradebook entry belongs to that run, so leave it alone
+            if docker.has_job(command, self.grader_repo_path):
+                print('Autograding job already known to the docker pool; not removing the old autograding result')
+            else:
+                print('Removing old autograding result from DB if it exists')
+                try:
+                    gb = Gradebook('sqlite:///'+self.grader_repo_path +'/gradebook.db')
+                    gb.remove_submission(self.asgn.name, self.student_prefix+self.stu.canvas_id)
+                except MissingEntry as e:
+                    pass
+                finally:
+                    gb.close()
             print('Submitting job to docker pool for autograding')
-            self.autograde_docker_job_id = docker.submit('nbgrader autograde --force --assignment=' + self.asgn.name + ' --student='+self.student_prefix+self.stu.canvas_id, self.grader_repo_path)
+            self.autograde_docker_job_id = docker.submit(command, self.grader_repo_path, 'autograde', self.asgn.name, self.asgn.due_at, self.submission_size())
             return SubmissionStatus.NEEDS_AUTOGRADE
 
     def check_grading(self, canvas, docker_results):
@@ -237,8 +287,7 @@ class Submission:
                 #create the fail flag file
                 with open(self.autograde_fail_flag_path, 'wb') as f:
                     pass
-                jupyter_uid = pwd.getpwnam('jupyter').pw_uid
-                os.chown(self.autograde_fail_flag_path, jupyter_uid, jupyter_uid)
+                chown_user(self.autograde_fail_flag_path, self.jupyter_user)
                 return SubmissionStatus.AUTOGRADE_FAILED
             print('Valid autograder result.')
             self.autograde_docker_job_id = None
@@ -347,10 +396,6 @@ class Submission:
     ######################################################
 
     def submit_genfeedback(self, docker):
-        # create the autograded assignment file path
-        self.feedback_path = os.path.join(self.grader_repo_path, self.grader_local_feedback_folder)
-        self.feedback_fail_flag_path = os.path.join(self.grader_repo_path, 'feedback_failed_'+self.asgn.name+'-'+self.stu.canvas_id)
-
         print('Generating feedback for submission ' + self.asgn.name+':'+self.stu.canvas_id)
 
         if os.path.exists(self.feedback_fail_flag_path):
@@ -362,7 +407,7 @@ class Submission:
             return SubmissionStatus.FEEDBACK_GENERATED
         else:
             print('Submitting job to docker pool for feedback gen')
-            self.feedback_docker_job_id = docker.submit('nbgrader generate_feedback --force --assignment=' + self.asgn.name + ' --student=' + self.student_prefix+self.stu.canvas_id, self.grader_repo_path)
+            self.feedback_docker_job_id = docker.submit('nbgrader generate_feedback --force --assignment=' + self.asgn.name + ' --student=' + self.student_prefix+self.stu.canvas_id, self.grader_repo_path, 'feedback', self.asgn.name, self.asgn.due_at, self.submission_size())
             return SubmissionStatus.NEEDS_FEEDBACK
 
     def check_feedback(self, docker_results):
@@ -378,8 +423,7 @@ class Submission:
                 #create the fail flag file
                 with open(self.feedback_fail_flag_path, 'wb') as f:
                     pass
-                jupyter_uid = pwd.getpwnam('jupyter').pw_uid
-                os.chown(self.feedback_fail_flag_path, jupyter_uid, jupyter_uid)
+                chown_user(self.feedback_fail_flag_path, self.jupyter_user)
                 return SubmissionStatus.FEEDBACK_FAILED
             print('Valid feedback generated.')
             self.feedback_docker_job_id = None
@@ -406,8 +450,7 @@ class Submission:
             if os.path.exists(fdbk_folder_student):
                 try:
                     shutil.copy(fdbk_path_grader, fdbk_path_student) 
-                    jupyter_uid = pwd.getpwnam('jupyter').pw_uid
-                    os.chown(fdbk_path_student, jupyter_uid, jupyter_uid)
+                    chown_user(fdbk_path_student, self.jupyter_user)
                 except Exception as e:
                     print('Error occured when returning feedback.')
                     print(e)
@@ -425,8 +468,7 @@ class Submission:
             if os.path.exists(soln_folder_student):
                 try:
                     shutil.copy(soln_path_grader, soln_path_student) 
-                    jupyter_uid = pwd.getpwnam('jupyter').pw_uid
-                    os.chown(soln_path_student, jupyter_uid, jupyter_uid)
+                    chown_user(soln_path_student, self.jupyter_user)
                 except Exception as e:
                     print('Error occurred when returning soln.')
                     print(e)
@@ -0,0 +1,41 @@
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+#one snapshot that has to happen at a due time: student is None for the whole-course snapshot of an assignment,
+#or the student's canvas id for an override snapshot
+SnapshotEvent = namedtuple('SnapshotEvent', ['due_at', 'assignment', 'student', 'snap_name'])
+
+class DueTimeline(object):
+    """
+    Every assignment and override due time, sorted once (as POSIX timestamps) so that "what is past due" and
+    "when is the next deadline" are binary searches instead of scans over all assignments and overrides.
+    Rebuild it whenever the assignments/overrides change (i.e. after a canvas sync).
+    """
+
+    def __init__(self, assignments):
+        events = []
+        for a in assignments:
+            if a.due_at is not None:
+                events.append(SnapshotEvent(a.due_at.timestamp(), a.name, None, a.snapshot_name()))
+            for over in a.overrides:
+                if over['due_at'] is not None:
+                    events.append(SnapshotEvent(over['due_at'].timestamp(), a.name, over['student_ids'][0], a.snapshot_name(over)))
+        events.sort(key = lambda ev : ev.due_at)
+        self.events = events
+        self.times = [ev.due_at for ev in events]
+
+    def __len__(self):
+        return len(self.events)
+
+    def due_before(self, t):
+        #events strictly past due at time t
+        return self.events[:bisect_left(self.times, t)]
+
+    def due_between(self, t0, t1):
+        #events with t0 < due_at <= t1
+        return self.events[bisect_right(self.times, t0):bisect_right(self.times, t1)]
+
+    def next_due(self, t):
+        #the first due time strictly after t, or None if there are no more deadlines
+        i = bisect_right(self.times, t)
+        return self.times[i] if i < len(self.times) else None
@@ -0,0 +1,61 @@
+import os, pwd, stat
+import tempfile
+import pickle as pk
+from functools import lru_cache
+
+#cache the passwd lookup; it doesn't change during a run and getpwnam can hit NSS/LDAP
+@lru_cache(maxsize=None)
+def get_uid_gid(username):
+    pw = pwd.getpwnam(username)
+    return pw.pw_uid, pw.pw_gid
+
+def chown_user(path, username):
+    uid, gid = get_uid_gid(username)
+    os.chown(path, uid, gid)
+
+def chown_tree(path, username):
+    #chown path and everything below it in one pass
+    #os.fwalk hands us an fd for each directory so each chown is relative to that fd (no repeated path resolution)
+    uid, gid = get_uid_gid(username)
+    for root, dirs, files, rootfd in os.fwalk(path, follow_symlinks=False):
+        os.chown(rootfd, uid, gid)
+        for fi in files:
+            os.chown(fi, uid, gid, dir_fd=rootfd, follow_symlinks=False)
+        #fwalk doesn't descend into symlinked dirs, so chown the link itself here
+        for di in dirs:
+            if stat.S_ISLNK(os.stat(di, dir_fd=rootfd, follow_symlinks=False).st_mode):
+                os.chown(di, uid, gid, dir_fd=rootfd, follow_symlinks=False)
+
+def makedirs_owned(path, username):
+    #create path and any missing parents, chowning only the directories that we actually create
+    uid, gid = get_uid_gid(username)
+    to_create = []
+    fldr = os.path.abspath(path)
+    while not os.path.exists(fldr):
+        to_create.append(fldr)
+        fldr = os.path.dirname(fldr)
+    os.makedirs(path, exist_ok=True)
+    for fldr in to_create:
+        os.chown(fldr, uid, gid)
+
+def available_memory():
+    #MemAvailable (bytes) from /proc/meminfo: free memory plus reclaimable cache, i.e. what new containers can actually use
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+def save_pickle(obj, path):
+    #write to a temp file in the same folder and atomically swap it in, so that a concurrent reader
+    #(e.g. a snapshot run loading the canvas cache while a grading run saves it) never sees a partial file
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(path)), prefix = '.' + os.path.basename(path) + '-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pk.dump(obj, f)
+        #mkstemp creates the file readable by us only
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
@@ -9,6 +9,7 @@ class ZFS(object):
     def __init__(self, config, dry_run):
         self.user_folder_root = config.user_folder_root
         self.jupyterhub_config_dir = config.jupyterhub_config_dir
+        self.jupyter_user = config.jupyter_user
         self.dry_run = dry_run
 
     def snapshot_all(self, snap_name):
@@ -29,9 +30,8 @@ class ZFS(object):
         print(check_output(['/usr/sbin/zfs', 'list', '-t', 'snapshot'], stderr = STDOUT))
 
     def create_user_folder(self, username):
-        callysto_user = 'jupyter'
         course = 'dsci100'
-        cmd_list = [os.path.join(self.jupyterhub_config_dir, 'zfs_homedir.sh'), course, username, callysto_user]
+        cmd_list = [os.path.join(self.jupyterhub_config_dir, 'zfs_homedir.sh'), course, username, self.jupyter_user]
         if not self.dry_run:
             check_output(cmd_list, stderr=STDOUT)
         else:
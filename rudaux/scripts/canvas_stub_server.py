@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+#A local stand-in for the parts of the Canvas REST API that rudaux uses, for testing and benchmarking rudaux.canvas
+#without touching a real course. It serves a generated course (students, TAs, assignments with overrides, groups,
+#submissions) with per-request latency, Canvas-style pagination and rate limiting (X-Rate-Limit-Remaining /
+#X-Request-Cost headers, 403 when the quota runs out), and optional random 5xx errors.
+#
+#Serve it and point a course config at it (c.canvas_domain = 'http://localhost:8765/', c.canvas_id = '1',
+#c.jupyterhub_host_root = 'hub.example.com'):
+#    python3 canvas_stub_server.py --port 8765 --latency 0.1
+#or benchmark the canvas client against it at a few concurrency levels:
+#    python3 canvas_stub_server.py --benchmark --latency 0.1 --concurrency 1 4 8
+
+import time
+import random
+import asyncio
+import threading
+from argparse import ArgumentParser
+from aiohttp import web
+from multidict import MultiDict
+import pendulum as plm
+
+class StubCanvas(object):
+
+    preflight_cost = 50
+    refill_rate = 10.
+
+    def __init__(self, n_students = 300, n_assignments = 20, n_groups = 30, hub_host = 'hub.example.com',
+                 latency = 0.05, error_rate = 0., quota = 700., seed = 1):
+        rng = random.Random(seed)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = rng
+        self.quota = quota
+        self.bucket = quota
+        self.bucket_updated = time.monotonic()
+        self.n_requests = 0
+        self.n_throttled = 0
+        self.next_id = 100000
+        now = plm.now()
+
+        self.course = {'id' : 1, 'name' : 'Stub Course', 'time_zone' : 'America/Vancouver'}
+        self.enrollments = []
+        def enroll(uid, typ):
+            self.enrollments.append({'type' : typ, 'enrollment_state' : 'active',
+                                     'created_at' : str(now.subtract(days = rng.randint(0, 60))),
+                                     'updated_at' : str(now.subtract(days = rng.randint(0, 30))),
+                                     'user' : {'id' : uid, 'name' : 'User ' + str(uid), 'sortable_name' : str(uid) + ', User',
+                                               'short_name' : 'User ' + str(uid), 'sis_user_id' : str(90000000 + uid)}})
+        self.students = list(range(1000, 1000 + n_students))
+        for uid in self.students:
+            enroll(uid, 'StudentEnrollment')
+        enroll(10, 'TeacherEnrollment')
+        enroll(20, 'TaEnrollment')
+        enroll(21, 'TaEnrollment')
+        enroll(30, 'StudentViewEnrollment')
+
+        self.assignments = {}
+        self.overrides = {}
+        self.submissions = {}
+        for k in range(n_assignments):
+            aid = 2000 + k
+            due = now.subtract(weeks = n_assignments//2).add(weeks = k)
+            self.overrides[aid] = [self._override(aid, [rng.choice(self.students)], due.add(days = rng.randint(1, 7)), due)
+                                   for m in range(rng.randint(0, 5))]
+            self.assignments[aid] = {'id' : aid, 'name' : 'assignment_' + str(k).zfill(2),
+                                     'due_at' : str(due), 'lock_at' : str(due.add(days = 14)), 'unlock_at' : str(due.subtract(days = 7)),
+                                     'points_possible' : 100, 'grading_type' : 'points', 'workflow_state' : 'published',
+                                     'published' : True, 'omit_from_final_grade' : False, 'updated_at' : str(now),
+                                     'external_tool_tag_attributes' : {'url' : 'https://' + hub_host + '/hub/lti/launch'}}
+            self.submissions[aid] = {uid : self._submission(aid, uid, due < now and rng.random() < 0.5) for uid in self.students}
+
+        self.groups = {3000 + g : [uid for uid in self.students if uid % n_groups == g] for g in range(n_groups)}
+
+    def _override(self, aid, student_ids, due, unlock):
+        self.next_id += 1
+        return {'id' : self.next_id, 'assignment_id' : aid, 'title' : 'override-' + str(self.next_id), 'student_ids' : student_ids,
+                'due_at' : str(due), 'unlock_at' : str(unlock), 'lock_at' : str(due.add(days = 7))}
+
+    def _submission(self, aid, uid, graded):
+        score = float(self.rng.randint(50, 100)) if graded else None
+        return {'user_id' : uid, 'assignment_id' : aid, 'grade' : None if score is None else str(score), 'score' : score,
+                'workflow_state' : 'graded' if graded else 'unsubmitted', 'excused' : False, 'late_policy_status' : None,
+                'points_deducted' : None, 'posted_at' : str(plm.now()) if graded else None, 'late' : False,
+                'missing' : False, 'entered_grade' : None if score is None else str(score), 'entered_score' : score}
+
+    def _touch(self, aid):
+        self.assignments[aid]['updated_at'] = str(plm.now())
+
+    def _has_overrides(self, a):
+        return dict(a, has_overrides = len(self.overrides[a['id']]) > 0)
+
+    #=======================================#
+    #     Rate limiting / latency / paging  #
+    #=======================================#
+
+    def _refill(self):
+        now = time.monotonic()
+        self.bucket = min(self.quota, self.bucket + self.refill_rate*(now - self.bucket_updated))
+        self.bucket_updated = now
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.n_requests += 1
+        self._refill()
+        if self.bucket <= 0:
+            self.n_throttled += 1
+            return web.Response(status = 403, text = '403 Forbidden (Rate Limit Exceeded)',
+                                headers = {'X-Rate-Limit-Remaining' : '0.0', 'X-Request-Cost' : '0.0'})
+        #canvas charges in-flight requests up front, and refunds it (less the actual cost) when they finish
+        self.bucket -= self.preflight_cost
+        await asyncio.sleep(self.latency)
+        cost = 1. + self.rng.random()
+        self._refill()
+        self.bucket += self.preflight_cost - cost
+        headers = {'X-Rate-Limit-Remaining' : str(round(max(self.bucket, 0.), 1)), 'X-Request-Cost' : str(round(cost, 3))}
+        if self.rng.random() < self.error_rate:
+            return web.Response(status = 503, text = 'Service Unavailable', headers = headers)
+        try:
+            resp = await handler(request)
+        except KeyError:
+            resp = web.Response(status = 404, text = 'Not Found')
+        resp.headers.update(headers)
+        return resp
+
+    async def _paginate(self, request, items):
+        per_page = request.query.get('per_page')
+        if per_page is None and request.can_read_body:
+            per_page = (await request.json()).get('per_page')
+        per_page = int(per_page or 10)
+        page = int(request.query.get('page', 1))
+        resp = web.json_response(items[(page-1)*per_page:page*per_page])
+        if page*per_page < len(items):
+            #keep repeated keys (e.g. assignment_ids[])
+            query = MultiDict(request.query)
+            query['page'] = str(page + 1)
+            query['per_page'] = str(per_page)
+            resp.headers['Link'] = '<' + str(request.url.with_query(query)) + '>; rel="next"'
+        return resp
+
+    #=======================================#
+    #               Endpoints               #
+    #=======================================#
+
+    async def course_info(self, request):
+        return web.json_response(self.course)
+
+    async def enrollment_list(self, request):
+        return await self._paginate(request, self.enrollments)
+
+    async def assignment_list(self, request):
+        return await self._paginate(request, [self._has_overrides(a) for a in self.assignments.values()])
+
+    async def override_list(self, request):
+        return await self._paginate(request, self.overrides[int(request.match_info['aid'])])
+
+    async def override_create(self, request):
+        aid = int(request.match_info['aid'])
+        od = (await request.json())['assignment_override']
+        over = dict(self._override(aid, od['student_ids'], plm.now(), plm.now()), **{k : od[k] for k in ['title', 'due_at', 'unlock_at', 'lock_at']})
+        self.overrides[aid].append(over)
+        self._touch(aid)
+        return web.json_response(over)
+
+    async def override_batch_create(self, request):
+        created = []
+        for od in (await request.json())['assignment_overrides']:
+            aid = int(od['assignment_id'])
+            over = dict(self._override(aid, od['student_ids'], plm.now(), plm.now()), **{k : od[k] for k in ['title', 'due_at', 'unlock_at', 'lock_at']})
+            self.overrides[aid].append(over)
+            self._touch(aid)
+            created.append(over)
+        return web.json_response(created)
+
+    async def override_delete(self, request):
+        aid, oid = int(request.match_info['aid']), int(request.match_info['oid'])
+        over = [o for o in self.overrides[aid] if o['id'] == oid]
+        if len(over) == 0:
+            return web.Response(status = 404, text = 'Not Found')
+        self.overrides[aid].remove(over[0])
+        self._touch(aid)
+        return web.json_response(over[0])
+
+    async def submission_list(self, request):
+        return await self._paginate(request, list(self.submissions[int(request.match_info['aid'])].values()))
+
+    async def course_submission_list(self, request):
+        #students/submissions?student_ids[]=all&assignment_ids[]=...
+        student_ids = request.query.getall('student_ids[]', [])
+        aids = [int(aid) for aid in request.query.getall('assignment_ids[]', [])] or list(self.submissions.keys())
+        subms = [subm for aid in aids for uid, subm in self.submissions[aid].items() if 'all' in student_ids or str(uid) in student_ids]
+        return await self._paginate(request, subms)
+
+    async def submission_get(self, request):
+        return web.json_response(self.submissions[int(request.match_info['aid'])][int(request.match_info['uid'])])
+
+    async def submission_put(self, request):
+        aid, uid = int(request.match_info['aid']), int(request.match_info['uid'])
+        score = float((await request.json())['submission']['posted_grade'])
+        self.submissions[aid][uid].update({'score' : score, 'grade' : str(score), 'entered_score' : score,
+                                           'entered_grade' : str(score), 'workflow_state' : 'graded'})
+        return web.json_response(self.submissions[aid][uid])
+
+    async def group_list(self, request):
+        return await self._paginate(request, [{'id' : gid, 'name' : 'group_' + str(gid), 'members_count' : len(members)} for gid, members in self.groups.items()])
+
+    async def membership_list(self, request):
+        gid = int(request.match_info['gid'])
+        return await self._paginate(request, [{'group_id' : gid, 'user_id' : uid} for uid in self.groups[gid]])
+
+    def app(self):
+        app = web.Application(middlewares = [self.middleware])
+        c = '/api/v1/courses/{cid}/'
+        app.add_routes([web.get(c, self.course_info),
+                        web.get(c + 'enrollments', self.enrollment_list),
+                        web.get(c + 'assignments', self.assignment_list),
+                        web.get(c + 'assignments/{aid}/overrides', self.override_list),
+                        web.post(c + 'assignments/{aid}/overrides', self.override_create),
+                        web.post(c + 'assignments/overrides', self.override_batch_create),
+                        web.delete(c + 'assignments/{aid}/overrides/{oid}', self.override_delete),
+                        web.get(c + 'assignments/{aid}/submissions', self.submission_list),
+                        web.get(c + 'students/submissions', self.course_submission_list),
+                        web.get(c + 'assignments/{aid}/submissions/{uid}', self.submission_get),
+                        web.put(c + 'assignments/{aid}/submissions/{uid}', self.submission_put),
+                        web.get(c + 'groups', self.group_list),
+                        web.get('/api/v1/groups/{gid}/memberships', self.membership_list)])
+        return app
+
+def serve_in_background(stub, port):
+    #run the stub server on its own event loop in a daemon thread; returns once it's listening
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    async def start():
+        runner = web.AppRunner(stub.app())
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        started.set()
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(start())
+        loop.run_forever()
+    threading.Thread(target = run, daemon = True).start()
+    started.wait()
+
+def benchmark(args, stub):
+    #time the canvas fetches that rudaux does on every sync / grading run, at each concurrency level
+    from traitlets.config import Config
+    from rudaux.canvas import Canvas
+    import terminaltables as ttbl
+    serve_in_background(stub, args.port)
+    tbl = [['Concurrency', 'Assignments + Overrides (s)', 'Groups + Memberships (s)', 'Submissions (s)', 'Requests', 'Throttled']]
+    for conc in args.concurrency:
+        config = Config()
+        config.canvas_domain = 'http://127.0.0.1:' + str(args.port) + '/'
+        config.canvas_id = '1'
+        config.canvas_token = 'stub'
+        config.jupyterhub_host_root = args.hub_host
+        config.canvas_max_concurrency = conc
+        config.canvas_max_tries = 10
+        config.canvas_rate_limit_reserve = 100
+        canvas = Canvas(config, dry_run = True)
+        n_req, n_thr = stub.n_requests, stub.n_throttled
+        times = []
+        start = time.time()
+        asgns = canvas.get_assignments()
+        times.append(time.time() - start)
+        start = time.time()
+        canvas.get_groups()
+        times.append(time.time() - start)
+        start = time.time()
+        canvas.get_course_submissions([a['canvas_id'] for a in asgns])
+        times.append(time.time() - start)
+        tbl.append([conc] + [round(t, 2) for t in times] + [stub.n_requests - n_req, stub.n_throttled - n_thr])
+        if args.verbose:
+            print(canvas.request_report())
+        canvas.close()
+    print(ttbl.AsciiTable(tbl, 'Canvas client vs stub (' + str(args.latency) + 's latency per request)').table)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Serve a stub Canvas course for testing / benchmarking rudaux.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--students', type=int, default=300)
+    parser.add_argument('--assignments', type=int, default=20)
+    parser.add_argument('--groups', type=int, default=30)
+    parser.add_argument('--hub-host', dest='hub_host', default='hub.example.com', help='The jupyterhub_host_root that assignment launch urls point at.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds each request takes.')
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0., help='Fraction of requests that fail with a 503.')
+    parser.add_argument('--quota', type=float, default=700., help='Size of the rate limit bucket.')
+    parser.add_argument('--benchmark', action='store_true', help='Instead of just serving, time the rudaux canvas client against the stub.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8], help='canvas_max_concurrency values to benchmark.')
+    parser.add_argument('--verbose', action='store_true', help='Print the per-endpoint request stats for each benchmark run.')
+    args = parser.parse_args()
+
+    stub = StubCanvas(args.students, args.assignments, args.groups, args.hub_host, args.latency, args.error_rate, args.quota)
+    if args.benchmark:
+        benchmark(args, stub)
+    else:
+        web.run_app(stub.app(), host = '127.0.0.1', port = args.port)
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+#An in-process stand-in for the parts of the docker SDK that rudaux.docker uses, for testing the docker job pool
+#(scheduling, multiple hosts, failover, retries, the circuit breaker, crash recovery) without a docker daemon.
+#Containers just "run" for a random duration and exit; hosts can be taken down and brought back mid-batch,
+#and container starts can be made to fail.
+#
+#Pass FakeDocker(...).client_factory as Docker's client_factory, or run a demo batch over a few fake hosts:
+#    python3 fake_docker.py --jobs 100 --hosts 3 --slots 4 --kill-host-after 2
+
+import os
+import time
+import random
+import tempfile
+import threading
+from argparse import ArgumentParser
+import docker
+
+class FakeContainer(object):
+
+    def __init__(self, host, command, duration, labels):
+        self.host = host
+        self.id = '%064x' % random.getrandbits(256)
+        self.command = command
+        self.labels = labels
+        self.finish_at = time.time() + duration
+        self.status = 'running'
+        self.attrs = {'State' : {'ExitCode' : None, 'OOMKilled' : False}}
+
+    def reload(self):
+        self.host.check_up()
+        if self.id not in self.host.containers_by_id:
+            raise docker.errors.NotFound('No such container: ' + self.id)
+        if self.status == 'running' and time.time() >= self.finish_at:
+            self.status = 'exited'
+            self.attrs['State']['ExitCode'] = 0
+
+    def logs(self, stdout = True, stderr = True):
+        self.host.check_up()
+        return ('fake output of ' + self.command + '\n').encode('utf-8')
+
+    def stats(self, stream = False, one_shot = True):
+        self.host.check_up()
+        return {'memory_stats' : {'usage' : random.randint(100, 500)*1024**2}}
+
+    def remove(self, force = False):
+        self.host.check_up()
+        if self.status == 'running' and not force:
+            raise docker.errors.APIError('You cannot remove a running container ' + self.id + '. Stop the container before attempting removal or force remove')
+        self.host.containers_by_id.pop(self.id, None)
+
+class FakeDockerHost(object):
+    """
+    One fake docker daemon. Set `down` to make every call fail with a connection error (the containers on it are lost),
+    and `start_error` to an exception to make container starts fail with it.
+    """
+
+    def __init__(self, url, min_duration, max_duration):
+        self.url = url
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.down = False
+        self.start_error = None
+        self.containers_by_id = {}
+        self.n_started = 0
+        #the SDK's client.containers.* methods live on this object too
+        self.containers = self
+
+    def check_up(self):
+        if self.down:
+            raise ConnectionError('Cannot connect to the fake docker daemon at ' + str(self.url))
+
+    def ping(self):
+        self.check_up()
+        return True
+
+    def run(self, image, command, detach = True, labels = None, **kwargs):
+        self.check_up()
+        if self.start_error is not None:
+            raise self.start_error
+        ctr = FakeContainer(self, command, random.uniform(self.min_duration, self.max_duration), labels or {})
+        self.containers_by_id[ctr.id] = ctr
+        self.n_started += 1
+        return ctr
+
+    def get(self, container_id):
+        self.check_up()
+        if container_id not in self.containers_by_id:
+            raise docker.errors.NotFound('No such container: ' + container_id)
+        return self.containers_by_id[container_id]
+
+    def list(self, all = False, filters = None):
+        self.check_up()
+        ctrs = list(self.containers_by_id.values())
+        label = (filters or {}).get('label')
+        if label is not None:
+            key, value = label.split('=', 1)
+            ctrs = [c for c in ctrs if c.labels.get(key) == value]
+        return ctrs if all else [c for c in ctrs if c.status == 'running']
+
+    def kill(self):
+        #the daemon goes away, taking its containers with it
+        self.down = True
+        self.containers_by_id = {}
+
+class FakeDocker(object):
+
+    def __init__(self, min_duration = 0.5, max_duration = 2.):
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.hosts = {}
+
+    def client_factory(self, url):
+        if url not in self.hosts:
+            self.hosts[url] = FakeDockerHost(url, self.min_duration, self.max_duration)
+        self.hosts[url].check_up()
+        return self.hosts[url]
+
+def demo(args):
+    #run a batch over fake hosts, optionally killing one partway through, and report how the pool coped
+    from traitlets.config import Config
+    from rudaux.docker import Docker
+    fake = FakeDocker(args.min_duration, args.max_duration)
+    config = Config()
+    config.name = 'fake'
+    config.grading_image = 'fake/image'
+    config.docker_memory = '2g'
+    config.docker_state_dir = tempfile.mkdtemp(prefix = 'rudaux-fake-docker-')
+    config.num_docker_threads = args.slots
+    config.docker_adaptive = False
+    config.min_docker_threads = 1
+    config.max_docker_threads = args.slots
+    config.docker_hosts = [{'url' : 'fake://host' + str(i), 'slots' : args.slots} for i in range(args.hosts)]
+    pool = Docker(config, False, fake.client_factory)
+    pool.health_check_every = 1
+    pool.backoff_base = 0.5
+    keys = [pool.submit('nbgrader autograde --assignment=fake --student=student' + str(i), None, 'autograde', 'fake', None) for i in range(args.jobs)]
+    if args.kill_host_after is not None:
+        victim = fake.hosts['fake://host0']
+        threading.Timer(args.kill_host_after, victim.kill).start()
+    start = time.time()
+    results = pool.wait(keys)
+    elapsed = time.time() - start
+    statuses = {}
+    for r in results.values():
+        statuses[r['exit_status']] = statuses.get(r['exit_status'], 0) + 1
+    print('Ran ' + str(args.jobs) + ' jobs in ' + str(round(elapsed, 1)) + ' seconds; exit statuses: ' + str(statuses))
+    for url, host in sorted(fake.hosts.items()):
+        print('  ' + url + ': ' + str(host.n_started) + ' containers started' + (' (killed)' if host.down else ''))
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Run a batch of jobs through the rudaux docker pool against fake docker hosts.')
+    parser.add_argument('--jobs', type=int, default=50)
+    parser.add_argument('--hosts', type=int, default=2)
+    parser.add_argument('--slots', type=int, default=4, help='Container slots per host.')
+    parser.add_argument('--min-duration', dest='min_duration', type=float, default=0.5, help='Shortest fake job (seconds).')
+    parser.add_argument('--max-duration', dest='max_duration', type=float, default=2., help='Longest fake job (seconds).')
+    parser.add_argument('--kill-host-after', dest='kill_host_after', type=float, default=None, help='Take the first host down after this many seconds.')
+    args = parser.parse_args()
+    demo(args)
@@ -9,13 +9,42 @@ c.student_local_assignment_folder = 'dsci-100/materials' # the name of the stude
 c.grading_image = 'yourdockeraccount/your-docker-image:v0.1'
 c.jupyterhub_host_root = 'your-student-jupyterhub.domain.com'
 c.jupyterhub_config_dir = '/srv/jupyterhub/' #the folder where jupyterhub_config and zfs_homedir.sh is
+c.jupyter_user = 'jupyter' #the system user that owns the student/grader folders (optional; defaults to jupyter)
 c.latereg_extension_days = 7 #number of days to give extensions for late registrations (registration date + 7 days here)
 c.instructor_user = 'your_username' #your username on the jupyterhub (you have to create this using dictauth)
 c.instructor_repo_url = 'git@github.com:your-account/your-repo.git' #the git url for the course material
+#c.instructor_repo_mirror = '/path/to/your/rudaux/config/folder/dsci100_instructor_repo.git' #local bare mirror of the instructor repo, fetched once per run (optional; defaults to [name]_instructor_repo.git in the course dir)
+#c.grader_clone_depth = 1 #history depth for grader folder clones from the mirror; None for a full clone (optional; defaults to 1)
+#c.num_git_threads = 4 #number of grader folders to clone in parallel (optional; defaults to 4)
+#c.canvas_max_concurrency = 4 #max canvas requests in flight at once; fewer are sent when canvas's rate limit quota runs low (optional; defaults to 4)
+#c.canvas_max_tries = 5 #how many times to try a canvas request that was throttled or failed with a server error (optional; defaults to 5)
+#c.canvas_full_sync_hours = 24 #`rudaux snapshot` and the daemon's periodic sync only refetch overrides/group memberships that changed, with a full canvas sync at least this often (optional; defaults to 24)
+#c.canvas_rate_limit_reserve = 100 #units of canvas's rate limit quota (700 by default) to keep unused, e.g. for other scripts using the same token (optional; defaults to 100)
 c.return_solution_threshold = 0.93 #the fraction of students whose assignments must be collected before you return solutions
 c.student_folder_root = '/tank-student/home/dsci100' #the NFS mount point on the instructor jupyterhub server for /tank/home/dsci100 from student server
 c.num_docker_threads = 4 #the number of CPU threads to use when grading, generating feedback, etc
 c.docker_memory = '1g' #the amount of memory for each grading thread
+#after a few grading runs, `rudaux stats` recommends values for the two settings above based on past job runtimes/memory
+#c.docker_hosts = [{'url' : 'unix:///var/run/docker.sock', 'slots' : 4},
+#                  {'url' : 'tcp://grader2.domain.com:2376', 'slots' : 8, 'path_map' : {'/tank/home/dsci100' : '/mnt/dsci100'}}]
+#                  #spread grading containers over several docker daemons, each with its own number of slots; grader/student folders
+#                  #must be shared with the other hosts (e.g. over NFS), with path_map translating local paths to paths on that host
+#                  #(optional; defaults to the local daemon with num_docker_threads slots)
+#c.docker_adaptive = True #start at num_docker_threads and adjust it to host load, free memory and OOM kills (optional; defaults to False)
+#c.min_docker_threads = 1 #lower bound on concurrent containers in adaptive mode (optional; defaults to 1)
+#c.max_docker_threads = 8 #upper bound on concurrent containers in adaptive mode (optional; defaults to num_docker_threads)
+#c.docker_state_dir = '/path/to/state' #where the docker job history and job queue (used to recover after a crash) are stored (optional; defaults to the course directory)
+#c.num_pipelined_assignments = 3 #grade this many assignments at once, overlapping collection/uploads with autograding in one shared docker pool (optional; defaults to 1)
+#c.lock_policy = {'snapshot' : 'skip', 'grading' : 'queue', 'notify' : 'skip'} #what a cron command does when another one in its group (snapshot / run+extend_lateregs / notify) is still running: wait for it ('queue') or exit ('skip') (optional; these are the defaults)
+#c.lock_wait_minutes = 60 #how long a 'queue' command waits for the lock before giving up (optional; defaults to 60)
+#c.lock_max_hours = 12 #runs holding a lock for longer than this are flagged as possibly hung in logs and `rudaux runs` (optional; defaults to 12)
+#c.daemon_socket = '/path/to/your/rudaux/config/folder/dsci100_daemon.sock' #control socket for `rudaux daemon` / `rudaux ctl` (optional; defaults to [name]_daemon.sock in the course dir)
+#c.daemon_sync_minutes = 60 #`rudaux daemon`: how often to resynchronize with canvas (optional; defaults to 60)
+#c.daemon_snapshot_minutes = 30 #`rudaux daemon`: snapshots are taken at each due time, plus a sweep this often (optional; defaults to 30)
+#c.daemon_snapshot_delay = 30 #`rudaux daemon`: seconds after a due time to take its snapshot (optional; defaults to 30)
+#c.daemon_latereg_hours = 24 #`rudaux daemon`: how often to apply late registration extensions (optional; defaults to 24)
+#c.daemon_grading_hours = 24 #`rudaux daemon`: how often to run the grading workflow (optional; defaults to 24)
+#c.daemon_notify_minutes = 60 #`rudaux daemon`: how often to send queued notifications (optional; defaults to 60)
 c.earliest_solution_return_date = '2020-10-02 01:00:00' #the earliest date in the course to return any solutions for anything
 
 c.notify_days = ['Monday', 'Thursday'] #days of the week to send grading reminder emails to graders (emails are sent to instructor for any errors any day)
@@ -26,6 +55,11 @@ c.sendmail.contact_info = {  #contact info for you and graders -- format is 'you
    'a_ta_name' : {'name' : 'TA Nice Name', 'address' : 'ta.email@email.com'},
    'a_ta_name' : {'name' : 'TA Nice Name', 'address' : 'ta.email@email.com'}
 }
+#c.notification_digest_hours = {'a_ta_name' : 24} #send queued notifications to these users at most once per X hours (optional; everyone else gets them at each `rudaux notify`)
+#c.notification_max_attempts = 5 #give up on a notification after this many failed sends (optional; defaults to 5)
+#c.notification_retry_minutes = 30 #wait this long before retrying a failed send, doubling after each failure (optional; defaults to 30)
+#c.notification_threads = 4 #number of notifications sent concurrently (optional; defaults to 4)
+#c.notification_rate = 1. #max notifications sent per second (optional; defaults to 1)
 #don't need this unless using notification_type = rudaux.notification.SMTP
 #c.smtp.hostname = 'smtp.otherdomain.com:587'
 #c.smtp.address = 'dsci100bot@otherdomain.com'